@@ -0,0 +1,230 @@
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.FileDescriptor;
+import java.io.FileInputStream;
+import java.io.FileOutputStream;
+import java.io.IOException;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.lang.management.ManagementFactory;
+import java.lang.management.ThreadMXBean;
+import java.lang.reflect.InvocationTargetException;
+import java.lang.reflect.Method;
+import java.net.URI;
+import java.nio.charset.StandardCharsets;
+import java.util.ArrayList;
+import java.util.HashMap;
+import java.util.List;
+import java.util.Locale;
+import java.util.Map;
+import javax.tools.Diagnostic;
+import javax.tools.DiagnosticCollector;
+import javax.tools.FileObject;
+import javax.tools.ForwardingJavaFileManager;
+import javax.tools.JavaCompiler;
+import javax.tools.JavaFileManager;
+import javax.tools.JavaFileObject;
+import javax.tools.SimpleJavaFileObject;
+import javax.tools.StandardJavaFileManager;
+import javax.tools.ToolProvider;
+
+/**
+ * Long-lived JVM for execute_java.py: compiles every solution in memory with javax.tools and runs its main method
+ * in a fresh class loader, so the static state of one solution is not visible to the next one and the JIT of the
+ * worker stays warm.
+ *
+ * Protocol on stdin/stdout, all numbers big endian:
+ *   request:  int length, class name (utf-8), int length, source (utf-8), long timeout in milliseconds
+ *             (a negative timeout only compiles the source, for syntax checks)
+ *   response: int status, boolean exiting, long cpu nanoseconds, long wall nanoseconds, int length, stdout (utf-8),
+ *             int length, messages (utf-8)
+ * status: 0 = finished, 1 = compilation failed, 2 = timed out, 3 = main threw an exception, 4 = main not found.
+ * After a timeout or an Error (like OutOfMemoryError) the worker answers with exiting = true and exits, because
+ * the thread of the solution cannot be stopped safely; the python side starts a new worker.
+ */
+public class JavaWorker {
+    static final int FINISHED = 0, COMPILATION_FAILED = 1, TIMED_OUT = 2, EXCEPTION = 3, NO_MAIN = 4;
+
+    static class SourceFile extends SimpleJavaFileObject {
+        final String source;
+        SourceFile(String className, String source) {
+            super(URI.create("string:///" + className + Kind.SOURCE.extension), Kind.SOURCE);
+            this.source = source;
+        }
+        @Override public CharSequence getCharContent(boolean ignoreEncodingErrors) { return source; }
+    }
+
+    static class ClassFile extends SimpleJavaFileObject {
+        final ByteArrayOutputStream bytes = new ByteArrayOutputStream();
+        ClassFile(String className) {
+            super(URI.create("bytes:///" + className.replace('.', '/') + Kind.CLASS.extension), Kind.CLASS);
+        }
+        @Override public OutputStream openOutputStream() { return bytes; }
+    }
+
+    static class MemoryFileManager extends ForwardingJavaFileManager<StandardJavaFileManager> {
+        final Map<String, ClassFile> classes = new HashMap<>();
+        MemoryFileManager(StandardJavaFileManager fileManager) { super(fileManager); }
+        @Override public JavaFileObject getJavaFileForOutput(JavaFileManager.Location location, String className,
+                                                             JavaFileObject.Kind kind, FileObject sibling) {
+            ClassFile file = new ClassFile(className);
+            classes.put(className, file);
+            return file;
+        }
+    }
+
+    static class MemoryClassLoader extends ClassLoader {
+        final Map<String, ClassFile> classes;
+        MemoryClassLoader(Map<String, ClassFile> classes) {
+            super(JavaWorker.class.getClassLoader());
+            this.classes = classes;
+        }
+        @Override protected Class<?> findClass(String name) throws ClassNotFoundException {
+            ClassFile file = classes.get(name);
+            if (file == null) throw new ClassNotFoundException(name);
+            byte[] bytes = file.bytes.toByteArray();
+            return defineClass(name, bytes, 0, bytes.length);
+        }
+    }
+
+    final JavaCompiler compiler = ToolProvider.getSystemJavaCompiler();
+    final StandardJavaFileManager standardFileManager = compiler.getStandardFileManager(null, Locale.ROOT, StandardCharsets.UTF_8);
+    final ThreadMXBean threads = ManagementFactory.getThreadMXBean();
+
+    int status;
+    long cpuNanos;
+    long wallNanos; // of the main method, without the compilation
+    String messages;
+    boolean restart;
+
+    void run(String className, String source, long timeoutMillis, ByteArrayOutputStream stdout) {
+        status = FINISHED;
+        cpuNanos = 0;
+        wallNanos = 0;
+        messages = "";
+        restart = false;
+
+        DiagnosticCollector<JavaFileObject> diagnostics = new DiagnosticCollector<>();
+        MemoryFileManager fileManager = new MemoryFileManager(standardFileManager);
+        List<JavaFileObject> units = new ArrayList<>();
+        units.add(new SourceFile(className, source));
+        boolean compiled = compiler.getTask(null, fileManager, diagnostics, null, null, units).call();
+        if (!compiled) {
+            StringBuilder text = new StringBuilder();
+            for (Diagnostic<? extends JavaFileObject> diagnostic : diagnostics.getDiagnostics()) {
+                if (diagnostic.getKind() != Diagnostic.Kind.ERROR) continue;
+                text.append(className).append(".java:").append(diagnostic.getLineNumber()).append(": error: ")
+                    .append(diagnostic.getMessage(Locale.ROOT)).append('\n');
+            }
+            status = COMPILATION_FAILED;
+            messages = text.toString();
+            return;
+        }
+        if (timeoutMillis < 0) return; // syntax check only
+
+        Method method;
+        try {
+            Class<?> solution = new MemoryClassLoader(fileManager.classes).loadClass(className);
+            method = solution.getMethod("main", String[].class);
+        } catch (ReflectiveOperationException | LinkageError e) {
+            status = NO_MAIN;
+            messages = e.toString();
+            return;
+        }
+        final Method main = method;
+
+        Throwable[] thrown = new Throwable[1];
+        long[] cpu = new long[1];
+        Thread thread = new Thread(() -> {
+            try {
+                main.invoke(null, (Object) new String[0]);
+            } catch (InvocationTargetException e) {
+                thrown[0] = e.getCause();
+            } catch (Throwable e) {
+                thrown[0] = e;
+            } finally {
+                cpu[0] = threads.isCurrentThreadCpuTimeSupported() ? threads.getCurrentThreadCpuTime() : 0;
+            }
+        }, "solution");
+        thread.setDaemon(true);
+        // like a java process: stdout is the result, stderr is dropped
+        PrintStream capture = new PrintStream(stdout, true, StandardCharsets.UTF_8);
+        System.setOut(capture);
+        System.setErr(new PrintStream(OutputStream.nullOutputStream()));
+        long start = System.nanoTime();
+        thread.start();
+        try {
+            thread.join(timeoutMillis);
+        } catch (InterruptedException e) {
+            Thread.currentThread().interrupt();
+        }
+        wallNanos = System.nanoTime() - start;
+        if (thread.isAlive()) {
+            status = TIMED_OUT;
+            restart = true;
+            cpuNanos = threads.isThreadCpuTimeSupported() ? Math.max(0, threads.getThreadCpuTime(thread.getId())) : 0;
+            return;
+        }
+        cpuNanos = cpu[0];
+        capture.flush();
+        if (thrown[0] != null) {
+            status = EXCEPTION;
+            messages = thrown[0].toString();
+            restart = thrown[0] instanceof Error; // the heap or the stack of the worker may be broken
+        }
+    }
+
+    static byte[] readBytes(DataInputStream in) throws IOException {
+        byte[] bytes = new byte[in.readInt()];
+        in.readFully(bytes);
+        return bytes;
+    }
+
+    static void writeString(DataOutputStream out, String text) throws IOException {
+        byte[] bytes = text.getBytes(StandardCharsets.UTF_8);
+        out.writeInt(bytes.length);
+        out.write(bytes);
+    }
+
+    public static void main(String[] args) throws IOException {
+        // the protocol uses the real stdout; System.out is replaced by the capture of the solutions
+        DataInputStream in = new DataInputStream(new BufferedInputStream(new FileInputStream(FileDescriptor.in)));
+        DataOutputStream out = new DataOutputStream(new BufferedOutputStream(new FileOutputStream(FileDescriptor.out)));
+        PrintStream log = System.err;
+        JavaWorker worker = new JavaWorker();
+        while (true) {
+            String className, source;
+            long timeoutMillis;
+            try {
+                className = new String(readBytes(in), StandardCharsets.UTF_8);
+                source = new String(readBytes(in), StandardCharsets.UTF_8);
+                timeoutMillis = in.readLong();
+            } catch (IOException e) {
+                return; // the python side closed the pipe
+            }
+            ByteArrayOutputStream stdout = new ByteArrayOutputStream();
+            try {
+                worker.run(className, source, timeoutMillis, stdout);
+            } catch (Throwable e) {
+                worker.status = EXCEPTION;
+                worker.messages = e.toString();
+                worker.restart = true;
+            }
+            String output = new String(stdout.toByteArray(), StandardCharsets.UTF_8);
+            out.writeInt(worker.status);
+            out.writeBoolean(worker.restart);
+            out.writeLong(worker.cpuNanos);
+            out.writeLong(worker.wallNanos);
+            writeString(out, output);
+            writeString(out, worker.messages);
+            out.flush();
+            if (worker.restart) {
+                log.flush();
+                Runtime.getRuntime().halt(worker.status == TIMED_OUT ? 2 : 3);
+            }
+        }
+    }
+}
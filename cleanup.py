@@ -1,5 +1,5 @@
 from argparse import ArgumentParser
-from llm_client import ollama_api_delete, Endpoint
+from llm_client import ollama_api_delete, api_stub_endpoint
 
 def main():
     parser = ArgumentParser(description="Cleanup models: delete models from ollama endpoints")
@@ -14,7 +14,7 @@ def main():
 
     for api_stub in api_base:
         try:
-            endpoint = Endpoint(store_name=model_name, model_name=model_name, key="", url=f"{api_stub}/v1/chat/completions")
+            endpoint = api_stub_endpoint(model_name, model_name, api_stub)
             ollama_api_delete(endpoint)
             print(f"Model {model_name} removed from {api_stub}.")
         except Exception as e:
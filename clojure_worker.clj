@@ -0,0 +1,99 @@
+;; Warm clojure runtime for execute_clojure.py: evaluates every solution in a fresh namespace like `clj -M -e`,
+;; so the runtime and the tooling start once per worker instead of once per solution.
+;;
+;; Protocol on stdin/stdout, all numbers big endian:
+;;   request:  int length, code (utf-8), long timeout in milliseconds
+;;   response: int status, boolean exiting, long wall nanoseconds, int length, stdout (utf-8), int length, message (utf-8)
+;; status: 0 = finished, 1 = the solution threw an exception, 2 = timed out.
+;; After a timeout or an Error (like OutOfMemoryError) the worker answers with exiting = true and exits, because
+;; the thread of the solution cannot be stopped safely; the python side then starts a new worker. It also replaces
+;; the workers after a number of solutions, so state which leaks out of the namespaces does not carry over for long.
+
+(ns clojure-worker
+  (:import [java.io BufferedInputStream BufferedOutputStream ByteArrayOutputStream DataInputStream DataOutputStream
+            FileDescriptor FileInputStream FileOutputStream OutputStreamWriter PrintStream StringReader]
+           [java.nio.charset StandardCharsets]
+           [clojure.lang LineNumberingPushbackReader]))
+
+(def finished 0)
+(def exception 1)
+(def timed-out 2)
+
+(def counter (atom 0))
+
+(defn eval-solution
+  "Read and evaluate the forms of the code in the current namespace and print the non-nil values like clj -e"
+  [code]
+  (let [eof (Object.)
+        reader (LineNumberingPushbackReader. (StringReader. code))]
+    (loop []
+      (let [form (binding [*read-eval* true] (read reader false eof))]
+        (when-not (identical? form eof)
+          (let [value (eval form)]
+            (when-not (nil? value) (prn value)))
+          (recur))))))
+
+(defn run-solution
+  "Evaluate the code in a fresh namespace on its own thread; returns [status output message exiting wall-nanos]"
+  [code timeout-ms]
+  (let [ns-name (symbol (str "solution-" (swap! counter inc)))
+        solution-ns (create-ns ns-name)
+        buffer (ByteArrayOutputStream.)
+        out (OutputStreamWriter. buffer StandardCharsets/UTF_8)
+        thrown (atom nil)
+        thread (Thread.
+                 (fn []
+                   (try
+                     (binding [*ns* solution-ns
+                               *out* out]
+                       (refer 'clojure.core)
+                       (eval-solution code))
+                     (catch Throwable e (reset! thrown e))
+                     (finally (.flush out))))
+                 "solution")]
+    (System/setOut (PrintStream. buffer true "UTF-8"))
+    (.setDaemon thread true)
+    (let [start (System/nanoTime)
+          _ (.start thread)
+          _ (.join thread timeout-ms)
+          wall-nanos (- (System/nanoTime) start)
+          output (String. (.toByteArray buffer) StandardCharsets/UTF_8)]
+      (if (.isAlive thread)
+        [timed-out output "" true wall-nanos]
+        (do
+          (remove-ns ns-name)
+          (if-let [e @thrown]
+            [exception output (str e) (instance? Error e) wall-nanos] ; the heap or the stack of the worker may be broken
+            [finished output "" false wall-nanos]))))))
+
+(defn write-string [^DataOutputStream out ^String text]
+  (let [bytes (.getBytes text StandardCharsets/UTF_8)]
+    (.writeInt out (alength bytes))
+    (.write out bytes)))
+
+(defn -main []
+  ;; the protocol uses the real stdout; System/out and *out* are replaced by the capture of the solutions
+  (let [in (DataInputStream. (BufferedInputStream. (FileInputStream. FileDescriptor/in)))
+        out (DataOutputStream. (BufferedOutputStream. (FileOutputStream. FileDescriptor/out)))]
+    (System/setErr (PrintStream. (java.io.OutputStream/nullOutputStream))) ; like a clj process: stderr is dropped
+    (loop []
+      (when-let [request (try
+                           (let [bytes (byte-array (.readInt in))]
+                             (.readFully in bytes)
+                             [(String. bytes StandardCharsets/UTF_8) (.readLong in)])
+                           (catch java.io.IOException _ nil))] ; the python side closed the pipe
+        (let [[code timeout-ms] request
+              [status output message exiting wall-nanos] (try
+                                                           (run-solution code timeout-ms)
+                                                           (catch Throwable e [exception "" (str e) true 0]))]
+          (.writeInt out status)
+          (.writeBoolean out exiting)
+          (.writeLong out wall-nanos)
+          (write-string out output)
+          (write-string out message)
+          (.flush out)
+          (if exiting
+            (.halt (Runtime/getRuntime) (int status))
+            (recur)))))))
+
+(-main)
@@ -1,15 +1,91 @@
 import os
 import re
 import json
+import hashlib
+import statistics
+import threading
 import multiprocessing
 from concurrent.futures import ThreadPoolExecutor
-from llm_client import Endpoint
+from llm_client import Endpoint, ResponseCache
 from argparse import ArgumentParser
 from benchmark import read_benchmark, write_benchmark, sort_benchmark
-from execute_clojure import execute_clojure_code
-from execute_java import execute_java_code
+import execute_clojure
+from execute_clojure import execute_clojure_code, set_clojure_worker
+import execute_java
+from execute_java import JavaBatch, execute_java_code, set_java_worker
 from execute_python import execute_python_code
-from execute_rust import execute_rust_code
+import execute_rust
+from execute_rust import execute_rust_code, set_rust_build
+
+SOLUTIONS_META_FILE = 'solutions_meta.json'
+SOLUTIONS_PROFILE_FILE = 'solutions_profile.json'
+
+class ExecutionCache:
+    """
+    Outputs of executed programs, shared by all models in cache/execution. Many models write the same program for
+    easy problems, so the key is the language and the hash of the normalized source: line endings, trailing
+    whitespace and empty lines do not count. Entries are evicted least-recently-used first like the response cache.
+    Timeouts and failures of the execution environment are not cached because they depend on the load of the machine.
+    """
+    NOT_CACHED = ("timed", "Error executing code", "No output received", "Unknown issue")
+
+    def __init__(self, cache_dir, max_bytes=256 << 20):
+        self.store = ResponseCache(cache_dir, max_bytes)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.not_cached = 0
+
+    @staticmethod
+    def normalize(code):
+        lines = (line.rstrip() for line in code.replace('\r\n', '\n').split('\n'))
+        return '\n'.join(line for line in lines if line)
+
+    @staticmethod
+    def key(language, code):
+        return hashlib.sha256(f"{language}\n{ExecutionCache.normalize(code)}".encode('utf-8')).hexdigest()
+
+    def get(self, language, code, profile=None):
+        """the cached output of the program or None; the profile of the execution is copied into profile"""
+        entry = self.store.get(ExecutionCache.key(language, code))
+        with self.lock:
+            if entry is None: self.misses += 1
+            else: self.hits += 1
+        if entry is None: return None
+        if profile is not None: profile.update(entry.get('profile', {}))
+        return entry.get('output')
+
+    def contains(self, language, code):
+        """True if the program is in the cache; does not count as a lookup"""
+        return os.path.exists(self.store.path(ExecutionCache.key(language, code)))
+
+    @staticmethod
+    def is_cacheable(raw_output):
+        """decided on the complete output of an executor, the last line of a failure is usually a traceback line"""
+        return not (raw_output.startswith("Error") and any(marker in raw_output for marker in ExecutionCache.NOT_CACHED))
+
+    def put(self, language, code, output, profile=None, cacheable=True):
+        if not cacheable:
+            with self.lock: self.not_cached += 1
+            return
+        entry = {'language': language, 'output': output}
+        if profile: entry['profile'] = profile
+        self.store.put(ExecutionCache.key(language, code), entry)
+
+    def report(self):
+        lookups = self.hits + self.misses
+        share = 100.0 * self.hits / lookups if lookups else 0.0
+        return (f"Execution cache: {self.hits} of {lookups} programs taken from the cache ({share:.1f}%), "
+                f"{self.not_cached} results not cached (timeouts and environment errors)")
+
+execution_cache_enabled = True
+execution_cache = ExecutionCache(os.path.join(os.path.dirname(os.path.realpath(__file__)), 'cache', 'execution'))
+
+def set_execution_cache(enabled, max_mb=None):
+    """Enable or disable the execution cache and set its size limit in MB"""
+    global execution_cache_enabled
+    execution_cache_enabled = enabled
+    if max_mb is not None: execution_cache.store.max_bytes = max_mb << 20
 
 def get_extension(language):
     if language == 'c': return 'c'
@@ -61,7 +137,74 @@ def get_series_name(language, max_problem_number, tool_mode=False):
         return f"{language}-tool-{max_problem_number}"
     return f"{language}-{max_problem_number}"
 
-def process_solutions(model_name, language, max_problem_number, expected_solutions, tool_mode=False):
+def source_hash(program_file_path):
+    """content hash of a solution file; a file with an unchanged hash does not need to be executed again"""
+    with open(program_file_path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+def read_solutions_meta(results_dir):
+    """
+    Read the solutions_meta.json of a results directory. It maps each program file name to the content hash,
+    the executor settings and the output of its last execution; solutions.json keeps the plain outputs for the
+    other tools. Outputs which the ExecutionCache does not cache are not recorded, so they are executed again.
+    """
+    meta_path = os.path.join(results_dir, SOLUTIONS_META_FILE)
+    if not os.path.exists(meta_path): return {}
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as json_file:
+            return json.load(json_file)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def executor_settings(language, profile=None):
+    """
+    the settings of the executor of a language which can change the output; recorded in solutions_meta.json.
+    Without a profile these are the configured settings, with the profile of an execution the settings which the
+    execution actually used: a worker which is not available falls back to processes.
+    """
+    if language == 'rust':
+        return {'rust_opt_level': execute_rust.rust_build_cache.opt_level}
+    if language in ('java', 'clojure'):
+        if profile is None:
+            enabled = execute_java.java_worker_enabled if language == 'java' else execute_clojure.clojure_worker_enabled
+            return {language: 'worker' if enabled else 'process'}
+        return {language: profile.get('executor', 'process')}
+    return {}
+
+def is_recorded(recorded, content_hash, language):
+    """True if a meta record holds the output of the same file executed with the configured settings"""
+    return bool(recorded) and recorded.get('hash') == content_hash and \
+        recorded.get('settings', {}) == executor_settings(language)
+
+def meta_record(content_hash, language, output, profile, cacheable):
+    """the meta record of an execution; None for outputs which shall be executed again next time"""
+    if not cacheable: return None
+    return {'hash': content_hash, 'settings': executor_settings(language, profile), 'output': output, 'profile': profile}
+
+def write_solutions_meta(results_dir, meta):
+    with open(os.path.join(results_dir, SOLUTIONS_META_FILE), 'w', encoding='utf-8') as json_file:
+        json.dump(dict(sorted(meta.items())), json_file, indent=4)
+
+def read_solutions_profile(results_dir):
+    """
+    Read the solutions_profile.json of a results directory. It maps each problem number to the profile of the
+    execution of its solution: wall_seconds, cpu_seconds, peak_rss_mb, exit_status and timed_out, as far as the
+    executor can measure them, and executor "worker" for solutions which ran in a java or clojure worker.
+    Solutions which were not executed (answer found in the text) have an empty profile.
+    """
+    profile_path = os.path.join(results_dir, SOLUTIONS_PROFILE_FILE)
+    if not os.path.exists(profile_path): return {}
+    try:
+        with open(profile_path, 'r', encoding='utf-8') as json_file:
+            return json.load(json_file)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+def write_solutions_profile(results_dir, profiles):
+    with open(os.path.join(results_dir, SOLUTIONS_PROFILE_FILE), 'w', encoding='utf-8') as json_file:
+        json.dump(dict(sorted(profiles.items())), json_file, indent=4)
+
+def process_solutions(model_name, language, max_problem_number, expected_solutions, tool_mode=False, incremental=True):
     results_dir = os.path.join('solutions', model_name, language)
     solutions_json_path = os.path.join('solutions', model_name, language, 'solutions.json')
     extension = get_extension(language)
@@ -70,7 +213,11 @@ def process_solutions(model_name, language, max_problem_number, expected_solutio
         raise Exception(f"Directory '{results_dir}' does not exist.")
 
     solutions = {}
+    profiles = {}
     tasks = []
+    meta = read_solutions_meta(results_dir) if incremental else {}
+    hashes = {}
+    unchanged = 0
     program_files = sorted(os.listdir(results_dir))
     for program_file in program_files:
         if tool_mode:
@@ -82,50 +229,105 @@ def process_solutions(model_name, language, max_problem_number, expected_solutio
         problem_number = get_problem_number_from_stem(program_file[:-extlen])
         if int(problem_number) > max_problem_number: break
 
+        # only new or changed files are executed, the others keep the output of their last execution
+        hashes[program_file] = source_hash(program_file_path)
+        recorded = meta.get(program_file)
+        if is_recorded(recorded, hashes[program_file], language):
+            solutions[problem_number] = recorded.get('output', '')
+            profiles[problem_number] = recorded.get('profile', {})
+            unchanged += 1
+            continue
+
         expected = expected_solutions.get(problem_number, None)
         tasks.append((program_file_path, expected))
 
+    if unchanged:
+        print(f"Skipped {unchanged} unchanged {language} files, their outputs are taken from {SOLUTIONS_META_FILE}")
     if tasks:
+        java_batch = None
+        if language == 'java' and not execute_java.java_worker_enabled:
+            # compile all java solutions with a few javac invocations, the executions then only start java
+            java_batch = JavaBatch([read_code(program_file_path) for program_file_path, expected in tasks
+                                    if needs_execution(program_file_path, expected)])
         max_workers = min(len(tasks), multiprocessing.cpu_count() or 1)
-        with ThreadPoolExecutor(max_workers=max_workers) as executor:
-            results = list(executor.map(_execute_solution_task, tasks))
+        try:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(lambda task: _execute_solution_task(task, java_batch), tasks))
+        finally:
+            if java_batch: java_batch.close()
 
-        for problem_number, output in results:
+        for (program_file_path, _), (problem_number, output, profile, cacheable) in zip(tasks, results):
             solutions[problem_number] = output
+            profiles[problem_number] = profile
+            program_file = os.path.basename(program_file_path)
+            record = meta_record(hashes[program_file], language, output, profile, cacheable)
+            if record: meta[program_file] = record
+            else: meta.pop(program_file, None)
 
             # Write the solutions to a JSON file. We write this after each solution to avoid losing progress.
             with open(solutions_json_path, 'w', encoding='utf-8') as json_file:
-                json.dump(solutions, json_file, indent=4)
+                json.dump(dict(sorted(solutions.items())), json_file, indent=4)
+        write_solutions_meta(results_dir, meta)
+    elif solutions:
+        with open(solutions_json_path, 'w', encoding='utf-8') as json_file:
+            json.dump(dict(sorted(solutions.items())), json_file, indent=4)
+    if solutions: write_solutions_profile(results_dir, profiles)
 
     print(f"Executed all {language} files and saved results to {solutions_json_path}")
     return solutions
 
-def execute_solution(program_file_path, expected):
-    extension = program_file_path.split('.')[-1]
-    language = get_language_from_extension(extension)
-
-    # load the program code
+def read_code(program_file_path):
+    """load the program code; stripped in case there are empty lines at the end"""
     with open(program_file_path, 'r', encoding='utf-8') as file:
-        code = file.read()
+        return file.read().strip()
+
+def execute_solution(program_file_path, expected, java_batch=None, profile=None):
+    """execute a solution file and return the last line of its output; the measurements of the execution go to profile"""
+    return run_solution(program_file_path, expected, java_batch, profile)[0]
 
+def answer_in_content(code, expected_solution):
+    """the context around the expected solution if it appears anywhere in the content of a solution file, else None"""
     # In some cases the code extraction does not find code and considers the whole file as code.
     # Here it might be that the LLM did actually solve the problem by itself using reasoning.
     # If that happens, the answer might be anywhere in the content.
-    code = code.strip() # in case there are empty lines at the end
-    expected_solution = expected.get('solution', '') if expected else ''
+    if not expected_solution: return None
+    # Remove commas and check if solution appears in content
+    code_normalized = code.replace(',', '')
+    idx = code_normalized.find(expected_solution)
+    if idx < 0: return None
+    # Extract the context around the solution for logging
+    context_start = max(0, idx - 20)
+    context_end = min(len(code_normalized), idx + len(expected_solution) + 20)
+    return code_normalized[context_start:context_end]
+
+def needs_execution(program_file_path, expected):
+    """True if run_solution would execute the program: the answer is not in the content and not in the execution cache"""
+    code = read_code(program_file_path)
+    if answer_in_content(code, expected.get('solution', '') if expected else '') is not None: return False
+    language = get_language_from_extension(program_file_path.split('.')[-1])
+    return not (execution_cache_enabled and execution_cache.contains(language, code))
+
+def run_solution(program_file_path, expected, java_batch=None, profile=None):
+    """
+    execute a solution file like execute_solution; returns the last line of the output and whether the output may be
+    kept, which is False for timeouts and failures of the execution environment
+    """
+    extension = program_file_path.split('.')[-1]
+    language = get_language_from_extension(extension)
 
-    # Check if the expected solution appears anywhere in the content (for non-code responses)
-    if expected_solution and len(expected_solution) > 0:
-        # Remove commas and check if solution appears in content
-        code_normalized = code.replace(',', '')
-        if expected_solution in code_normalized:
-            # Extract the context around the solution for logging
-            idx = code_normalized.find(expected_solution)
-            context_start = max(0, idx - 20)
-            context_end = min(len(code_normalized), idx + len(expected_solution) + 20)
-            context = code_normalized[context_start:context_end]
-            print(f"Executed {program_file_path}: Found solution {expected_solution} in content: ...{context}...")
-            return expected_solution
+    code = read_code(program_file_path)
+    expected_solution = expected.get('solution', '') if expected else ''
+    context = answer_in_content(code, expected_solution)
+    if context is not None:
+        print(f"Executed {program_file_path}: Found solution {expected_solution} in content: ...{context}...")
+        return expected_solution, True
+
+    # programs which were executed before, maybe for another model, are taken from the execution cache
+    cached_output = execution_cache.get(language, code, profile) if execution_cache_enabled else None
+    if cached_output is not None:
+        result = "** CORRECT **" if cached_output == expected_solution else ".. incorrect .."
+        print(f"Executed {program_file_path}: {cached_output} - {result} (from execution cache)")
+        return cached_output, True
 
     # Otherwise, try to execute the code
     if True:
@@ -133,28 +335,43 @@ def execute_solution(program_file_path, expected):
         print(f"Running program: {program_file_path}")
         output = ""
         if language == 'python':
-            output = execute_python_code(code)
+            output = execute_python_code(code, profile=profile)
         if language == 'clojure':
-            output = execute_clojure_code(code)
+            output = execute_clojure_code(code, profile=profile)
         if language == 'java':
-            output = execute_java_code(code)
+            output = java_batch.execute(code, profile=profile) if java_batch else None
+            if output is None: output = execute_java_code(code, profile=profile)
         if language == 'rust':
-            output = execute_rust_code(code)
+            output = execute_rust_code(code, profile=profile)
     
         # if the output has several lines, we only want the last one
         #print(f"Executed {solution_code_path}, raw output:{output}")
+        cacheable = ExecutionCache.is_cacheable(output)
         output = output.strip().split('\n')[-1]
         result = "** CORRECT **" if output == expected_solution else ".. incorrect .."
         print(f"Executed {program_file_path}: {output} - {result}")
-        return output
+        if execution_cache_enabled: execution_cache.put(language, code, output, profile, cacheable)
+        return output, cacheable
 
-def _execute_solution_task(args):
+def _execute_solution_task(args, java_batch=None):
     program_file_path, expected = args
     problem_number = get_problem_number_from_stem(os.path.splitext(os.path.basename(program_file_path))[0])
-    output = execute_solution(program_file_path, expected)
-    return problem_number, output
-
-def evaluate_solutions(solutions, model_name, language, max_problem_number, expected_solutions, tool_mode=False):
+    profile = {}
+    output, cacheable = run_solution(program_file_path, expected, java_batch, profile)
+    return problem_number, output, profile, cacheable
+
+def efficiency_columns(solutions, profiles, expected_solutions):
+    """medians of the measurements of the correct solutions which were executed; empty if there are none"""
+    correct = [profiles.get(problem_number) or {} for problem_number, output in solutions.items()
+               if output == expected_solutions.get(problem_number, {}).get('solution')]
+    columns = {}
+    for key, name in (('wall_seconds', 'median-seconds'), ('cpu_seconds', 'median-cpu-seconds'), ('peak_rss_mb', 'median-rss-mb')):
+        values = [profile[key] for profile in correct if profile.get(key) is not None]
+        if values: columns[name] = round(statistics.median(values), 4)
+    if columns: columns['profiled'] = sum(1 for profile in correct if profile)
+    return columns
+
+def evaluate_solutions(solutions, model_name, language, max_problem_number, expected_solutions, tool_mode=False, profiles=None):
 
     if len(solutions) == max_problem_number:
         # evaluate the solutions by comparing with the expected results
@@ -200,6 +417,11 @@ def evaluate_solutions(solutions, model_name, language, max_problem_number, expe
         print(f"Candidate Solution Count: {candidate_count}")
         print(f"Candidate Point Average: {candidate_point_average}")
 
+        # efficiency of the correct solutions, so models can also be compared by the runtime of their code
+        if profiles is None: profiles = read_solutions_profile(os.path.join('solutions', model_name, language))
+        efficiency = efficiency_columns(solutions, profiles, expected_solutions)
+        if efficiency: print(f"Efficiency of correct solutions: {efficiency}")
+
         # open the benchmark file and update the points
         benchmark = read_benchmark()
 
@@ -209,6 +431,7 @@ def evaluate_solutions(solutions, model_name, language, max_problem_number, expe
         series_name_test = f"{series_name}-test"
         entry[series_name] = candidate_point_average
         entry[series_name_test] = ''.join(test_results)
+        for name, value in efficiency.items(): entry[f"{series_name}-{name}"] = value
         benchmark[model_name] = entry
 
         # sort the benchmark with the highest points first, average over all batch sizes
@@ -228,12 +451,23 @@ def main():
     parser.add_argument('--language', required=False, default='python,java,rust,clojure', help='Name of the programming language to use, default is python')
     parser.add_argument('--endpoint', required=False, default='', help='Name of an <endpoint>.json file in the endpoints directory')
     parser.add_argument('--tool', action='store_true', help='execute tool-generated source files with the tool- prefix and store separate benchmark keys')
+    parser.add_argument('--reexecute', action='store_true', help='execute all solution files, also those which did not change since their last execution')
+    parser.add_argument('--no_exec_cache', action='store_true', help='execute every program instead of taking the output of an identical program from cache/execution')
+    parser.add_argument('--exec_cache_mb', type=int, default=256, help='size limit of the execution cache in MB, default is 256')
+    parser.add_argument('--java_worker', action='store_true', help='execute java solutions in long-lived worker JVMs instead of one javac and one java process per solution')
+    parser.add_argument('--clojure_worker', action='store_true', help='evaluate clojure solutions in warm worker runtimes instead of one clj process per solution')
+    parser.add_argument('--rust_opt_level', default='2', help='rustc opt-level of the rust solutions, default is 2')
+    parser.add_argument('--rust_compile_workers', type=int, default=0, help='number of parallel rustc processes, default is half the number of cpu cores')
     parser.add_argument('--n100', action='store_true', help='only 100 problems') # this is the default
     parser.add_argument('--n200', action='store_true', help='only 200 problems')
     parser.add_argument('--n400', action='store_true', help='only 400 problems')
     parser.add_argument('--nall', action='store_true', help='all problems')
 
     args = parser.parse_args()
+    set_execution_cache(not args.no_exec_cache, args.exec_cache_mb)
+    set_java_worker(args.java_worker)
+    set_clojure_worker(args.clojure_worker)
+    set_rust_build(args.rust_opt_level, args.rust_compile_workers)
     store_name = args.model
     languages = args.language.split(',')
     max_problem_number = 200
@@ -264,11 +498,12 @@ def main():
             benchmark = read_benchmark()
             # the keys are the model names
             for store_name in benchmark:
-                solutions = process_solutions(store_name, language, max_problem_number, expected_solutions, tool_mode=args.tool)
+                solutions = process_solutions(store_name, language, max_problem_number, expected_solutions, tool_mode=args.tool, incremental=not args.reexecute)
                 evaluate_solutions(solutions, store_name, language, max_problem_number, expected_solutions, tool_mode=args.tool)
         else:
-            solutions = process_solutions(store_name, language, max_problem_number, expected_solutions, tool_mode=args.tool)
+            solutions = process_solutions(store_name, language, max_problem_number, expected_solutions, tool_mode=args.tool, incremental=not args.reexecute)
             evaluate_solutions(solutions, store_name, language, max_problem_number, expected_solutions, tool_mode=args.tool)
+    if execution_cache_enabled: print(execution_cache.report())
 
 if __name__ == "__main__":
     main()
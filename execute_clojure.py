@@ -1,6 +1,10 @@
+import os
 import re
+import struct
 import subprocess
+import threading
 import traceback
+from sandbox import core_pool, jvm_options, pin_process, run_limited
 
 
 CLOJURE_BLOCKED_PATTERNS = [
@@ -72,7 +76,108 @@ def syntax_check_clojure(code):
     return 0, "Parentheses OK", ""
 
 
-def execute_clojure_code(code, timeout=10):
+CLOJURE_WORKER_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "clojure_worker.clj")
+CLOJURE_WORKER_RECYCLE = 50          # solutions per worker; defs outside the solution namespace would carry over
+CLOJURE_WORKER_STARTUP_SECONDS = 120 # allowance for the start of a worker on top of the timeout of a solution
+CLOJURE_FINISHED, CLOJURE_EXCEPTION, CLOJURE_TIMED_OUT = range(3)
+
+clojure_worker_enabled = False
+
+
+class ClojureWorker:
+    """
+    A warm clojure runtime running clojure_worker.clj: every solution is evaluated in a fresh namespace which is
+    removed afterwards, so the runtime starts once per worker instead of once per solution. The worker exits after
+    a timeout or an Error of a solution and is replaced after CLOJURE_WORKER_RECYCLE solutions.
+    """
+    def __init__(self):
+        self.process = subprocess.Popen(
+            ["clj", *("-J" + option for option in jvm_options()), "-M", CLOJURE_WORKER_SOURCE],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, start_new_session=True)
+        self.runs = 0
+        self.exiting = False
+
+    def _read(self, size):
+        data = self.process.stdout.read(size)
+        if len(data) != size: raise EOFError("Clojure worker ended unexpectedly")
+        return data
+
+    def run(self, code, timeout):
+        """Evaluate one solution; returns (status, wall_seconds, output, message)"""
+        # watchdog for the worker itself; the timeout of the solution is enforced inside the worker
+        watchdog = threading.Timer(timeout + CLOJURE_WORKER_STARTUP_SECONDS, self.close)
+        watchdog.start()
+        try:
+            data = code.encode("utf-8")
+            self.process.stdin.write(struct.pack(">i", len(data)) + data + struct.pack(">q", int(timeout * 1000)))
+            self.process.stdin.flush()
+            status, self.exiting, wall_nanos = struct.unpack(">i?q", self._read(13))
+            output = self._read(struct.unpack(">i", self._read(4))[0]).decode("utf-8", errors="replace")
+            message = self._read(struct.unpack(">i", self._read(4))[0]).decode("utf-8", errors="replace")
+        finally:
+            watchdog.cancel()
+        self.runs += 1
+        return status, wall_nanos / 1e9, output, message
+
+    def usable(self):
+        return not self.exiting and self.process.poll() is None and self.runs < CLOJURE_WORKER_RECYCLE
+
+    def close(self):
+        if self.process.poll() is None: self.process.kill()
+        self.process.wait()
+
+
+class ClojureWorkerPool:
+    """Idle clojure workers, one per concurrent execution"""
+    def __init__(self):
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def run(self, code, timeout):
+        with self.lock:
+            worker = self.idle.pop() if self.idle else None
+        # the worker runs the solution on a core of its own like run_limited, so the workers do not oversubscribe
+        with core_pool.core() as core:
+            if worker is None: worker = ClojureWorker()
+            pin_process(worker.process.pid, core)
+            try:
+                result = worker.run(code, timeout)
+            except (EOFError, OSError):
+                worker.close()
+                raise
+        if worker.usable():
+            with self.lock: self.idle.append(worker)
+        else:
+            worker.close()
+        return result
+
+clojure_worker_pool = ClojureWorkerPool()
+
+
+def set_clojure_worker(enabled):
+    """Evaluate clojure solutions in warm worker runtimes instead of one clj process per solution"""
+    global clojure_worker_enabled
+    clojure_worker_enabled = enabled
+
+
+def execute_clojure_code_in_worker(code, timeout=10, profile: dict = None):
+    global clojure_worker_enabled
+    try:
+        status, wall_seconds, output, _ = clojure_worker_pool.run(code, timeout)
+    except (EOFError, OSError) as exc:
+        if not isinstance(exc, EOFError):
+            print(f"Clojure worker not available, executing with clj processes: {exc}")
+            clojure_worker_enabled = False
+        return None
+    if profile is not None:
+        profile.update({"wall_seconds": round(wall_seconds, 4), "exit_status": 0 if status == CLOJURE_FINISHED else 1,
+                        "timed_out": status == CLOJURE_TIMED_OUT, "executor": "worker"})
+    if status == CLOJURE_TIMED_OUT:
+        return "Error: Clojure program execution timed"
+    return output.strip()
+
+
+def execute_clojure_code(code, timeout=10, profile: dict = None):
     code = re.sub(r"\(ns\s+[\w\.\-]+(?:\s+\(:[^\)]+\))*\s*\)", "", code, flags=re.MULTILINE)
 
     if re.search(r"\(defn\s+-main\s*\[", code):
@@ -82,11 +187,14 @@ def execute_clojure_code(code, timeout=10):
         exit_code, _, safety_error = validate_clojure_code_safety(code)
         if exit_code != 0:
             return f"Error: {safety_error}"
-        result = subprocess.run(
-            ["clj", "-M", "-e", code],
-            capture_output=True,
-            text=True,
+        if clojure_worker_enabled:
+            output = execute_clojure_code_in_worker(code, timeout, profile)
+            if output is not None: return output
+        result = run_limited(
+            ["clj", *("-J" + option for option in jvm_options()), "-M", "-e", code],
             timeout=timeout,
+            memory_mb=None, # the heap is limited with -Xmx
+            profile=profile,
         )
         return result.stdout.strip()
     except subprocess.TimeoutExpired:
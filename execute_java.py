@@ -1,8 +1,13 @@
 import os
 import re
 import shutil
+import struct
 import subprocess
 import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sandbox import core_pool, jvm_options, pin_process, run_limited
 
 
 JAVA_BLOCKED_PATTERNS = [
@@ -44,6 +49,9 @@ def syntax_check_java(code):
     if exit_code != 0:
         return exit_code, stdout, stderr
 
+    if java_worker_enabled:
+        output = syntax_check_java_in_worker(code)
+        if output is not None: return output
     temp_dir = tempfile.mkdtemp(prefix="opx_java_")
     try:
         class_name = extract_class_name(code)
@@ -63,32 +71,178 @@ def syntax_check_java(code):
         shutil.rmtree(temp_dir, ignore_errors=True)
 
 
-def execute_java_code(code, timeout=10):
+JAVA_WORKER_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "JavaWorker.java")
+JAVA_WORKER_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "cache", "java_worker")
+JAVA_WORKER_RECYCLE = 200       # solutions per worker, the loaded classes of finished solutions are not always collected
+JAVA_WORKER_COMPILE_SECONDS = 60 # allowance for the in-memory compilation on top of the timeout of a solution
+JAVA_FINISHED, JAVA_COMPILATION_FAILED, JAVA_TIMED_OUT, JAVA_EXCEPTION, JAVA_NO_MAIN = range(5)
+JAVA_CHECK_ONLY = -1 # timeout which makes the worker only compile a solution
+
+java_worker_enabled = False
+
+
+class JavaWorker:
+    """
+    A long-lived JVM running JavaWorker.java: it compiles the solutions in memory and runs each of them in a fresh
+    class loader, so JVM startup and JIT warm-up are paid once per worker instead of twice per solution.
+    The worker exits after a timeout or an Error of a solution, the pool then starts a new one.
+    """
+    compile_lock = threading.Lock()
+
+    def __init__(self):
+        JavaWorker.compile_worker()
+        self.process = subprocess.Popen(
+            ["java", *jvm_options(), "-cp", JAVA_WORKER_DIR, "JavaWorker"],
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, start_new_session=True)
+        self.runs = 0
+        self.exiting = False
+
+    @staticmethod
+    def compile_worker():
+        """Compile JavaWorker.java into cache/java_worker if the class is missing or older than the source"""
+        with JavaWorker.compile_lock:
+            class_path = os.path.join(JAVA_WORKER_DIR, "JavaWorker.class")
+            if os.path.exists(class_path) and os.path.getmtime(class_path) >= os.path.getmtime(JAVA_WORKER_SOURCE):
+                return
+            os.makedirs(JAVA_WORKER_DIR, exist_ok=True)
+            result = run_limited(["javac", "-J" + jvm_options()[0], "-d", JAVA_WORKER_DIR, JAVA_WORKER_SOURCE],
+                                 memory_mb=None, cpu_seconds=None)
+            if result.returncode != 0:
+                raise OSError(f"Could not compile {JAVA_WORKER_SOURCE}: {result.stderr.strip()}")
+
+    def _read(self, size):
+        data = self.process.stdout.read(size)
+        if len(data) != size: raise EOFError("Java worker ended unexpectedly")
+        return data
+
+    def run(self, class_name, code, timeout):
+        """Compile and run one solution; returns (status, cpu_seconds, wall_seconds, output, messages)"""
+        def write(data: bytes):
+            self.process.stdin.write(struct.pack(">i", len(data)) + data)
+        # watchdog for the worker itself; the timeout of the solution is enforced inside the worker
+        watchdog = threading.Timer(timeout + JAVA_WORKER_COMPILE_SECONDS, self.close)
+        watchdog.start()
+        try:
+            write(class_name.encode("utf-8"))
+            write(code.encode("utf-8"))
+            self.process.stdin.write(struct.pack(">q", int(timeout * 1000)))
+            self.process.stdin.flush()
+            status, self.exiting, cpu_nanos, wall_nanos = struct.unpack(">i?qq", self._read(21))
+            output = self._read(struct.unpack(">i", self._read(4))[0]).decode("utf-8", errors="replace")
+            messages = self._read(struct.unpack(">i", self._read(4))[0]).decode("utf-8", errors="replace")
+        finally:
+            watchdog.cancel()
+        self.runs += 1
+        return status, cpu_nanos / 1e9, wall_nanos / 1e9, output, messages
+
+    def usable(self):
+        return not self.exiting and self.process.poll() is None and self.runs < JAVA_WORKER_RECYCLE
+
+    def close(self):
+        if self.process.poll() is None: self.process.kill()
+        self.process.wait()
+
+
+class JavaWorkerPool:
+    """Idle java workers, one per concurrent execution"""
+    def __init__(self):
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def run(self, class_name, code, timeout):
+        with self.lock:
+            worker = self.idle.pop() if self.idle else None
+        # the worker runs the solution on a core of its own like run_limited, so the workers do not oversubscribe
+        with core_pool.core() as core:
+            if worker is None: worker = JavaWorker()
+            pin_process(worker.process.pid, core)
+            try:
+                result = worker.run(class_name, code, timeout)
+            except (EOFError, OSError):
+                worker.close()
+                raise
+        if worker.usable():
+            with self.lock: self.idle.append(worker)
+        else:
+            worker.close()
+        return result
+
+java_worker_pool = JavaWorkerPool()
+
+
+def set_java_worker(enabled):
+    """Run java solutions in long-lived worker JVMs instead of one javac and one java process per solution"""
+    global java_worker_enabled
+    java_worker_enabled = enabled
+
+
+def execute_java_code_in_worker(class_name, code, timeout=10, profile: dict = None):
+    global java_worker_enabled
+    try:
+        status, cpu_seconds, wall_seconds, output, messages = java_worker_pool.run(class_name, code, timeout)
+    except (EOFError, OSError) as exc:
+        if not isinstance(exc, EOFError):
+            # no jdk with javax.tools: use javac and java processes from now on
+            print(f"Java worker not available, executing with javac and java: {exc}")
+            java_worker_enabled = False
+        return None
+    if profile is not None:
+        profile.update({"wall_seconds": round(wall_seconds, 4), "cpu_seconds": round(cpu_seconds, 4),
+                        "exit_status": 0 if status == JAVA_FINISHED else 1, "timed_out": status == JAVA_TIMED_OUT,
+                        "executor": "worker"})
+    if status == JAVA_COMPILATION_FAILED:
+        print("Compilation Error:")
+        print(messages)
+        return "Error: Java compilation failed"
+    if status == JAVA_TIMED_OUT:
+        return "Error: Java program execution timed out"
+    return output.strip()
+
+
+def syntax_check_java_in_worker(code):
+    """Compile a solution in a java worker without running it; None if no worker is available"""
+    global java_worker_enabled
+    try:
+        class_name = extract_class_name(code)
+    except ValueError as exc:
+        return 1, "", str(exc)
+    try:
+        status, _, _, _, messages = java_worker_pool.run(class_name, code, JAVA_CHECK_ONLY)
+    except (EOFError, OSError) as exc:
+        if not isinstance(exc, EOFError):
+            print(f"Java worker not available, checking with javac: {exc}")
+            java_worker_enabled = False
+        return None
+    if status == JAVA_COMPILATION_FAILED:
+        return 1, "", (messages or "Java syntax check failed").strip()
+    return 0, "Syntax OK", ""
+
+
+def execute_java_code(code, timeout=10, profile: dict = None):
     temp_dir = tempfile.mkdtemp(prefix="temp_java_")
     try:
         exit_code, _, safety_error = validate_java_code_safety(code)
         if exit_code != 0:
             return f"Error: {safety_error}"
         class_name = extract_class_name(code)
+        if java_worker_enabled:
+            output = execute_java_code_in_worker(class_name, code, timeout, profile)
+            if output is not None: return output
         java_file_path = os.path.join(temp_dir, f"{class_name}.java")
         with open(java_file_path, "w", encoding="utf-8") as file:
             file.write(code)
 
-        compile_result = subprocess.run(
-            ["javac", java_file_path],
-            capture_output=True,
-            text=True,
-        )
+        compile_result = run_limited(["javac", "-J" + jvm_options()[0], java_file_path], memory_mb=None, cpu_seconds=None)
         if compile_result.returncode != 0:
             print("Compilation Error:")
             print(compile_result.stderr)
             return "Error: Java compilation failed"
 
-        execute_result = subprocess.run(
-            ["java", "-cp", temp_dir, class_name],
-            capture_output=True,
-            text=True,
+        execute_result = run_limited(
+            ["java", *jvm_options(), "-cp", temp_dir, class_name],
             timeout=timeout,
+            memory_mb=None, # the heap is limited with -Xmx
+            profile=profile,
         )
         return execute_result.stdout.strip()
     except subprocess.TimeoutExpired:
@@ -97,3 +251,95 @@ def execute_java_code(code, timeout=10):
         return f"Error: {str(exc)}"
     finally:
         shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+JAVA_BATCH_SHARD_SIZE = 50 # solutions per javac invocation of a batch; the shards are compiled in parallel
+JAVA_DIAGNOSTIC_PATTERN = re.compile(r"^(.*?\.java):(\d+): error: ")
+
+
+class JavaBatch:
+    """
+    Compile the java solutions of a run with few javac invocations instead of one per solution.
+    Every solution is written to a package directory of its own (the package statement is put in front of the
+    first line, so the line numbers of the diagnostics stay the same), the files are compiled in shards and the
+    diagnostics are mapped back to the solutions. Shards with errors are compiled again without the failed files,
+    because javac writes no classes at all if one file has errors. execute() then only starts the java process.
+    Solutions which are not safe, have no public class or declare a package are left to execute_java_code.
+    """
+    def __init__(self, codes, shard_size: int = JAVA_BATCH_SHARD_SIZE, workers: int = None):
+        self.build_dir = tempfile.mkdtemp(prefix="temp_java_batch_")
+        self.classes_dir = os.path.join(self.build_dir, "classes")
+        self.compiled = {} # code -> qualified class name
+        self.errors = {}   # code -> javac diagnostics
+        sources = {}       # source path -> (code, qualified class name)
+        for code in dict.fromkeys(codes):
+            if validate_java_code_safety(code)[0] != 0 or re.search(r"^\s*package\s", code, re.MULTILINE): continue
+            try:
+                class_name = extract_class_name(code)
+            except ValueError:
+                continue
+            package = f"p{len(sources):05d}"
+            package_dir = os.path.join(self.build_dir, "src", package)
+            os.makedirs(package_dir)
+            source_path = os.path.join(package_dir, f"{class_name}.java")
+            with open(source_path, "w", encoding="utf-8") as file:
+                file.write(f"package {package}; {code}")
+            sources[source_path] = (code, f"{package}.{class_name}")
+        if not sources: return
+
+        os.makedirs(self.classes_dir)
+        paths = list(sources)
+        shards = [paths[i:i + shard_size] for i in range(0, len(paths), shard_size)]
+        t0 = time.time()
+        with ThreadPoolExecutor(max_workers=workers or min(len(shards), os.cpu_count() or 1)) as executor:
+            failed = {}
+            for shard_failed in executor.map(self._compile_shard, shards): failed.update(shard_failed)
+        for source_path, (code, qualified_name) in sources.items():
+            if source_path in failed:
+                if failed[source_path] is not None: self.errors[code] = failed[source_path]
+            else:
+                self.compiled[code] = qualified_name
+        print(f"Compiled {len(self.compiled)} of {len(sources)} java solutions with {len(shards)} javac invocation(s) "
+              f"in {time.time() - t0:.1f} seconds")
+
+    def _compile_shard(self, paths):
+        """Compile a shard; returns the failed source paths with their diagnostics (None if the error is unknown)"""
+        failed = {}
+        while paths:
+            result = run_limited(["javac", "-J" + jvm_options()[0], "-encoding", "UTF-8", "-d", self.classes_dir, *paths],
+                                 memory_mb=None, cpu_seconds=None)
+            if result.returncode == 0: break
+            diagnostics = {}
+            current = None
+            for line in (result.stderr or result.stdout).splitlines():
+                match = JAVA_DIAGNOSTIC_PATTERN.match(line)
+                if match: current = match.group(1) if match.group(1) in paths else None
+                if current: diagnostics[current] = diagnostics.get(current, "") + line + "\n"
+            if not diagnostics:
+                # an error without a file, the solutions of this shard are compiled one by one by execute_java_code
+                failed.update({path: None for path in paths})
+                break
+            failed.update(diagnostics)
+            paths = [path for path in paths if path not in diagnostics]
+        return failed
+
+    def execute(self, code, timeout=10, profile: dict = None):
+        """Run a solution of the batch; returns None for code which is not part of the batch"""
+        if code in self.errors:
+            print("Compilation Error:")
+            print(self.errors[code])
+            return "Error: Java compilation failed"
+        if code not in self.compiled: return None
+        try:
+            execute_result = run_limited(
+                ["java", *jvm_options(), "-cp", self.classes_dir, self.compiled[code]],
+                timeout=timeout,
+                memory_mb=None, # the heap is limited with -Xmx
+                profile=profile,
+            )
+            return execute_result.stdout.strip()
+        except subprocess.TimeoutExpired:
+            return "Error: Java program execution timed out"
+
+    def close(self):
+        shutil.rmtree(self.build_dir, ignore_errors=True)
@@ -2,11 +2,16 @@ import ast
 import builtins
 import faulthandler
 import multiprocessing
+import os
+import pickle
 import signal
 import sys
+import threading
+import time
 import traceback
 from contextlib import redirect_stdout
 from io import StringIO
+from sandbox import MEMORY_LIMIT_MB, address_space_mb, apply_limits, core_pool, profile_from_rusage, peak_rss_self, rss_mb
 
 
 PYTHON_ALLOWED_MODULE_NAMES = [
@@ -88,13 +93,8 @@ def syntax_check_python(code, filename=""):
     return validate_python_code_safety(code)
 
 
-def execute_python_code_worker(code, output_queue):
-    faulthandler.enable(file=sys.stderr, all_threads=True)
-    if hasattr(signal, "SIGUSR1"):
-        faulthandler.register(signal.SIGUSR1, file=sys.stderr, all_threads=True)
-    if hasattr(signal, "SIGQUIT"):
-        faulthandler.register(signal.SIGQUIT, file=sys.stderr, all_threads=True)
-
+def restricted_globals_template():
+    """Globals for the solutions: the allowed builtins, a restricted __import__ and the pre-imported allowed modules"""
     allowed_builtins = {name: getattr(builtins, name) for name in PYTHON_ALLOWED_BUILTINS}
     allowed_builtins["setrecursionlimit"] = sys.setrecursionlimit
 
@@ -106,7 +106,7 @@ def execute_python_code_worker(code, output_queue):
         raise ImportError(f"Importing module '{name}' is not allowed.")
 
     allowed_builtins["__import__"] = safe_import
-    restricted_globals = {
+    return {
         "__builtins__": allowed_builtins,
         "__import__": safe_import,
         "__name__": "__main__",
@@ -115,6 +115,15 @@ def execute_python_code_worker(code, output_queue):
         **allowed_modules,
     }
 
+
+def execute_python_snippet(code, restricted_globals, core=None):
+    """Run one solution in a forked child of the sandbox template; returns the result dict"""
+    # after the imports, so only the solution counts against the limits; the forked child already has the
+    # address space of the template, the solution may use MEMORY_LIMIT_MB in addition
+    apply_limits(core, memory_mb=address_space_mb() + MEMORY_LIMIT_MB)
+    # the fork starts with the resident size of the template, which depends on the script which started it;
+    # so the peak rss of a solution is the growth over that start
+    start_rss = peak_rss_self()
     capture = StringIO()
     try:
         with redirect_stdout(capture):
@@ -123,29 +132,141 @@ def execute_python_code_worker(code, output_queue):
     except Exception as exc:
         error_trace = traceback.format_exc()
         output = f"Error executing code: {exc}\nTraceback:\n{error_trace}"
-    output_queue.put({"output": output})
+    return {"output": output, "peak_rss_growth": peak_rss_self() - start_rss}
+
+
+def python_sandbox_template(connection):
+    """
+    Main loop of a sandbox template process. The template imports the allowed modules and builds the restricted
+    globals once; every solution runs in a fresh fork of the template, so no state is shared between solutions.
+    Protocol: receives (code, core), sends ("started", pid) after the fork and then a dict with result, exit_status
+    and rusage when the child ended. The parent kills the child on timeout, the template reaps it in any case.
+    """
+    faulthandler.enable(file=sys.stderr, all_threads=True)
+    if hasattr(signal, "SIGUSR1"):
+        faulthandler.register(signal.SIGUSR1, file=sys.stderr, all_threads=True)
+    if hasattr(signal, "SIGQUIT"):
+        faulthandler.register(signal.SIGQUIT, file=sys.stderr, all_threads=True)
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # ctrl-c is handled by the parent
+    restricted_globals = restricted_globals_template()
 
+    while True:
+        try:
+            request = connection.recv()
+        except EOFError:
+            return
+        if request is None: return
+        code, core = request
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(read_fd)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            try:
+                data = pickle.dumps(execute_python_snippet(code, restricted_globals, core))
+                with os.fdopen(write_fd, "wb") as result_file:
+                    result_file.write(data)
+            finally:
+                os._exit(0)
+        os.close(write_fd)
+        connection.send(("started", pid))
+        with os.fdopen(read_fd, "rb") as result_file:
+            data = result_file.read() # read before wait4, a large output would block the child in the pipe
+        _, status, rusage = os.wait4(pid, 0)
+        try:
+            result = pickle.loads(data) if data else None
+        except Exception:
+            result = None
+        connection.send({"result": result, "exit_status": os.waitstatus_to_exitcode(status), "rusage": rusage})
 
-def execute_python_code(code, timeout=10):
+
+class PythonSandboxPool:
+    """
+    Warm template processes for execute_python_code, one per concurrent execution. The templates are started with
+    spawn, so they are small fresh interpreters which do not share the memory of the calling process. A template
+    only forks, it never runs a solution itself, so it can be reused for any number of solutions.
+    """
+    def __init__(self):
+        self.idle = []
+        self.lock = threading.Lock()
+        self.context = multiprocessing.get_context("spawn")
+
+    def _checkout(self):
+        with self.lock:
+            if self.idle: return self.idle.pop()
+        parent_connection, child_connection = self.context.Pipe()
+        process = self.context.Process(target=python_sandbox_template, args=(child_connection,), daemon=True)
+        process.start()
+        child_connection.close()
+        return process, parent_connection
+
+    def _checkin(self, template):
+        with self.lock:
+            self.idle.append(template)
+
+    def _discard(self, template):
+        process, connection = template
+        connection.close()
+        process.kill()
+        process.join()
+
+    def run(self, code, timeout, core=None):
+        """Run a solution; returns (reply of the template or None if the template failed, timed_out)"""
+        template = self._checkout()
+        _, connection = template
+        try:
+            t0 = time.time() # after the checkout, the start of a new template does not count for the solution
+            connection.send((code, core))
+            _, pid = connection.recv()
+            timed_out = not connection.poll(timeout)
+            if timed_out:
+                try:
+                    os.kill(pid, signal.SIGKILL)
+                except OSError:
+                    pass
+            reply = connection.recv()
+            reply["wall_seconds"] = time.time() - t0
+        except (EOFError, OSError):
+            self._discard(template)
+            return None, False
+        self._checkin(template)
+        return reply, timed_out
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for process, connection in idle:
+            try:
+                connection.send(None)
+            except OSError:
+                pass
+            connection.close()
+            process.join(timeout=1)
+
+python_sandbox_pool = PythonSandboxPool()
+
+
+def execute_python_code(code, timeout=10, profile: dict = None):
     exit_code, _, safety_error = syntax_check_python(code)
     if exit_code != 0:
         return f"Error: {safety_error}"
-    output_queue = multiprocessing.Queue()
-    process = multiprocessing.Process(target=execute_python_code_worker, args=(code, output_queue))
-    process.start()
-    process.join(timeout)
-
-    if process.is_alive():
-        process.terminate()
-        process.join()
+    with core_pool.core() as core:
+        reply, timed_out = python_sandbox_pool.run(code, timeout, core)
+    if reply is None:
+        return "Error: No output received from the executed code."
+    if profile is not None:
+        profile.update(profile_from_rusage(reply["rusage"], reply["wall_seconds"], reply["exit_status"]))
+        growth = (reply["result"] or {}).get("peak_rss_growth")
+        profile["peak_rss_mb"] = rss_mb(growth) if growth is not None else None
+        profile["timed_out"] = timed_out
+    if timed_out:
         return "Error: Code execution timed out."
 
-    try:
-        result = output_queue.get_nowait()
-        if "output" in result:
-            return result["output"]
-        if "error" in result:
-            return result["error"]
-        return "Error: Unknown issue occurred during code execution."
-    except multiprocessing.queues.Empty:
+    result = reply["result"]
+    if result is None:
         return "Error: No output received from the executed code."
+    if "output" in result:
+        return result["output"]
+    if "error" in result:
+        return result["error"]
+    return "Error: Unknown issue occurred during code execution."
@@ -1,8 +1,11 @@
+import hashlib
 import os
 import re
 import shutil
 import subprocess
 import tempfile
+import threading
+from sandbox import run_limited
 
 
 RUST_BLOCKED_PATTERNS = [
@@ -29,22 +32,118 @@ def validate_rust_code_safety(code):
     return 0, "Safety OK", ""
 
 
+RUST_CACHE_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "cache", "rust")
+RUST_CACHE_MAX_MB = 1024
+RUST_OPT_LEVEL = "2" # rustc -C opt-level; debug builds (0) make compute-heavy solutions time out
+# an error of the program with a source span; linker errors, resource limits and killed compilers have none
+RUST_DIAGNOSTIC_PATTERN = re.compile(r"^error(\[E\d+\])?: .*\n\s*--> ", re.MULTILINE)
+
+
+class RustBuildCache:
+    """
+    Compiled rust binaries in cache/rust, keyed by the hash of the source, the rustc version and the opt-level,
+    so every distinct program is compiled once, also across models and runs. Compilation errors are cached as well
+    if they are diagnostics of the program; failures of the environment are compiled again next time.
+    Compilations run in their own stage with at most compile_workers rustc processes at the same time, the
+    executions are limited by the cpu cores of the sandbox. Least recently used binaries are removed above max_mb.
+    """
+    def __init__(self, cache_dir=RUST_CACHE_DIR, opt_level=RUST_OPT_LEVEL, compile_workers=None, max_mb=RUST_CACHE_MAX_MB):
+        self.cache_dir = cache_dir
+        self.opt_level = opt_level
+        self.max_bytes = max_mb << 20
+        self.compile_slots = threading.BoundedSemaphore(compile_workers or max(1, (os.cpu_count() or 1) // 2))
+        self.lock = threading.Lock()
+        self.key_locks = {}
+        self.version = None
+        self.stores = 0
+
+    def rustc_version(self):
+        if self.version is None:
+            result = subprocess.run(["rustc", "--version", "--verbose"], capture_output=True, text=True)
+            self.version = result.stdout.strip()
+        return self.version
+
+    def key(self, code):
+        return hashlib.sha256(f"{self.rustc_version()}\nopt-level={self.opt_level}\n{code}".encode("utf-8")).hexdigest()
+
+    def compile(self, code):
+        """Return (binary path, None) or (None, rustc errors); compiles only if the program is not in the cache"""
+        key = self.key(code)
+        binary_path = os.path.join(self.cache_dir, key)
+        error_path = binary_path + ".err"
+        with self.lock:
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock: # the same program is compiled once if several models wrote it
+            for path in (binary_path, error_path):
+                if os.path.exists(path):
+                    os.utime(path) # most recently used
+                    if path == binary_path: return binary_path, None
+                    with open(error_path, "r", encoding="utf-8") as file:
+                        return None, file.read()
+
+            os.makedirs(self.cache_dir, exist_ok=True)
+            temp_dir = tempfile.mkdtemp(prefix="temp_rust_")
+            try:
+                rust_file_path = os.path.join(temp_dir, "rust.rs")
+                with open(rust_file_path, "w", encoding="utf-8") as file:
+                    file.write(code)
+                temp_binary_path = os.path.join(temp_dir, "rust")
+                with self.compile_slots:
+                    compile_result = run_limited(
+                        ["rustc", "-A", "warnings", "-C", f"opt-level={self.opt_level}", rust_file_path, "-o", temp_binary_path],
+                        memory_mb=None, cpu_seconds=None)
+                if compile_result.returncode != 0:
+                    if compile_result.returncode > 0 and RUST_DIAGNOSTIC_PATTERN.search(compile_result.stderr):
+                        with open(error_path, "w", encoding="utf-8") as file:
+                            file.write(compile_result.stderr)
+                    return None, compile_result.stderr
+                os.replace(temp_binary_path, binary_path)
+            finally:
+                shutil.rmtree(temp_dir, ignore_errors=True)
+        self._stored()
+        return binary_path, None
+
+    def _stored(self):
+        """remove the least recently used files from time to time if the cache is above its size limit"""
+        with self.lock:
+            self.stores += 1
+            if self.stores % 32 != 0: return
+            try:
+                entries = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir)]
+                entries = sorted(((os.stat(path), path) for path in entries), key=lambda entry: entry[0].st_mtime)
+            except OSError:
+                return
+            total = sum(stat.st_size for stat, _ in entries)
+            for stat, path in entries:
+                if total <= self.max_bytes: break
+                try:
+                    os.remove(path)
+                    total -= stat.st_size
+                except OSError:
+                    pass
+
+rust_build_cache = RustBuildCache()
+
+
+def set_rust_build(opt_level=None, compile_workers=None):
+    """Set the rustc opt-level and the number of parallel rustc processes"""
+    if opt_level is not None: rust_build_cache.opt_level = str(opt_level)
+    if compile_workers: rust_build_cache.compile_slots = threading.BoundedSemaphore(compile_workers)
+
+
 def syntax_check_rust(code):
     exit_code, stdout, stderr = validate_rust_code_safety(code)
     if exit_code != 0:
         return exit_code, stdout, stderr
 
+    # only the metadata, a full optimized build is left to the execution which takes it from the build cache
     temp_dir = tempfile.mkdtemp(prefix="opx_rust_")
     try:
         source_path = os.path.join(temp_dir, "main.rs")
         output_path = os.path.join(temp_dir, "main")
         with open(source_path, "w", encoding="utf-8") as handle:
             handle.write(code)
-        result = subprocess.run(
-            ["rustc", "--emit", "metadata", "-o", output_path, source_path],
-            capture_output=True,
-            text=True,
-        )
+        result = run_limited(["rustc", "--emit", "metadata", "-o", output_path, source_path], memory_mb=None, cpu_seconds=None)
         if result.returncode == 0:
             return 0, "Syntax OK", ""
         stderr = (result.stderr or result.stdout or "Rust syntax check failed").strip()
@@ -55,41 +154,16 @@ def syntax_check_rust(code):
         shutil.rmtree(temp_dir, ignore_errors=True)
 
 
-def execute_rust_code(code, timeout=10):
-    temp_dir = tempfile.mkdtemp(prefix="temp_rust_")
+def execute_rust_code(code, timeout=10, profile: dict = None):
+    exit_code, _, safety_error = validate_rust_code_safety(code)
+    if exit_code != 0:
+        return f"Error: {safety_error}"
+    binary_path, errors = rust_build_cache.compile(code)
+    if binary_path is None:
+        return f"Error: Rust compilation failed: {errors}"
+
     try:
-        exit_code, _, safety_error = validate_rust_code_safety(code)
-        if exit_code != 0:
-            return f"Error: {safety_error}"
-        rust_file_path = os.path.join(temp_dir, "rust.rs")
-        with open(rust_file_path, "w", encoding="utf-8") as file:
-            file.write(code)
-
-        binary_path = os.path.join(temp_dir, "rust")
-        compile_result = subprocess.run(
-            ["rustc", "-A", "warnings", rust_file_path, "-o", binary_path],
-            capture_output=True,
-            text=True,
-        )
-        if compile_result.returncode != 0:
-            return f"Error: Rust compilation failed: {compile_result.stderr}"
-
-        try:
-            exec_result = subprocess.run(
-                [binary_path],
-                capture_output=True,
-                text=True,
-                timeout=timeout,
-            )
-            output = exec_result.stdout.strip()
-        except subprocess.TimeoutExpired:
-            output = "Error: Rust program execution timed out"
-        finally:
-            if os.path.exists(binary_path):
-                os.remove(binary_path)
-
-        return output
+        exec_result = run_limited([binary_path], timeout=timeout, profile=profile)
+        return exec_result.stdout.strip()
     except subprocess.TimeoutExpired:
-        return "Error: Rust program execution timed"
-    finally:
-        shutil.rmtree(temp_dir, ignore_errors=True)
+        return "Error: Rust program execution timed out"
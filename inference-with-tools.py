@@ -26,14 +26,20 @@ from benchmark import read_benchmark, write_benchmark, sort_benchmark
 from execute import execute_solution
 from llm_client import (
     Endpoint,
-    ensure_model_available,
+    api_stub_endpoint,
+    get_connect_seconds,
+    get_session,
+    iter_sse_events,
     ollama_pull,
     openai_api_check_exist,
     openai_api_list,
+    reset_connect_timer,
+    set_session_pool_size,
+    warm_up_endpoint,
 )
 from llm_model_test import complete_model_capabilities
 from execute_clojure import syntax_check_clojure
-from execute_java import syntax_check_java
+from execute_java import set_java_worker, syntax_check_java
 from execute_python import syntax_check_python
 from execute_rust import syntax_check_rust
 
@@ -324,6 +330,12 @@ def get_api_tools(tools: List[dict]) -> List[dict]:
     return [_sanitize_tool_schema(tool) for tool in tools]
 
 
+# In prefix cache mode every request carries this same tool block, so the system prompt and the tools form a
+# byte-identical prefix which server-side prompt caches can reuse. Exhausted tools are rejected by handle_tool_call.
+PREFIX_CACHE_API_TOOLS = get_api_tools(TOOLS)
+PREFIX_CACHE_COMPACT_INTERVAL = 16 # messages between two compactions when the prefix cache is used
+
+
 @dataclass
 class State:
     max_tool_calls: int = MAX_TOOL_CALLS
@@ -772,6 +784,7 @@ def _extract_delta_text(delta_value) -> str:
 
 def consume_streaming_tool_response(response, problem_number: str, turn: int) -> dict:
     usage = {}
+    timings = {}
     content_parts: List[str] = []
     reasoning_parts: List[str] = []
     tool_calls_by_index: Dict[int, dict] = {}
@@ -803,12 +816,8 @@ def consume_streaming_tool_response(response, problem_number: str, turn: int) ->
             sys.stdout.flush()
             current_stream_kind = ""
 
-    for raw_line in response.iter_lines(decode_unicode=True):
-        if not raw_line:
-            continue
-        if not raw_line.startswith("data: "):
-            continue
-        payload_line = raw_line[len("data: "):].strip()
+    for payload_line in iter_sse_events(response.iter_content(chunk_size=None)):
+        payload_line = payload_line.strip()
         if payload_line == "[DONE]":
             close_stream_prefix()
             break
@@ -822,6 +831,9 @@ def consume_streaming_tool_response(response, problem_number: str, turn: int) ->
         event_usage = event.get("usage")
         if isinstance(event_usage, dict):
             usage = event_usage
+        event_timings = event.get("timings")
+        if isinstance(event_timings, dict):
+            timings = event_timings
 
         choices = event.get("choices", [])
         if not choices:
@@ -909,6 +921,7 @@ def consume_streaming_tool_response(response, problem_number: str, turn: int) ->
     return {
         "choices": [{"message": message}],
         "usage": usage,
+        "timings": timings,
     }
 
 
@@ -1230,6 +1243,97 @@ def build_user_message(prompt: str, base64_image: str = None) -> dict:
     }
 
 
+def _compacted_path(parsed_args: dict, key: str = "path") -> str:
+    try:
+        return normalize_virtual_path(parsed_args.get(key, ""))
+    except (ValueError, AttributeError):
+        return ""
+
+
+def compact_messages(messages: List[dict]) -> int:
+    """Replace superseded file contents and stale tool outputs in the conversation with short stubs.
+    The latest write_file/read_file of every existing file, the latest syntax_check of every file, the latest
+    list_files and the latest update_plan stay complete, so the model still sees the current workspace and plan.
+    Stubbing is deterministic, so a stub stays byte-identical in later turns; but every new stub changes an earlier
+    message, so a server-side prefix cache is only valid up to that message. Returns the saved bytes."""
+    calls = []  # (tool call, tool message, tool name, arguments, result) of every successful tool call
+    for index, assistant in enumerate(messages):
+        if assistant.get("role") != "assistant" or not assistant.get("tool_calls"):
+            continue
+        tools = []
+        for tool in messages[index + 1:]:
+            if tool.get("role") != "tool": break
+            tools.append(tool)
+        tools_by_id = {tool.get("tool_call_id"): tool for tool in tools}
+        for position, tool_call in enumerate(assistant["tool_calls"]):
+            tool = tools_by_id.get(tool_call.get("id")) or (tools[position] if position < len(tools) else None)
+            if tool is None: continue
+            function = tool_call.get("function", {})
+            try:
+                parsed_args = json.loads(function.get("arguments") or "{}")
+                result = json.loads(tool.get("content") or "{}")
+            except json.JSONDecodeError:
+                continue
+            if isinstance(parsed_args, dict) and isinstance(result, dict) and result.get("exit_code") == 0:
+                calls.append((tool_call, tool, function.get("name"), parsed_args, result))
+
+    stale = set()
+    latest_content: Dict[str, int] = {}  # path -> call which carries the current file content
+    latest_check: Dict[str, int] = {}    # path -> latest syntax_check of the file
+    latest_call: Dict[str, int] = {}     # tool name -> latest list_files / update_plan
+    for index, (_, _, tool_name, parsed_args, _) in enumerate(calls):
+        path = _compacted_path(parsed_args)
+        if tool_name in ("write_file", "read_file"):
+            if path in latest_content: stale.add(latest_content[path])
+            latest_content[path] = index
+            if tool_name == "write_file" and path in latest_check: stale.add(latest_check.pop(path))
+        elif tool_name == "delete_file":
+            if path in latest_content: stale.add(latest_content.pop(path))
+            if path in latest_check: stale.add(latest_check.pop(path))
+        elif tool_name == "rename_file":
+            source_path = _compacted_path(parsed_args, "source_path")
+            destination_path = _compacted_path(parsed_args, "destination_path")
+            if source_path == destination_path: continue
+            # an existing destination is overwritten
+            if destination_path in latest_content: stale.add(latest_content.pop(destination_path))
+            if destination_path in latest_check: stale.add(latest_check.pop(destination_path))
+            if source_path in latest_check: stale.add(latest_check.pop(source_path))
+            if source_path in latest_content: latest_content[destination_path] = latest_content.pop(source_path)
+        elif tool_name == "syntax_check":
+            if path in latest_check: stale.add(latest_check[path])
+            latest_check[path] = index
+        elif tool_name in ("list_files", "update_plan"):
+            if tool_name in latest_call: stale.add(latest_call[tool_name])
+            latest_call[tool_name] = index
+
+    saved = 0
+    for index in stale:
+        tool_call, tool, tool_name, parsed_args, result = calls[index]
+        path = _compacted_path(parsed_args)
+        stub = f"[compacted: superseded by a later {tool_name} call]"
+        if tool_name == "write_file":
+            stub = f"[compacted: superseded content of {path}, use read_file for the current version]"
+            compacted_args = json.dumps({"path": parsed_args.get("path", ""), "content": stub})
+            function = tool_call["function"]
+            if function["arguments"] != compacted_args:
+                saved += byte_size(function["arguments"]) - byte_size(compacted_args)
+                function["arguments"] = compacted_args
+            continue
+        if tool_name == "read_file":
+            stub = f"[compacted: superseded content of {path}, use read_file for the current version]"
+        elif tool_name == "update_plan":
+            compacted_args = json.dumps({"plan": [], "explanation": stub})
+            function = tool_call["function"]
+            if function["arguments"] != compacted_args:
+                saved += byte_size(function["arguments"]) - byte_size(compacted_args)
+                function["arguments"] = compacted_args
+        compacted_result = json.dumps({"tool": result.get("tool", tool_name), "exit_code": 0, "stdout": stub, "stderr": ""})
+        if tool["content"] != compacted_result:
+            saved += byte_size(tool["content"]) - byte_size(compacted_result)
+            tool["content"] = compacted_result
+    return saved
+
+
 def validate_tool_agent_contract(
     endpoint: Endpoint,
     think: bool = False,
@@ -1261,7 +1365,7 @@ def validate_tool_agent_contract(
         f"with {len(payload['tools'])} tools."
     )
     t0 = time.monotonic()
-    response = requests.post(
+    response = get_session(endpoint.url).post(
         endpoint.url,
         headers=headers,
         json=payload,
@@ -1290,6 +1394,8 @@ def run_tool_agent(
     think: bool = False,
     no_think: bool = False,
     stream: bool = False,
+    prefix_cache: bool = False,
+    compact: bool = True,
 ) -> str:
     state = State()
     messages = [
@@ -1303,14 +1409,28 @@ def run_tool_agent(
         headers["Authorization"] = f"Bearer {endpoint.key}"
     delivered = DeliveryResult(delivered=False)
 
+    prompt_stats = {"turns": 0, "prompt_tokens": 0, "cached_tokens": 0, "prefill_ms": 0.0}
+
+    compacted_length = len(messages)
     for turn in range(MAX_TOOL_CALLS * 4):
+        # with the prefix cache, the context is compacted in steps only, so the prefix stays stable in between
+        if compact and (not prefix_cache or len(messages) - compacted_length >= PREFIX_CACHE_COMPACT_INTERVAL):
+            compacted_length = len(messages)
+            saved_bytes = compact_messages(messages)
+            if saved_bytes > 0:
+                log(
+                    f"[{problem_number}] Turn {turn + 1}: compacted context by {saved_bytes} bytes, "
+                    f"{sum(byte_size(json.dumps(message)) for message in messages)} bytes left"
+                )
         payload = {
             "model": endpoint.model_name,
             "messages": messages,
-            "tools": get_api_tools(get_visible_tools(state)),
+            "tools": PREFIX_CACHE_API_TOOLS if prefix_cache else get_api_tools(get_visible_tools(state)),
             "stream": stream,
             "temperature": 0.0,
         }
+        if prefix_cache and not endpoint.key:
+            payload["cache_prompt"] = True # llama.cpp keeps the kv cache of the common prefix; hosted apis reject unknown fields
         if no_think:
             payload["enable_thinking"] = False
         elif think:
@@ -1321,7 +1441,8 @@ def run_tool_agent(
             f"[{problem_number}] Turn {turn + 1}: waiting for model response from "
             f"{endpoint.model_name} with {len(payload['tools'])} tools."
         )
-        response = requests.post(
+        reset_connect_timer()
+        response = get_session(url).post(
             url,
             headers=headers,
             json=payload,
@@ -1329,6 +1450,8 @@ def run_tool_agent(
             stream=stream,
             timeout=(60, 600),
         )
+        connect_seconds = get_connect_seconds()
+        ttfb_seconds = max(0.0, response.elapsed.total_seconds() - connect_seconds)
         raise_for_status_with_body(
             response,
             f"[{problem_number}] Turn {turn + 1} request failed",
@@ -1337,9 +1460,17 @@ def run_tool_agent(
             response_json = consume_streaming_tool_response(response, problem_number, turn + 1)
         else:
             response_json = response.json()
+        prompt_tokens, cached_tokens, prefill_ms = extract_prompt_cache_stats(response_json)
+        prompt_stats["turns"] += 1
+        prompt_stats["prompt_tokens"] += prompt_tokens or 0
+        prompt_stats["cached_tokens"] += cached_tokens or 0
+        prompt_stats["prefill_ms"] += prefill_ms or 0.0
+        cache_text = f", cached_tokens {cached_tokens}" if cached_tokens is not None else ""
+        prefill_text = f", prefill {prefill_ms / 1000.0:.2f}s" if prefill_ms is not None else ""
         log(
             f"[{problem_number}] Turn {turn + 1}: model response received in "
-            f"{time.monotonic() - request_t0:.2f}s; {summarize_response(response_json)}"
+            f"{time.monotonic() - request_t0:.2f}s (connect {connect_seconds:.3f}s, ttfb {ttfb_seconds:.2f}s"
+            f"{cache_text}{prefill_text}); {summarize_response(response_json)}"
         )
 
         chunk, tool_name, tool_id, tool_args_unescaped = extract_response_fields(response_json)
@@ -1371,11 +1502,39 @@ def run_tool_agent(
             delivered = delivery
             break
 
+    log_prompt_stats(problem_number, prompt_stats)
     if not delivered.delivered:
         raise RuntimeError("Task is not complete until deliver_code is called.")
     return delivered.content
 
 
+def extract_prompt_cache_stats(response_json: dict) -> Tuple[int, int, float]:
+    """Prompt tokens, prompt tokens served from the server's prefix cache and prefill milliseconds of a response.
+    OpenAI and vLLM report usage.prompt_tokens_details.cached_tokens, llama.cpp reports timings.cache_n and
+    timings.prompt_ms; values the server does not report are None."""
+    usage = response_json.get("usage") if isinstance(response_json.get("usage"), dict) else {}
+    timings = response_json.get("timings") if isinstance(response_json.get("timings"), dict) else {}
+    prompt_tokens = usage.get("prompt_tokens")
+    details = usage.get("prompt_tokens_details") if isinstance(usage.get("prompt_tokens_details"), dict) else {}
+    cached_tokens = details.get("cached_tokens", usage.get("cached_tokens", timings.get("cache_n")))
+    prefill_ms = timings.get("prompt_ms")
+    return (
+        prompt_tokens if isinstance(prompt_tokens, int) else None,
+        cached_tokens if isinstance(cached_tokens, int) else None,
+        float(prefill_ms) if isinstance(prefill_ms, (int, float)) else None,
+    )
+
+
+def log_prompt_stats(problem_number: str, prompt_stats: dict) -> None:
+    prompt_tokens = prompt_stats["prompt_tokens"]
+    cached_tokens = prompt_stats["cached_tokens"]
+    cached_share = 100.0 * cached_tokens / prompt_tokens if prompt_tokens else 0.0
+    log(
+        f"[{problem_number}] Prompt tokens over {prompt_stats['turns']} turns: {prompt_tokens}, "
+        f"cached {cached_tokens} ({cached_share:.1f}%), prefill {prompt_stats['prefill_ms'] / 1000.0:.2f}s"
+    )
+
+
 def process_single_problem(
     endpoint: Endpoint,
     store_name: str,
@@ -1393,6 +1552,8 @@ def process_single_problem(
     think: bool = False,
     no_think: bool = False,
     stream: bool = False,
+    prefix_cache: bool = False,
+    compact: bool = True,
 ) -> Tuple[str, str, bool]:
     t0 = time.monotonic()
     previous_endpoint = getattr(LOG_CONTEXT, "endpoint", "")
@@ -1410,6 +1571,8 @@ def process_single_problem(
             think=think,
             no_think=no_think,
             stream=stream,
+            prefix_cache=prefix_cache,
+            compact=compact,
         )
         with open(output_path, "w", encoding="utf-8") as file:
             file.write(code)
@@ -1483,14 +1646,14 @@ def evaluate_existing_solution(
 
 
 def prepare_endpoints(endpoints: List[Endpoint]) -> List[Endpoint]:
+    # pull and load the model on all endpoints in parallel
+    with ThreadPoolExecutor(max_workers=max(1, len(endpoints))) as executor:
+        ready = list(executor.map(lambda endpoint: warm_up_endpoint(endpoint, attempts=3), endpoints))
     available_endpoints = []
-    for endpoint in endpoints:
-        try:
-            if ensure_model_available(endpoint, attempts=3, fail_if_unavailable=False):
-                available_endpoints.append(endpoint)
-        except Exception as e:
-            log(f"Error loading endpoint {endpoint}: {e}")
-        if endpoint not in available_endpoints:
+    for endpoint, endpoint_ready in zip(endpoints, ready):
+        if endpoint_ready:
+            available_endpoints.append(endpoint)
+        else:
             log(f"Failed to load endpoint {endpoint} after 3 attempts.")
     return available_endpoints
 
@@ -1548,6 +1711,8 @@ def process_problem_files(
     think=False,
     no_think=False,
     stream=False,
+    prefix_cache=False,
+    compact=True,
 ):
     log(f"Processing problems in {problems_dir} with language {language} and endpoint: {endpoints[0]}")
     store_name = endpoints[0].store_name
@@ -1560,8 +1725,6 @@ def process_problem_files(
     solutions_json_path = os.path.join(solutions_dir, "solutions.json")
     extension = get_extension(language)
 
-    ensure_model_available(endpoints[0], attempts=3, fail_if_unavailable=True)
-
     available_endpoints = prepare_endpoints(endpoints)
     if not available_endpoints:
         raise Exception("No usable endpoints are available.")
@@ -1642,7 +1805,9 @@ def process_problem_files(
         log("No problems queued.")
         return
 
-    max_workers = len(available_endpoints)
+    # every endpoint gets as many workers as it has request slots; round-robin over the slots
+    endpoint_slots = [endpoint for endpoint in available_endpoints for _ in range(max(1, endpoint.max_concurrency))]
+    max_workers = len(endpoint_slots)
     if max_workers == 1:
         log("Using serial execution because only one endpoint is available.")
 
@@ -1704,6 +1869,8 @@ def process_problem_files(
                     think,
                     no_think,
                     stream,
+                    prefix_cache,
+                    compact,
                 )
                 future_to_problem[future] = (problem_number, endpoint.store_name, expected)
                 log(f"[{problem_number}] Queued generation on {endpoint.store_name}")
@@ -1744,7 +1911,7 @@ def process_problem_files(
                 future_to_problem[future] = (problem_number, store_name, expected)
                 log(f"[{problem_number}] Queued existing tool solution for evaluation on {store_name}")
             for index, (problem_number, prompt, output_path, base64_image, expected) in enumerate(problem_jobs):
-                endpoint = available_endpoints[index % len(available_endpoints)]
+                endpoint = endpoint_slots[index % len(endpoint_slots)]
                 future = executor.submit(
                     process_single_problem,
                     endpoint,
@@ -1763,6 +1930,8 @@ def process_problem_files(
                     think,
                     no_think,
                     stream,
+                    prefix_cache,
+                    compact,
                 )
                 future_to_problem[future] = (problem_number, endpoint.store_name, expected)
                 log(f"[{problem_number}] Queued generation on {endpoint.store_name}")
@@ -1792,7 +1961,7 @@ def process_problem_files(
 
 def main():
     parser = ArgumentParser(description="Process Euler problems and send them to an LLM.")
-    parser.add_argument("--api", action="append", help="Specify (multiple) backend OpenAI API endpoints (i.e. ollama); can be used multiple times")
+    parser.add_argument("--api", action="append", help="Specify (multiple) backend OpenAI API endpoints (i.e. ollama); can be used multiple times. Append @<n> (i.e. http://host:8000@8) to send up to n requests in parallel to that server")
     parser.add_argument("--api_base", required=False, default="http://localhost:11434", help="API base URL for the LLM or a list of such urls (comma-separated), default is http://localhost:11434")
     parser.add_argument("--endpoint", required=False, default="", help="Name of an <endpoint>.json file in the endpoints directory")
     parser.add_argument("--allmodels", action="store_true", help="loop over all models provided by ollama and run those which are missing in benchmark.json")
@@ -1803,6 +1972,10 @@ def main():
     parser.add_argument("--language", required=False, default="python,java,rust,clojure", help="Name of the languages to test, default is python,java,rust,clojure")
     parser.add_argument("--overwrite_existing", action="store_true", help="if set, re-calculate all problems that already have an answer")
     parser.add_argument("--overwrite_failed", action="store_true", help="if set, re-calculate those problems with wrong answers")
+    parser.add_argument("--prefix_cache", action="store_true", help=f"send the same system prompt and full tool block on every turn (and cache_prompt to local servers) so server-side prefix caches can reuse the prompt; the context is then compacted only every {PREFIX_CACHE_COMPACT_INTERVAL} messages, because a compaction rewrites earlier messages and invalidates the cached prefix from there")
+    parser.add_argument("--no_compact", action="store_true", help="keep superseded file contents and stale tool outputs in the conversation instead of replacing them with short stubs; compaction shortens the prompt but invalidates a server-side prefix cache from the first rewritten message")
+    parser.add_argument("--java_worker", action="store_true", help="check the syntax of java files in long-lived worker JVMs instead of one javac process per syntax_check")
+    parser.add_argument("--pool_size", type=int, default=64, help="number of keep-alive HTTP connections per server, default is 64")
     parser.add_argument("--n100", action="store_true", help="problems 1 to 100")
     parser.add_argument("--n200", action="store_true", help="problems 1 to 200")
     parser.add_argument("--n300", action="store_true", help="problems 201 to 300")
@@ -1810,6 +1983,8 @@ def main():
     parser.add_argument("--nall", action="store_true", help="all problems")
 
     args = parser.parse_args()
+    set_session_pool_size(args.pool_size)
+    set_java_worker(args.java_worker)
     api_base = args.api if args.api else args.api_base.split(",") if "," in args.api_base else [args.api_base]
     store_name = args.model
     max_problem_number, problem_start, problem_end = get_tooling_batch_bounds(args)
@@ -1836,7 +2011,7 @@ def main():
             if endpoint_name:
                 raise Exception("The --allmodels option cannot be used in combination with --endpoint.")
 
-            local_endpoint = Endpoint(store_name=store_name, model_name=store_name, key="", url=f"{api_base[0]}/v1/chat/completions")
+            local_endpoint = api_stub_endpoint(store_name, store_name, api_base[0])
             models = openai_api_list(local_endpoint)
             log(f"Found {len(models)} models in ollama.")
             for model in models:
@@ -1844,10 +2019,7 @@ def main():
                 tooling_bench_name = get_tooling_series_name(language, max_problem_number)
                 if model not in benchmark or tooling_bench_name not in benchmark[model]:
                     log(f"Inference with tools: Using model {model} and language {language}")
-                    endpoints = [
-                        Endpoint(store_name=model, model_name=model, key="", url=f"{api_stub}/v1/chat/completions")
-                        for api_stub in api_base
-                    ]
+                    endpoints = [api_stub_endpoint(model, model, api_stub) for api_stub in api_base]
                     process_problem_files(
                         problems_dir,
                         template_content,
@@ -1862,6 +2034,8 @@ def main():
                         think=args.think,
                         no_think=args.no_think,
                         stream=args.stream,
+                        prefix_cache=args.prefix_cache,
+                        compact=not args.no_compact,
                     )
         else:
             endpoints = []
@@ -1875,10 +2049,7 @@ def main():
                     endpoints = [Endpoint(**json.load(file))]
             else:
                 log(f"Inference with tools: Using model {store_name} and language {language}")
-                endpoints = [
-                    Endpoint(store_name=store_name, model_name=store_name, key="", url=f"{api_stub}/v1/chat/completions")
-                    for api_stub in api_base
-                ]
+                endpoints = [api_stub_endpoint(store_name, store_name, api_stub) for api_stub in api_base]
 
             process_problem_files(
                 problems_dir,
@@ -1894,6 +2065,8 @@ def main():
                 think=args.think,
                 no_think=args.no_think,
                 stream=args.stream,
+                prefix_cache=args.prefix_cache,
+                compact=not args.no_compact,
             )
 
 
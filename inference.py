@@ -1,13 +1,12 @@
 import os
 import json
-import time
 import base64
-import threading
-from typing import List
+from typing import Callable, Dict, List, Optional, Tuple
 from argparse import ArgumentParser
 from llm_model_test import complete_model_capabilities, has_complete_model_capabilities
 from benchmark import read_benchmark, write_benchmark
-from llm_client import openai_api_list, ensure_model_available, Endpoint, LoadBalancer, Server, Task, Response
+from llm_cluster import ClusterScheduler
+from llm_client import openai_api_list, ensure_model_available, warm_up_servers, api_stub_endpoint, set_session_pool_size, set_response_cache, Endpoint, LoadBalancer, Server, Task, Response
 
 def read_template(template_path):
     with open(template_path, 'r', encoding='utf-8') as file:
@@ -21,43 +20,49 @@ def resolve_store_name(base_name: str, think: bool = False, no_think: bool = Fal
         store_name += "-no_think"
     return store_name
 
-def process_problem_files(problems_dir, template_content, endpoints: List[Endpoint], language, max_problem_number=9999,
-                          overwrite_existing=False, overwrite_failed=False, expected_solutions={},
-                          think=False, no_think=False):
-    print(f"Processing problems in {problems_dir} with language {language} and endpoint: {endpoints[0]}")
-    store_name = endpoints[0].store_name
-    solutions_dir = os.path.join('solutions', store_name, language)
-    os.makedirs(solutions_dir, exist_ok=True)
+SCHEDULES = ("filename", "longest_first")
+ENGINES = ("threads", "async")
 
-    # Create load balancer with all available endpoints
-    lb = LoadBalancer()
-    lb.start_distribution()
-    
-    # ensure that the first endpoint is loaded, but fail loudly instead of
-    # waiting forever when endpoint discovery is broken or the model is wrong.
-    ensure_model_available(endpoints[0], attempts=3, fail_if_unavailable=True)
-
-    # load server concurrently; they will download a model if that is not present so far.
-    def load_endpoints():
-        for endpoint in endpoints:
-            try:
-                loaded = ensure_model_available(endpoint, attempts=3, fail_if_unavailable=False)
-            except Exception as e:
-                print(f"Error loading endpoint {endpoint}: {e}")
-                loaded = False
-            if loaded:
-                lb.add_server(Server(endpoint=endpoint))
-            else:
-                print(f"Failed to load endpoint {endpoint} after 3 attempts.")
-    loading_thread = threading.Thread(target=load_endpoints, daemon=True)
-    loading_thread.start()
+def read_telemetry_duration(solutions_dir: str, problem_number: str) -> Optional[float]:
+    """Read the duration of an earlier inference of the problem from its NNNN.json telemetry file"""
+    telemetry_path = os.path.join(solutions_dir, f"{problem_number}.json")
+    if not os.path.exists(telemetry_path): return None
+    try:
+        with open(telemetry_path, 'r', encoding='utf-8') as file:
+            telemetry = json.load(file)
+    except (OSError, json.JSONDecodeError):
+        return None
+    duration = telemetry.get("duration_seconds")
+    if isinstance(duration, (int, float)) and duration > 0: return float(duration)
+    return None
 
-    # determine model capabilities; cache them in benchmark.json
-    benchmark = read_benchmark()
-    entry = benchmark.get(store_name, {})
-    is_vision = bool(entry.get('has_vision', False)) # we calculated the capabilities before, right after the start
+def estimate_problem_durations(problem_numbers: List[str], solutions_dir: str, expected_solutions: dict) -> Dict[str, float]:
+    """
+    Estimate the inference duration of each problem. Problems with telemetry from an earlier run use the measured
+    duration_seconds. All other problems are estimated from the points (difficulty) in solutions.json, scaled with
+    the median ratio of duration to points of the measured problems, so both estimates can be compared.
+    """
+    def points(problem_number: str) -> float:
+        value = expected_solutions.get(problem_number, {}).get('points', 0)
+        return float(value) if isinstance(value, (int, float)) else 0.0
+
+    measured = {problem_number: read_telemetry_duration(solutions_dir, problem_number) for problem_number in problem_numbers}
+    ratios = sorted(measured[p] / points(p) for p in problem_numbers if measured[p] is not None and points(p) > 0)
+    seconds_per_point = ratios[len(ratios) // 2] if ratios else 1.0
+    return {p: measured[p] if measured[p] is not None else points(p) * seconds_per_point for p in problem_numbers}
+
+def create_problem_tasks(problems_dir, template_content, store_name, language, max_problem_number=9999,
+                         overwrite_existing=False, overwrite_failed=False, think=False, no_think=False, is_vision=False,
+                         on_response: Optional[Callable[[str, Response], None]] = None) -> List[Task]:
+    """
+    Create the tasks of all problems of one language which do not have a solution yet.
+    on_response is called with the language and the response after the solution was written.
+    """
+    solutions_dir = os.path.join('solutions', store_name, language)
+    os.makedirs(solutions_dir, exist_ok=True)
 
-    # iterate over all problem files and process them
+    # iterate over all problem files and create the tasks
+    tasks: List[Task] = []
     for problem_file in sorted(os.listdir(problems_dir)):
         if problem_file.startswith('.') or not problem_file.endswith('.txt'): continue
         problem_number = problem_file[:-4]  # Remove .txt extension
@@ -66,7 +71,7 @@ def process_problem_files(problems_dir, template_content, endpoints: List[Endpoi
         result_file_path = os.path.join(solutions_dir, f"{problem_number}.md")
         
         if not overwrite_existing and not overwrite_failed and os.path.exists(result_file_path):
-            print(f"Skipping problem {problem_number} as it already has a solution.")
+            print(f"Skipping problem {problem_number}, language {language} as it already has a solution.")
             continue
         
         # read problem content
@@ -105,12 +110,20 @@ def process_problem_files(problems_dir, template_content, endpoints: List[Endpoi
                 "prompt_tokens": resonse.prompt_tokens,
                 "completion_tokens": resonse.completion_tokens,
                 "reasoning_tokens": resonse.reasoning_tokens,
+                "connect_seconds": resonse.connect_seconds,
+                "ttfb_seconds": resonse.ttfb_seconds,
+                "ttft_seconds": resonse.ttft_seconds,
+                "itl_p50_seconds": resonse.itl_p50_seconds,
+                "itl_p95_seconds": resonse.itl_p95_seconds,
+                "itl_p99_seconds": resonse.itl_p99_seconds,
+                "cached": resonse.cached,
             }
             with open(telemetry_result_file_path, 'w', encoding='utf-8') as file:
                 json.dump(telemetry, file, indent=4)
+            if on_response: on_response(language, resonse)
 
-        # Create task and add to load balancer
-        task = Task(
+        # Create task
+        tasks.append(Task(
             id = problem_number,
             description = f"problem {problem_number}, language {language}, model {store_name}",
             prompt = prompt,
@@ -118,17 +131,120 @@ def process_problem_files(problems_dir, template_content, endpoints: List[Endpoi
             response_processing = save_solution,
             think = think,
             no_think = no_think,
-        )    
+        ))
+    return tasks
+
+def create_scheduled_tasks(problems_dir, templates: Dict[str, str], store_name, languages: List[str], max_problem_number=9999,
+                           overwrite_existing=False, overwrite_failed=False, expected_solutions={},
+                           think=False, no_think=False, on_response: Optional[Callable[[str, Response], None]] = None) -> List[Tuple[float, Task]]:
+    """Create the tasks of all languages of a model together with their estimated durations"""
+    # the model capabilities were computed before and are cached in benchmark.json
+    benchmark = read_benchmark()
+    entry = benchmark.get(store_name, {})
+    is_vision = bool(entry.get('has_vision', False))
+
+    scheduled: List[Tuple[float, Task]] = []
+    for language in languages:
+        tasks = create_problem_tasks(problems_dir, templates[language], store_name, language, max_problem_number=max_problem_number,
+                                     overwrite_existing=overwrite_existing, overwrite_failed=overwrite_failed,
+                                     think=think, no_think=no_think, is_vision=is_vision, on_response=on_response)
+        solutions_dir = os.path.join('solutions', store_name, language)
+        durations = estimate_problem_durations([task.id for task in tasks], solutions_dir, expected_solutions)
+        scheduled.extend((durations[task.id], task) for task in tasks)
+    return scheduled
+
+def process_problem_files(problems_dir, templates: Dict[str, str], endpoints: List[Endpoint], languages: List[str], max_problem_number=9999,
+                          overwrite_existing=False, overwrite_failed=False, expected_solutions={},
+                          think=False, no_think=False, server_policy="throughput", schedule="longest_first", engine="threads",
+                          max_retries=4, hedge=False, on_response: Optional[Callable[[str, Response], None]] = None):
+    """
+    Run the problems of all given languages through one load balancer, so the servers keep working on the
+    next language while the last problems of a language are still running. templates maps a language to
+    its prompt template; solutions and telemetry are written to solutions/<store_name>/<language>.
+    on_response is called with the language and the response of every solved problem.
+    """
+    print(f"Processing problems in {problems_dir} with languages {', '.join(languages)} and endpoint: {endpoints[0]}")
+    store_name = endpoints[0].store_name
+
+    # Create load balancer with all available endpoints
+    if engine == "async":
+        from llm_client_async import AsyncLoadBalancer # needs aiohttp
+        lb = AsyncLoadBalancer(max_retries=max_retries)
+    else:
+        lb = LoadBalancer(policy=server_policy, max_retries=max_retries, hedge=hedge)
+    lb.start_distribution()
+    
+    # pull and load the model on all servers in parallel; each server joins the load balancer as soon as it is warm.
+    # Fail loudly instead of waiting forever when endpoint discovery is broken or the model is wrong.
+    if not warm_up_servers(endpoints, lambda endpoint: lb.add_server(Server(endpoint=endpoint)), attempts=3):
+        raise RuntimeError(
+            f"Could not verify any endpoint for model {endpoints[0].model_name}. "
+            "Check that /v1/models is reachable or that the model id is correct.")
+
+    scheduled = create_scheduled_tasks(problems_dir, templates, store_name, languages, max_problem_number=max_problem_number,
+                                       overwrite_existing=overwrite_existing, overwrite_failed=overwrite_failed,
+                                       expected_solutions=expected_solutions, think=think, no_think=no_think,
+                                       on_response=on_response)
+
+    # submit the problems which are expected to take longest first, so no server is left alone with a long problem at the end;
+    # the sort is stable, so the "filename" schedule keeps the order of the languages and problem numbers
+    if schedule == "longest_first":
+        scheduled.sort(key=lambda item: item[0], reverse=True)
+
+    # add the tasks to the load balancer
+    for _, task in scheduled:
         while not lb.add_task(task):
-            print(f"Waiting to add task {problem_number} - queue full")
-            time.sleep(1)
-        print(f"Added problem {problem_number}, language {language}, model {store_name} to processing queue")
+            print(f"Waiting to add task {task.id} - queue full") # add_task already blocks for a while
+        print(f"Added {task.description} to processing queue")
 
     # Wait for all tasks to complete
     print("Waiting for all problems to be processed...")
     lb.wait_completion()
+    if engine == "async": lb.close()
+    print("All problems processed!")
+
+
+def process_model_sweep(problems_dir, templates: Dict[str, str], api_base: List[str], models: Dict[str, List[str]], max_problem_number=9999,
+                        overwrite_existing=False, overwrite_failed=False, expected_solutions={},
+                        think=False, no_think=False, schedule="longest_first", max_retries=4):
+    """
+    Run the problems of several models on all servers with the cluster scheduler. models maps a model name to the
+    languages which shall be computed for it. The servers work on different models at the same time and only switch
+    the model when the work for their model is done, so every model is loaded as few times as possible.
+    """
+    print(f"Processing problems in {problems_dir} for {len(models)} models on {len(api_base)} server(s)")
+    scheduler = ClusterScheduler([api_stub_endpoint("", "", api_stub) for api_stub in api_base], max_retries=max_retries)
+    for model, languages in models.items():
+        store_name = resolve_store_name(model, think=think, no_think=no_think)
+        # like a run for a single model; the tasks of images depend on the has_vision capability
+        ensure_model_capabilities(api_stub_endpoint(store_name, model, api_base[0]), think=think, no_think=no_think)
+        scheduled = create_scheduled_tasks(problems_dir, templates, store_name, languages, max_problem_number=max_problem_number,
+                                           overwrite_existing=overwrite_existing, overwrite_failed=overwrite_failed,
+                                           expected_solutions=expected_solutions, think=think, no_think=no_think)
+        if schedule == "longest_first":
+            scheduled.sort(key=lambda item: item[0], reverse=True)
+        for _, task in scheduled:
+            task.model = model
+            scheduler.add_task(task)
+        print(f"Added {len(scheduled)} problems of model {model}, languages {', '.join(languages)} to processing queue")
+
+    scheduler.start()
+    print("Waiting for all problems to be processed...")
+    scheduler.wait_completion()
     print("All problems processed!")
 
+def ensure_model_capabilities(endpoint: Endpoint, think=False, no_think=False):
+    """determine the model capabilities of the endpoint once; they are cached in benchmark.json"""
+    benchmark = read_benchmark()
+    entry = benchmark.get(endpoint.store_name, {})
+    if has_complete_model_capabilities(entry):
+        print(f"Model capabilities already computed")
+    else:
+        ensure_model_available(endpoint, attempts=3, fail_if_unavailable=False)
+        entry, entry_changed = complete_model_capabilities(entry, endpoint, think = think, no_think = no_think)
+        if entry_changed:
+            benchmark[endpoint.store_name] = entry
+            write_benchmark(benchmark)
 
 def build_endpoints(api_base: List[str], endpoint_name: str, store_name: str, model_name: str) -> List[Endpoint]:
     if endpoint_name:
@@ -144,20 +260,20 @@ def build_endpoints(api_base: List[str], endpoint_name: str, store_name: str, mo
                     model_name=endpoint_dict["model"],
                     key=endpoint_dict["key"],
                     url=endpoint_dict["endpoint"],
+                    max_concurrency=endpoint_dict.get("max_concurrency", 1),
+                    rpm=endpoint_dict.get("rpm"),
+                    tpm=endpoint_dict.get("tpm"),
                 )
             ]
 
-    return [
-        Endpoint(store_name=store_name, model_name=model_name, key="",
-                    url=f"{api_stub}/v1/chat/completions") for api_stub in api_base
-    ]
+    return [api_stub_endpoint(store_name, model_name, api_stub) for api_stub in api_base]
     
 def main():
     parser = ArgumentParser(description="Process Euler problems and send them to an LLM.")
-    parser.add_argument('--api', action='append', help="Specify (multiple) backend OpenAI API endpoints (i.e. ollama); can be used multiple times")
+    parser.add_argument('--api', action='append', help="Specify (multiple) backend OpenAI API endpoints (i.e. ollama); can be used multiple times. Append @<n> (i.e. http://host:8000@8) to send up to n requests in parallel to that server")
     parser.add_argument('--api_base', required=False, default='http://localhost:11434', help='API base URL for the LLM or a list of such urls (comma-separated), default is http://localhost:11434')
     parser.add_argument('--endpoint', required=False, default='', help='Name of an <endpoint>.json file in the endpoints directory')
-    parser.add_argument('--allmodels', action='store_true', help='loop over all models provided by ollama and run those which are missing in benchmark.json')
+    parser.add_argument('--allmodels', action='store_true', help='run all models provided by ollama which are missing in benchmark.json; the servers work on different models at the same time and switch models as rarely as possible')
     parser.add_argument('--model', required=False, default='llama3.2:latest', help='Name of the model to use, default is llama3.2:latest')
     parser.add_argument('--think', action='store_true', help='enable thinking mode via backend request parameters (when supported)')
     parser.add_argument('--no_think', action='store_true', help='disable thinking mode via backend request parameters (when supported)')
@@ -165,12 +281,28 @@ def main():
     parser.add_argument('--overwrite_existing', action='store_true', help='if set, re-calculate all problems that already have an answer')
     parser.add_argument('--overwrite_failed', action='store_true', help='if set, re-calculate those problems with wrong answers')
     parser.add_argument('--only_capabilities', action='store_true', help='if set, only the model capabilities (thinking, vision, tools, forms) are tested')
+    parser.add_argument('--server_policy', required=False, default=None, choices=LoadBalancer.POLICIES, help='how tasks are assigned to servers: "fifo" takes the server that got free first, "throughput" (default) prefers servers with the lowest expected completion time')
+    parser.add_argument('--schedule', required=False, default='longest_first', choices=SCHEDULES, help='order in which problems are submitted: "longest_first" (default) starts with the problems that took longest before or have the most points, "filename" uses the problem number order')
+    parser.add_argument('--engine', required=False, default='threads', choices=ENGINES, help='"threads" (default) sends every request from its own thread, "async" runs all requests on one asyncio event loop (needs aiohttp); --server_policy applies to the threads engine only')
+    parser.add_argument('--retries', type=int, default=4, help='number of retries with exponential backoff for a problem which failed with a timeout, 429, 5xx or broken response, default is 4')
+    parser.add_argument('--hedge', action='store_true', help='send a duplicate request to an idle server when a problem runs longer than the 95th percentile of the response times; the first answer is kept (threads engine only)')
+    parser.add_argument('--no_cache', action='store_true', help='bypass the response cache in cache/llm and send every request to the model')
+    parser.add_argument('--cache_mb', type=int, default=1024, help='size limit of the response cache in MB, default is 1024')
+    parser.add_argument('--pool_size', type=int, default=64, help='number of keep-alive HTTP connections per server, default is 64')
     parser.add_argument('--n100', action='store_true', help='only 100 problems') # this is the default
     parser.add_argument('--n200', action='store_true', help='only 200 problems')
     parser.add_argument('--n400', action='store_true', help='only 400 problems')
     parser.add_argument('--nall', action='store_true', help='all problems')
 
     args = parser.parse_args()
+    if args.engine == 'async':
+        # the AsyncLoadBalancer has no scheduling policy and no hedging, --allmodels uses the ClusterScheduler
+        if args.server_policy: parser.error("--server_policy applies to the threads engine only")
+        if args.hedge: parser.error("--hedge applies to the threads engine only")
+        if args.allmodels: parser.error("--allmodels runs with the cluster scheduler and cannot be combined with --engine async")
+    if args.server_policy is None: args.server_policy = 'throughput'
+    set_session_pool_size(args.pool_size)
+    set_response_cache(not args.no_cache, args.cache_mb)
     
     api_base = args.api if args.api else args.api_base.split(",") if "," in args.api_base else [args.api_base]
     model_name = args.model
@@ -184,17 +316,7 @@ def main():
     if args.nall: max_problem_number = 9999
 
     endpoints = build_endpoints(api_base, endpoint_name, store_name, model_name)
-    # determine model capabilities; cache them in benchmark.json
-    benchmark = read_benchmark()
-    entry = benchmark.get(store_name, {})
-    if has_complete_model_capabilities(entry):
-        print(f"Model capabilities already computed")
-    else:
-        ensure_model_available(endpoints[0], attempts=3, fail_if_unavailable=False)
-        entry, entry_changed = complete_model_capabilities(entry, endpoints[0], think = args.think, no_think = args.no_think)
-        if entry_changed:
-            benchmark[store_name] = entry
-            write_benchmark(benchmark)
+    ensure_model_capabilities(endpoints[0], think = args.think, no_think = args.no_think)
     
     if args.only_capabilities:
         return # finish, we only tested the capabilities
@@ -207,58 +329,51 @@ def main():
     with open('solutions.json', 'r', encoding='utf-8') as json_file:
         expected_solutions = json.load(json_file)
         
-    # iterate over all languages
+    # read the templates of all languages
     languages = args.language.split(',')
+    problems_dir = 'problems'
+    if not os.path.exists(problems_dir):
+        raise Exception(f"Problems directory {problems_dir} does not exist. You must create it using the problems_scraper.py script.")
+    templates = {}
     for language in languages:
-        bench_name = f"{language}-{max_problem_number}"
-        
-        problems_dir = 'problems'
         template_path = os.path.join('templates', 'template_' + language + '.md')
-
-        if not os.path.exists(problems_dir):
-            raise Exception(f"Problems directory {problems_dir} does not exist. You must create it using the problems_scraper.py script.")
-
         if not os.path.exists(template_path):
             raise Exception(f"Template file {template_path} does not exist.")
+        templates[language] = read_template(template_path)
+
+    if args.allmodels:
+        if endpoint_name:
+            raise Exception("The --allmodels option cannot be used in combination with --endpoint.")
+        
+        # loop over all models provided by ollama and run those which are missing in benchmark.json
+        local_endpoint = api_stub_endpoint(store_name, model_name, api_base[0])
+        models = openai_api_list(local_endpoint)
+        print(f"Found {len(models)} models in ollama.")
+        benchmark = read_benchmark()
+        missing = {} # model -> languages which are missing in benchmark.json
+        for model in models:
+            entry = benchmark.get(resolve_store_name(model, think=args.think, no_think=args.no_think), {})
+            missing_languages = [language for language in languages if f"{language}-{max_problem_number}" not in entry]
+            if missing_languages:
+                print(f"Inference: Using model {model} and languages {', '.join(missing_languages)}")
+                missing[model] = missing_languages
 
-        template_content = read_template(template_path)
-
-        if args.allmodels:
-            if endpoint_name:
-                raise Exception("The --allmodels option cannot be used in combination with --endpoint.")
-            
-            # loop over all models provided by ollama and run those which are missing in benchmark.json
-            local_endpoint = Endpoint(store_name=store_name, model_name=model_name, key="", url=f"{api_base[0]}/v1/chat/completions")
-            models = openai_api_list(local_endpoint)
-            print(f"Found {len(models)} models in ollama.")
-            for model in models:
-                # in every loop we load the benchmark.json again because it might have been updated
-                benchmark = read_benchmark()
-                model_store_name = resolve_store_name(model, think=args.think, no_think=args.no_think)
-                entry = benchmark.get(model_store_name, {})
-
-                # add metadata to benchmark.json
-                if model_store_name not in benchmark or bench_name not in benchmark[model_store_name]:
-                    print(f"Inference: Using model {model} and language {language}")
-                    endpoints = [
-                        Endpoint(store_name=model_store_name, model_name=model, key="",
-                                url=f"{api_stub}/v1/chat/completions") for api_stub in api_base
-                    ]
-                    process_problem_files(problems_dir, template_content, endpoints, language, max_problem_number = max_problem_number,
-                                          overwrite_existing = args.overwrite_existing, overwrite_failed = args.overwrite_failed, expected_solutions = expected_solutions,
-                                          think = args.think, no_think = args.no_think)
+        # all (model, language, problem) tasks run together; the servers switch models as rarely as possible
+        process_model_sweep(problems_dir, templates, api_base, missing, max_problem_number = max_problem_number,
+                            overwrite_existing = args.overwrite_existing, overwrite_failed = args.overwrite_failed, expected_solutions = expected_solutions,
+                            think = args.think, no_think = args.no_think, schedule = args.schedule, max_retries = args.retries)
+    else:
+        # construct the endpoint object
+        if endpoint_name:
+            print(f"Inference: Using endpoint {endpoint_name} and languages {', '.join(languages)}")
         else:
-            # construct the endpoint object
-            if endpoint_name:
-                print(f"Inference: Using endpoint {endpoint_name} and language {language}")
-            else:
-                print(f"Inference: Using model {store_name} and language {language}")
-            endpoints = build_endpoints(api_base, endpoint_name, store_name, model_name)
-            
-            # run the inference
-            process_problem_files(problems_dir, template_content, endpoints, language, max_problem_number = max_problem_number,
-                                  overwrite_existing = args.overwrite_existing, overwrite_failed = args.overwrite_failed, expected_solutions = expected_solutions,
-                                  think = args.think, no_think = args.no_think)
+            print(f"Inference: Using model {store_name} and languages {', '.join(languages)}")
+        
+        # run the inference
+        process_problem_files(problems_dir, templates, endpoints, languages, max_problem_number = max_problem_number,
+                              overwrite_existing = args.overwrite_existing, overwrite_failed = args.overwrite_failed, expected_solutions = expected_solutions,
+                              think = args.think, no_think = args.no_think, server_policy = args.server_policy, schedule = args.schedule, engine = args.engine,
+                              max_retries = args.retries, hedge = args.hedge)
 
 if __name__ == "__main__":
     main()
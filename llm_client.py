@@ -1,18 +1,26 @@
 import os
+import re
 import json
+import math
 import time
 import queue
 import base64
+import random
+import hashlib
 import urllib3
 import requests
 import threading
+import urllib3.connection
+import urllib3.connectionpool
+from requests.adapters import HTTPAdapter
+from collections import deque
 from PIL import Image
 from io import BytesIO
 from enum import Enum, auto
 from urllib.parse import urlparse
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from argparse import ArgumentParser
-from typing import Callable, List, Optional
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
 
 @dataclass
 class Endpoint:
@@ -20,6 +28,9 @@ class Endpoint:
     model_name: str                             # Model name that is used in the api request
     key: str                                    # API key (if required)
     url: str                                    # URL of the endpoint
+    max_concurrency: int = 1                    # number of requests the server can process in parallel
+    rpm: Optional[int] = None                   # requests per minute allowed by the provider (hosted APIs)
+    tpm: Optional[int] = None                   # tokens per minute allowed by the provider (hosted APIs)
     _context_size: Optional[float] = None       # kilo-number of tokens
     _publication_date: Optional[str] = None     # ISO-short date, like 2025-09-19
     _quantization_level: Optional[int] = None   # number of bits per weight
@@ -30,6 +41,9 @@ class Endpoint:
             "model_name": self.model_name,
             "key": self.key,
             "url": self.url,
+            "max_concurrency": self.max_concurrency,
+            "rpm": self.rpm,
+            "tpm": self.tpm,
             "_context_size": self._context_size,
             "_publication_date": self._publication_date,
             "_quantization_level": self._quantization_level
@@ -39,6 +53,20 @@ def get_llm_url_stub(endpoint: Endpoint) -> str:
     """Get the base URL for the LLM API"""
     return urllib3.util.url.parse_url(endpoint.url)._replace(path='').url
 
+def split_api_stub(api_stub: str) -> Tuple[str, int]:
+    """Split an --api value like http://host:8000@8 into the base URL and the number of parallel request slots"""
+    api_stub = api_stub.strip()
+    match = re.fullmatch(r"(.+)@(\d+)", api_stub)
+    if match:
+        return match.group(1), max(1, int(match.group(2)))
+    return api_stub, 1
+
+def api_stub_endpoint(store_name: str, model_name: str, api_stub: str) -> Endpoint:
+    """Create an endpoint for a local openai-api server given as --api value (with optional @<slots> suffix)"""
+    api_base, max_concurrency = split_api_stub(api_stub)
+    return Endpoint(store_name=store_name, model_name=model_name, key="",
+                    url=f"{api_base}/v1/chat/completions", max_concurrency=max_concurrency)
+
 def ollama_api_delete(endpoint: dict) -> bool:
     api_base = get_llm_url_stub(endpoint)
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
@@ -47,6 +75,17 @@ def ollama_api_delete(endpoint: dict) -> bool:
                                 json={"model": endpoint.model_name})
     return response.status_code == 200
 
+def ollama_loaded_models(endpoint: Endpoint) -> List[str]:
+    """Names of the models which an ollama server has loaded into memory (/api/ps); empty for other servers"""
+    api_base = get_llm_url_stub(endpoint)
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+    try:
+        response = requests.get(f"{api_base}/api/ps", verify=False, timeout=5)
+        response.raise_for_status()
+        return [model["name"] for model in response.json().get("models", []) if model.get("name")]
+    except (requests.RequestException, ValueError, KeyError, TypeError, AttributeError):
+        return []
+
 def openai_api_list(endpoint) -> dict:
     """
     Try to read models from an openai-api-compatible endpoint (/api/tags).
@@ -139,26 +178,155 @@ def ollama_pull(endpoint: Endpoint) -> dict:
     if openai_api_check_exist(endpoint):
         return endpoint
 
-    # pull the model if it is not available
+    # pull the model if it is not available; the progress is streamed as one json object per line
     api_base = get_llm_url_stub(endpoint)
     print(f"Model {endpoint.model_name} is not available on server {api_base}. Pulling the model...")
     urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
     try:
-        response = requests.request("POST", f"{api_base}/api/pull", verify=False,
-                                    headers={'Accept': 'application/json', 'Content-Type': 'application/json'},
-                                    json={"model": endpoint.model_name, "stream": False})
+        response = requests.request("POST", f"{api_base}/api/pull", verify=False, stream=True,
+                                    headers={'Accept': 'application/x-ndjson', 'Content-Type': 'application/json'},
+                                    json={"model": endpoint.model_name, "stream": True}, timeout=(60, 600))
         if response.status_code != 200:
             print(f"Failed to pull model {endpoint.model_name} from server {api_base}. Status code: {response.status_code}, Response: {response.text}")
             return endpoint
-        data = response.json()
-        if data.get("error", False):
-            print(f"Error pulling Model {endpoint.model_name} from server {api_base}.")
+        error = None
+        last_print = 0.0
+        for line in response.iter_lines():
+            if not line: continue
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if data.get("error"):
+                error = data["error"]
+                break
+            # print the download progress at most every 5 seconds, and every change of the status
+            status = data.get("status", "")
+            total, completed = data.get("total"), data.get("completed")
+            now = time.time()
+            if total and completed is not None:
+                if now - last_print < 5 and completed < total: continue
+                print(f"Pulling {endpoint.model_name} on {api_base}: {status} {100.0 * completed / total:.1f}% of {total / 1e9:.2f} GB")
+            else:
+                print(f"Pulling {endpoint.model_name} on {api_base}: {status}")
+            last_print = now
+        if error:
+            print(f"Error pulling Model {endpoint.model_name} from server {api_base}: {error}")
         else:
             print(f"Model {endpoint.model_name} is now available on server {api_base}.")
     except requests.RequestException as e:
         print(f"Error during model pull request: {e}")
     return endpoint
 
+def warm_up_endpoint(endpoint: Endpoint, attempts: int = 3) -> bool:
+    """
+    Make the model of the endpoint ready: pull it if it is missing and load it into memory with a tiny completion,
+    so the load time is not counted as latency of the first task. Returns False if the model could not be verified.
+    """
+    api_base = get_llm_url_stub(endpoint)
+    try:
+        if not ensure_model_available(endpoint, attempts=attempts, fail_if_unavailable=False):
+            return False
+    except Exception as e:
+        print(f"Error loading endpoint {endpoint}: {e}")
+        return False
+    if endpoint.key:
+        return True # hosted endpoints have no load time; do not pay for a warm-up request
+    try:
+        t0 = time.time()
+        openai_api_chat(endpoint, "Hi", max_tokens=1, stream=False, system_message="Answer with one word.", use_cache=False)
+        print(f"Model {endpoint.model_name} is loaded on server {api_base} ({time.time() - t0:.1f} seconds warm-up).")
+    except Exception as e:
+        # the model is available, so the real requests can still succeed; they report their own errors
+        print(f"Warm-up request for {endpoint.model_name} on {api_base} failed: {e}")
+    return True
+
+def warm_up_servers(endpoints: List[Endpoint], on_ready: Callable[[Endpoint], None], attempts: int = 3) -> bool:
+    """
+    Warm up all endpoints in parallel and call on_ready for each endpoint as soon as it is ready.
+    Returns when the first endpoint is ready (True) or when all endpoints failed (False);
+    the other endpoints continue to warm up in the background.
+    """
+    condition = threading.Condition()
+    state = {"ready": 0, "finished": 0}
+
+    def warm_up(endpoint: Endpoint):
+        ready = warm_up_endpoint(endpoint, attempts=attempts)
+        if ready:
+            on_ready(endpoint)
+        else:
+            print(f"Failed to load endpoint {endpoint} after {attempts} attempts.")
+        with condition:
+            state["finished"] += 1
+            if ready: state["ready"] += 1
+            condition.notify_all()
+
+    for endpoint in endpoints:
+        threading.Thread(target=warm_up, args=(endpoint,), daemon=True).start()
+    with condition:
+        condition.wait_for(lambda: state["ready"] > 0 or state["finished"] == len(endpoints))
+        return state["ready"] > 0
+
+# HTTP connections are kept alive in one shared session per endpoint host. The connection classes measure the
+# time spent in establishing a connection (TCP connect and TLS handshake), so the telemetry can tell connection
+# setup apart from the time until the server sends the first byte.
+session_pool_size = 64 # number of keep-alive connections per host
+_sessions: Dict[str, requests.Session] = {}
+_sessions_lock = threading.Lock()
+_connect_timing = threading.local()
+
+class _TimedConnectMixin:
+    def connect(self):
+        t0 = time.time()
+        try:
+            super().connect()
+        finally:
+            _connect_timing.seconds = getattr(_connect_timing, "seconds", 0.0) + time.time() - t0
+
+class _TimedHTTPConnection(_TimedConnectMixin, urllib3.connection.HTTPConnection):
+    pass
+
+class _TimedHTTPSConnection(_TimedConnectMixin, urllib3.connection.HTTPSConnection):
+    pass
+
+class _TimedHTTPConnectionPool(urllib3.connectionpool.HTTPConnectionPool):
+    ConnectionCls = _TimedHTTPConnection
+
+class _TimedHTTPSConnectionPool(urllib3.connectionpool.HTTPSConnectionPool):
+    ConnectionCls = _TimedHTTPSConnection
+
+class _TimedHTTPAdapter(HTTPAdapter):
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": _TimedHTTPConnectionPool, "https": _TimedHTTPSConnectionPool}
+
+def set_session_pool_size(size: int):
+    """Set the number of keep-alive connections per host; applies to sessions created afterwards"""
+    global session_pool_size
+    session_pool_size = max(1, size)
+
+def get_session(url: str) -> requests.Session:
+    """Get the shared keep-alive session for the host of the url; sessions are thread-safe for our use"""
+    parsed_url = urlparse(url)
+    key = f"{parsed_url.scheme}://{parsed_url.netloc}"
+    with _sessions_lock:
+        session = _sessions.get(key)
+        if session is None:
+            session = requests.Session()
+            adapter = _TimedHTTPAdapter(pool_connections=1, pool_maxsize=session_pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[key] = session
+        return session
+
+def reset_connect_timer():
+    """Start measuring the connection setup time of the requests of the current thread"""
+    _connect_timing.seconds = 0.0
+
+def get_connect_seconds() -> float:
+    """Time spent in connection setup by the current thread since reset_connect_timer"""
+    return getattr(_connect_timing, "seconds", 0.0)
+
 def hex2base64(hex_string) -> str:
     return base64.b64encode(bytes.fromhex(hex_string)).decode('utf-8')
 
@@ -219,36 +387,181 @@ def _normalize_usage(usage: dict, fallback_total_tokens: int = 0) -> dict:
         "total_tokens": total_tokens,
     }
 
-def openai_api_chat(
+class ApiError(Exception):
+    """
+    Failed chat completion request. The kind tells the load balancer whether a retry can help:
+    timeout, connection, rate_limit (429), server (5xx), bad_response (broken or empty body) are retried,
+    client (other 4xx) and cancelled are not.
+    """
+    RETRYABLE = ("timeout", "connection", "rate_limit", "server", "bad_response")
+
+    def __init__(self, message: str, kind: str, status_code: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.kind = kind
+        self.status_code = status_code
+        self.retry_after = retry_after # seconds, from the Retry-After header
+
+    @property
+    def retryable(self) -> bool:
+        return self.kind in ApiError.RETRYABLE
+
+def classify_status(status_code: int) -> str:
+    """Error kind of a http status code"""
+    if status_code == 408: return "timeout"
+    if status_code == 429: return "rate_limit"
+    if status_code >= 500: return "server"
+    return "client"
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Seconds of a Retry-After header; the http-date form is not used by the inference servers"""
+    try:
+        return max(0.0, float(value)) if value else None
+    except ValueError:
+        return None
+
+retry_base_delay = 2.0  # seconds before the first retry, doubled for every further attempt
+retry_max_delay = 60.0
+
+def retry_delay(task: 'Task', error: Exception, max_retries: int) -> Optional[float]:
+    """Count a failed attempt of the task; returns the backoff delay or None if the task should not be retried"""
+    if not isinstance(error, ApiError) or not error.retryable or task.attempts >= max_retries:
+        return None
+    task.attempts += 1
+    delay = min(retry_max_delay, retry_base_delay * 2 ** (task.attempts - 1)) * random.uniform(0.8, 1.2)
+    if error.retry_after is not None:
+        delay = max(delay, error.retry_after)
+    return delay
+
+class ResponseCache:
+    """
+    On-disk cache of chat completions in <cache_dir>/<xx>/<hash>.json. The key is the hash of the request payload,
+    which holds the model name, the messages with the image, the tools and all sampling parameters.
+    Entries are evicted least-recently-used first when the cache grows over max_bytes; a hit refreshes the mtime.
+    """
+    def __init__(self, cache_dir: str, max_bytes: int = 1 << 30):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.size_bytes = None # computed on the first write
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(payload: dict) -> str:
+        return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[dict]:
+        path = self.path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                entry = json.load(file)
+            os.utime(path) # mark as recently used
+            return entry
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, entry: dict):
+        path = self.path(key)
+        data = json.dumps(entry, ensure_ascii=False).encode("utf-8")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as file:
+                file.write(data)
+            os.replace(tmp_path, path) # readers never see a partially written entry
+        except OSError as e:
+            print(f"Could not write cache entry {path}: {e}")
+            return
+        with self.lock:
+            if self.size_bytes is None:
+                self.size_bytes = sum(size for _, size, _ in self._entries())
+            else:
+                self.size_bytes += len(data)
+            if self.size_bytes > self.max_bytes:
+                self._evict()
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        """(mtime, size, path) of all entries"""
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".json"): continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        return entries
+
+    def _evict(self):
+        """Delete the least recently used entries until the cache is at 90% of its size limit; lock must be held"""
+        entries = sorted(self._entries())
+        self.size_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if self.size_bytes <= self.max_bytes * 0.9: break
+            try:
+                os.remove(path)
+                self.size_bytes -= size
+            except OSError:
+                pass
+
+response_cache_enabled = True
+response_cache = ResponseCache(os.path.join(os.path.dirname(os.path.realpath(__file__)), "cache", "llm"))
+
+def set_response_cache(enabled: bool, max_mb: Optional[int] = None):
+    """Enable or bypass the response cache and set its size limit"""
+    global response_cache_enabled
+    response_cache_enabled = enabled
+    if max_mb is not None:
+        response_cache.max_bytes = max_mb * (1 << 20)
+
+def response_cache_lookup(payload: dict, use_cache: bool, return_response_json: bool) -> Tuple[Optional[str], Optional[tuple]]:
+    """
+    Get the cache key for a request and the cached result tuple, if any. Only deterministic requests
+    (temperature 0) are cached; the key is None for all others or if the cache is bypassed.
+    """
+    if not (use_cache and response_cache_enabled) or payload.get("temperature") != 0.0:
+        return None, None
+    key = ResponseCache.key(payload)
+    entry = response_cache.get(key)
+    if entry is None:
+        return key, None
+    usage_summary = dict(entry["usage_summary"], cached=True)
+    usage_summary.pop("rate_limits", None) # the quota of the original response is outdated
+    result = (entry["answer"], entry["total_tokens"], entry["token_per_second"], usage_summary, entry["duration_seconds"])
+    return key, result + (entry.get("response_json"),) if return_response_json else result
+
+def response_cache_store(key: Optional[str], answer: str, total_tokens: int, token_per_second: float,
+                         usage_summary: dict, duration_seconds: float, response_json: Optional[dict], complete: bool = True):
+    """Store a successful result; empty and incomplete answers are not cached so that they are requested again"""
+    if key is None or not complete: return
+    tool_calls = ((response_json or {}).get("choices") or [{}])[0].get("message", {}).get("tool_calls")
+    if not answer and not tool_calls: return
+    response_cache.put(key, {
+        "answer": answer,
+        "total_tokens": total_tokens,
+        "token_per_second": token_per_second,
+        "usage_summary": usage_summary,
+        "duration_seconds": duration_seconds,
+        "response_json": response_json,
+        "created": time.time(),
+    })
+
+def build_chat_request(
     endpoint: Endpoint,
-    prompt: str = 'Hello World',
+    prompt: str,
     base64_image: str = None,
     temperature: float = 0.0,
-    max_tokens: int = 32768, # thats large and it requires that you set the context length in llm to 65536
+    max_tokens: int = 32768,
     stream: bool = True,
     system_message: str = "You are a helpful assistant",
     tools: list = None,
     response_format: dict = None,
-    return_response_json: bool = False,
     think = False,
     no_think = False
-) -> tuple:
-    """
-    Function to interact with the LLM API for chat completions.
-    
-    Args:
-        endpoint (dict): Dictionary containing endpoint information.
-        prompt (str): The prompt to send to the model.
-        base64_image (str): Base64 encoded image string (optional).
-        temperature (float): Temperature for randomness in response.
-        max_tokens (int): Maximum number of tokens for the response.
-        
-    Returns:
-        tuple: A tuple containing the model's response, total tokens used, and tokens per second.
-    """
-
-    # Disable SSL warnings
-    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+) -> Tuple[dict, dict]:
+    """Build the headers and the payload of a chat completion request; shared by the sync and the async client"""
 
     # Prepare the API endpoint URL
     stoptokens = ["[/INST]", "<|im_end|>", "<|end_of_turn|>", "<|eot_id|>", "<|end_header_id|>", "<EOS_TOKEN>", "</s>", "<|end|>"]
@@ -324,23 +637,238 @@ def openai_api_chat(
         payload["max_completion_tokens"] = max_tokens
     else:
         payload["max_tokens"] = max_tokens
-    modelname_lower = modelname.lower()
     if no_think:
         payload["enable_thinking"] = False
+    return headers, payload
+
+class SSEParser:
+    """
+    Incremental parser for server-sent events which works on the raw byte chunks of a response body.
+    Only complete lines are parsed, multi-line 'data:' fields of one event are joined with newlines and
+    the payload is decoded once per event, not once per line.
+    """
+    def __init__(self):
+        self.buffer = bytearray()  # the incomplete last line
+        self.data_lines: List[bytes] = []
+
+    def feed(self, chunk: bytes) -> List[str]:
+        """Add a chunk of the body; returns the data payloads of all events completed by this chunk"""
+        end = chunk.rfind(b"\n")
+        if end < 0:
+            self.buffer += chunk # only the new chunk is searched, so a long line arriving in pieces stays linear
+            return []
+        buffer = bytes(self.buffer) + chunk[:end]
+        self.buffer = bytearray(chunk[end + 1:])
+        events = []
+        for line in buffer.split(b"\n"):
+            if line.endswith(b"\r"): line = line[:-1]
+            if not line:
+                # an empty line dispatches the event
+                if self.data_lines:
+                    events.append(b"\n".join(self.data_lines).decode("utf-8", errors="replace"))
+                    self.data_lines = []
+            elif line.startswith(b"data:"):
+                value = line[5:]
+                self.data_lines.append(value[1:] if value.startswith(b" ") else value)
+            # comment lines (starting with ':') and the fields event, id and retry are not used by the chat api
+        return events
+
+    def flush(self) -> List[str]:
+        """Finish the body; returns the last event if the stream did not end with an empty line"""
+        events = self.feed(b"\n\n") if self.buffer or self.data_lines else []
+        self.buffer = bytearray()
+        return events
+
+def iter_sse_events(chunks) -> Iterator[str]:
+    """Iterate over the data payloads of the events in an iterable of body chunks"""
+    parser = SSEParser()
+    for chunk in chunks:
+        yield from parser.feed(chunk)
+    yield from parser.flush()
+
+def _percentile(values: List[float], p: float) -> Optional[float]:
+    if not values: return None
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, int(round(p / 100.0 * (len(values) - 1)))))]
+
+class ChatStream:
+    """Collects the answer, the usage and the token timing of a streamed chat completion from its data events"""
+    def __init__(self, endpoint: Endpoint, t0: float = None):
+        host = urlparse(endpoint.url).hostname or ""
+        self.url = endpoint.url
+        self.progress_char = host[0] if host else "."
+        self.parser = SSEParser()
+        self.t0 = time.time() if t0 is None else t0 # request start, the reference for the time to first token
+        self.text_chunks = []
+        self.token_times: List[float] = []  # arrival time of every event that carried generated text
+        self.usage = None
+        self.token_count = 0
+        self.parse_errors = 0
+        self.last_parse_error = ""
+        self.finish_reason = None
+        self.done = False
+
+    def feed(self, chunk: bytes):
+        """Process a raw chunk of the response body"""
+        for payload in self.parser.feed(chunk):
+            self.add_data(payload)
+            if self.done: return
+
+    def finish(self):
+        """Process an event which was not terminated by an empty line at the end of the body"""
+        if self.done: return
+        for payload in self.parser.flush():
+            self.add_data(payload)
+
+    def add_data(self, payload: str):
+        """Process the data payload of one event of the stream"""
+        payload = payload.strip()
+        if payload == "[DONE]":
+            print() # end progress line
+            self.done = True
+            return
+        try:
+            evt = json.loads(payload)
+        except json.JSONDecodeError as e:
+            self.parse_errors += 1
+            self.last_parse_error = f"{e}: {payload[:200]}"
+            return
+        if not isinstance(evt, dict):
+            self.parse_errors += 1
+            self.last_parse_error = f"unexpected event: {payload[:200]}"
+            return
+        if evt.get("error"):
+            # servers report failures in the middle of a stream as an error event
+            error = evt["error"]
+            code = error.get("code") if isinstance(error, dict) else None
+            kind = classify_status(code) if isinstance(code, int) and code >= 400 else "server"
+            raise ApiError(f"Stream error from {self.url}: {str(error)[:800]}", kind, status_code=code if isinstance(code, int) else None)
+        evt_usage = evt.get("usage")
+        if isinstance(evt_usage, dict):
+            self.usage = evt_usage
+        choices = evt.get("choices") or []
+        if choices:
+            if choices[0].get("finish_reason"):
+                self.finish_reason = choices[0]["finish_reason"]
+            delta = choices[0].get("delta") or {}
+            #print(delta)
+            if delta.get("content") or delta.get("reasoning") or delta.get("reasoning_content"):
+                self.token_times.append(time.time())
+            if "content" in delta:
+                # delta may have attributes content or reasoning. Take whatever is non-empty
+                token = delta.get("content") or delta.get("reasoning")
+                if token:
+                    self.text_chunks.append(token)
+                    self.token_count += 1
+                    #print(token, end="", flush=True)
+                    if self.token_count % 100 == 0:
+                        print(self.progress_char, end="", flush=True) # print a dot for each 10 tokens to show progress
+
+    def complete(self) -> bool:
+        """True if the stream ended regularly; a stream which was cut off or had malformed events is not cached"""
+        return (self.done or self.finish_reason is not None) and self.parse_errors == 0
+
+    def timing(self) -> dict:
+        """Time to first token and percentiles of the inter-token latency, in seconds"""
+        gaps = [b - a for a, b in zip(self.token_times, self.token_times[1:])]
+        return {
+            "ttft_seconds": self.token_times[0] - self.t0 if self.token_times else None,
+            "itl_p50_seconds": _percentile(gaps, 50),
+            "itl_p95_seconds": _percentile(gaps, 95),
+            "itl_p99_seconds": _percentile(gaps, 99),
+        }
+
+    def result(self, endpoint: Endpoint, duration_seconds: float) -> Tuple[str, int, float, dict]:
+        answer = "".join(self.text_chunks).strip()
+        if self.parse_errors > 0:
+            if not answer and self.usage is None:
+                raise ApiError(f"No valid stream events from {endpoint.url}, {self.parse_errors} malformed: {self.last_parse_error}", "bad_response")
+            print(f"Skipped {self.parse_errors} malformed stream events from {endpoint.url}, last: {self.last_parse_error}")
+        usage_summary = _normalize_usage(self.usage, fallback_total_tokens=len(self.text_chunks))
+        usage_summary.update(self.timing())
+        total_tokens = usage_summary["total_tokens"]
+        token_per_second = 0.0 if duration_seconds <= 0 else total_tokens / duration_seconds
+        if not answer: print(f"Empty streamed response from the API at {endpoint.url}")
+        return answer, total_tokens, token_per_second, usage_summary
+
+def parse_chat_response(endpoint: Endpoint, status_code: int, content_type: str, text: str, duration_seconds: float) -> Tuple[str, int, float, dict, dict]:
+    """Parse the body of a non-streamed chat completion"""
+    if not text.strip():
+        raise ApiError(f"Empty response body (status {status_code}) from {endpoint.url}", "bad_response", status_code)
+
+    if 'json' not in content_type.lower():
+        # possibly a html error page
+        snippet = text[:800].replace('\n',' ')
+        raise ApiError(f"Non-JSON response (status {status_code}, Content-Type {content_type}): {snippet}", "bad_response", status_code)
+
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError as e:
+        raise ApiError(f"Failed to parse JSON response from the API: {e}", "bad_response", status_code) from e
+    usage_summary = _normalize_usage(data.get('usage', {}))
+    total_tokens = usage_summary["total_tokens"]
+    token_per_second = total_tokens / duration_seconds if duration_seconds > 0 else 0.0
+    #print(f"Total tokens: {total_tokens}, tokens per second: {token_per_second:.2f}")
+    choices = data.get('choices', [])
+    if len(choices) == 0:
+        raise ApiError("No response from the API: " + str(data), "bad_response", status_code)
+    message = choices[0].get('message', {})
+    answer = message.get('content', '')
+    return answer, total_tokens, token_per_second, usage_summary, data
+
+def openai_api_chat(
+    endpoint: Endpoint,
+    prompt: str = 'Hello World',
+    base64_image: str = None,
+    temperature: float = 0.0,
+    max_tokens: int = 32768, # thats large and it requires that you set the context length in llm to 65536
+    stream: bool = True,
+    system_message: str = "You are a helpful assistant",
+    tools: list = None,
+    response_format: dict = None,
+    return_response_json: bool = False,
+    think = False,
+    no_think = False,
+    cancel_event: threading.Event = None,
+    use_cache: bool = True
+) -> tuple:
+    """
+    Function to interact with the LLM API for chat completions.
+    
+    Args:
+        endpoint (dict): Dictionary containing endpoint information.
+        prompt (str): The prompt to send to the model.
+        base64_image (str): Base64 encoded image string (optional).
+        temperature (float): Temperature for randomness in response.
+        max_tokens (int): Maximum number of tokens for the response.
+        cancel_event (threading.Event): when set, a streamed response is aborted with an ApiError of kind cancelled.
+        use_cache (bool): serve deterministic requests from the response cache and store their results.
+        
+    Returns:
+        tuple: A tuple containing the model's response, total tokens used, and tokens per second.
+    """
+
+    # Disable SSL warnings
+    urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
+
+    headers, payload = build_chat_request(
+        endpoint, prompt, base64_image=base64_image, temperature=temperature, max_tokens=max_tokens, stream=stream,
+        system_message=system_message, tools=tools, response_format=response_format, think=think, no_think=no_think)
+    cache_key, cached_result = response_cache_lookup(payload, use_cache, return_response_json)
+    if cached_result is not None:
+        return cached_result
 
     # use the endpoints array as failover mechanism
     response = None
-    text_chunks = []
-    usage = None
     read_timeout = 600 # seconds
-    token_count = 0
-    parsed_url = urlparse(endpoint.url)
-    host = parsed_url.hostname or ""
-    c0 = host[0] if host else "."
     #print(f"Calling model in strem mode: {stream}, payload: {json.dumps(payload)}")
+    connect_seconds = 0.0
+    ttfb_seconds = 0.0
     try:
         t0 = time.time()
-        response = requests.post(
+        chat_stream = ChatStream(endpoint, t0)
+        reset_connect_timer()
+        response = get_session(endpoint.url).post(
             endpoint.url,
             headers=headers,
             json=payload,
@@ -348,45 +876,28 @@ def openai_api_chat(
             stream=stream,
             timeout=(60, read_timeout) # (connect_timeout, read_timeout))
         )
+        # elapsed is the time until the response headers arrived, including the connection setup
+        connect_seconds = get_connect_seconds()
+        ttfb_seconds = max(0.0, response.elapsed.total_seconds() - connect_seconds)
+        rate_limits = parse_rate_limit_headers(response.headers)
         #print(f"Response status: {response.status_code}")
         response.raise_for_status()
         #print(f"Response headers: {response.headers}")
         if stream:
             #print("Response (stream): ", end="", flush=True)
             timeouttime = t0 + read_timeout
-            for line in response.iter_lines(decode_unicode=True):
+            for chunk in response.iter_content(chunk_size=None): # chunks as they arrive, not split into lines
                 if time.time() > timeouttime: break # we simply silently terminate the stream after the timeout
-                if not line: continue
-                #print(line)
-                if line.startswith("data: "):
-                    payload_line = line[len("data: "):].strip()
-                    if payload_line == "[DONE]":
-                        print() # end progress line
-                        break
-                    try:
-                        evt = json.loads(payload_line)
-                        evt_usage = evt.get("usage")
-                        if isinstance(evt_usage, dict):
-                            usage = evt_usage
-                        choices = evt.get("choices", [])
-                        if choices:
-                            delta = choices[0].get("delta", {})
-                            #print(delta)
-                            if "content" in delta:
-                                # delta may have attributes content or reasoning. Take whatever is non-empty
-                                token = delta.get("content") or delta.get("reasoning")
-                                if token:
-                                    text_chunks.append(token)
-                                    token_count += 1
-                                    #print(token, end="", flush=True)
-                                    if token_count % 100 == 0:
-                                        print(c0, end="", flush=True) # print a dot for each 10 tokens to show progress
-                    except Exception:
-                        pass # robust against json parse errors
+                if cancel_event is not None and cancel_event.is_set():
+                    response.close()
+                    raise ApiError(f"Request to {endpoint.url} cancelled", "cancelled")
+                chat_stream.feed(chunk)
+                if chat_stream.done: break
+            chat_stream.finish()
         t1 = time.time()
     except requests.exceptions.ReadTimeout as e:
-        raise Exception(f"Read timeout while calling {endpoint.url} (timeout=600s). "
-                        f"The model may be slow or the server overloaded.") from e
+        raise ApiError(f"Read timeout while calling {endpoint.url} (timeout=600s). "
+                       f"The model may be slow or the server overloaded.", "timeout") from e
     except requests.exceptions.RequestException as e:
         # print(f"Failed to access api: {e}")
         # Get the error message from the response
@@ -396,49 +907,29 @@ def openai_api_chat(
                 body = (e.response.text or "")[:800].replace("\n", " ")
             except Exception:
                 body = ""
-        raise Exception(f"API request failed to {endpoint.url}: {e} | Body: {body}") from e
+        status_code = e.response.status_code if getattr(e, "response", None) is not None else None
+        kind = classify_status(status_code) if status_code is not None else "connection"
+        retry_after = parse_retry_after(e.response.headers.get("Retry-After")) if status_code is not None else None
+        raise ApiError(f"API request failed to {endpoint.url}: {e} | Body: {body}", kind, status_code, retry_after) from e
 
     # Parse the response
-    try:
-        if stream:
-            answer = "".join(text_chunks).strip()
-            usage_summary = _normalize_usage(usage, fallback_total_tokens=len(text_chunks))
-            total_tokens = usage_summary["total_tokens"]
-            token_per_second = 0.0 if (t1 - t0) <= 0 else total_tokens / (t1 - t0)
-            if not answer: print(f"Empty streamed response from the API at {endpoint.url}")
-            response_json = None
-        else:
-            ctype = response.headers.get('Content-Type', '')
-            text  = response.text or ''
-            if not text.strip():
-                raise Exception(f"Empty response body (status {response.status_code}) from {endpoint.url}")
-
-            if 'json' not in ctype.lower():
-                # possibly a html error page
-                snippet = text[:800].replace('\n',' ')
-                raise Exception(f"Non-JSON response (status {response.status_code}, Content-Type {ctype}): {snippet}")
-
-            data = response.json()
-            usage_summary = _normalize_usage(data.get('usage', {}))
-            total_tokens = usage_summary["total_tokens"]
-            token_per_second = total_tokens / (t1 - t0)
-            #print(f"Total tokens: {total_tokens}, tokens per second: {token_per_second:.2f}")
-            choices = data.get('choices', [])
-            if len(choices) == 0:
-                raise Exception("No response from the API: " + str(data))
-            message = choices[0].get('message', {})
-            answer = message.get('content', '')
-            response_json = data
-        if return_response_json:
-            return answer, total_tokens, token_per_second, usage_summary, t1 - t0, response_json
-        return answer, total_tokens, token_per_second, usage_summary, t1 - t0
-    except json.JSONDecodeError as e:
-        raise Exception(f"Failed to parse JSON response from the API: {e}")
-
-busy_waiting_time = 1 # seconds
-
+    if stream:
+        answer, total_tokens, token_per_second, usage_summary = chat_stream.result(endpoint, t1 - t0)
+        response_json = None
+    else:
+        answer, total_tokens, token_per_second, usage_summary, response_json = parse_chat_response(
+            endpoint, response.status_code, response.headers.get('Content-Type', ''), response.text or '', t1 - t0)
+    # the usage summary also carries the timing of the request
+    usage_summary["connect_seconds"] = connect_seconds
+    usage_summary["ttfb_seconds"] = ttfb_seconds
+    usage_summary["rate_limits"] = rate_limits
+    response_cache_store(cache_key, answer, total_tokens, token_per_second, usage_summary, t1 - t0, response_json,
+                         complete=not stream or chat_stream.complete())
+    if return_response_json:
+        return answer, total_tokens, token_per_second, usage_summary, t1 - t0, response_json
+    return answer, total_tokens, token_per_second, usage_summary, t1 - t0
 
-@dataclass
+@dataclass(eq=False) # tasks are compared by identity so they can be members of a server's set of active tasks
 class Task:
     """
     Dataclass for task.
@@ -452,6 +943,8 @@ class Task:
     response_processing: Callable[['Response'], None] # a function to process the result
     think: bool = False         # use thinking settings
     no_think: bool = False      # use non-thinking settings
+    attempts: int = 0           # number of failed attempts which were retried
+    model: Optional[str] = None # model name for the request if the server may switch models; None uses the model of the endpoint
 
 @dataclass
 class Response:
@@ -468,81 +961,373 @@ class Response:
     prompt_tokens: Optional[int] = None
     completion_tokens: Optional[int] = None
     reasoning_tokens: Optional[int] = None
+    connect_seconds: Optional[float] = None     # time for TCP connect and TLS handshake; 0 if a kept-alive connection was used
+    ttfb_seconds: Optional[float] = None        # time from sending the request until the first byte of the response
+    ttft_seconds: Optional[float] = None        # time from sending the request until the first generated token (streaming only)
+    itl_p50_seconds: Optional[float] = None     # median inter-token latency (streaming only)
+    itl_p95_seconds: Optional[float] = None
+    itl_p99_seconds: Optional[float] = None
+    cached: bool = False                        # the answer was served from the response cache
 
-@dataclass
+class TokenBucket:
+    """Token bucket for a per-minute quota; a capacity of None is unlimited"""
+    def __init__(self, per_minute: Optional[int] = None):
+        self.capacity = per_minute
+        self.level = float(per_minute) if per_minute else 0.0
+        self.updated = time.time()
+        self.blocked_until = 0.0
+
+    def refill(self, now: float):
+        if self.capacity:
+            self.level = min(float(self.capacity), self.level + (now - self.updated) * self.capacity / 60.0)
+        self.updated = now
+
+    def wait_seconds(self, amount: float, now: float) -> float:
+        """Seconds until the amount is available; 0 if it is available now"""
+        if now < self.blocked_until: return self.blocked_until - now
+        if not self.capacity: return 0.0
+        self.refill(now)
+        need = min(amount, self.capacity) # a request larger than the bucket only waits for a full bucket
+        return 0.0 if self.level >= need else (need - self.level) * 60.0 / self.capacity
+
+    def take(self, amount: float, now: float):
+        if not self.capacity: return
+        self.refill(now)
+        self.level -= amount # may become negative if a request used more than estimated
+
+    def update(self, limit: Optional[int], remaining: Optional[int], reset_seconds: Optional[float], now: float):
+        """Adopt the quota reported by the provider"""
+        if limit:
+            if not self.capacity: self.level = float(limit)
+            self.capacity = limit
+        self.refill(now)
+        if remaining is not None and self.capacity:
+            # requests which were sent after this response was generated are already subtracted from our level
+            self.level = min(self.level, float(remaining))
+        if remaining == 0 and reset_seconds:
+            self.blocked_until = max(self.blocked_until, now + reset_seconds)
+
+    def pause(self, seconds: float, now: float):
+        self.blocked_until = max(self.blocked_until, now + seconds)
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Seconds of a duration like 1s, 6m0s, 20ms or 0.5 as used in the x-ratelimit-reset-* headers"""
+    if not value: return None
+    value = value.strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = re.findall(r"(\d+(?:\.\d+)?)(ms|h|m|s)", value)
+    if not parts: return None
+    factors = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+    return sum(float(number) * factors[unit] for number, unit in parts)
+
+def parse_rate_limit_headers(headers) -> dict:
+    """Read the x-ratelimit-* headers of a response into a dict; empty if the server does not send them"""
+    rate_limits = {}
+    for kind in ("requests", "tokens"):
+        for name in ("limit", "remaining"):
+            value = headers.get(f"x-ratelimit-{name}-{kind}")
+            if value is not None and value.strip().isdigit():
+                rate_limits[f"{name}_{kind}"] = int(value)
+        reset = parse_duration(headers.get(f"x-ratelimit-reset-{kind}"))
+        if reset is not None:
+            rate_limits[f"reset_{kind}_seconds"] = reset
+    return rate_limits
+
+class RateLimiter:
+    """
+    Requests and tokens per minute of an endpoint as two token buckets. The quotas come from the rpm and tpm
+    attributes of the endpoint and are updated from the x-ratelimit-* headers of the responses, so a hosted API
+    is limited even if its quota is not configured. Without quota the limiter never waits.
+    """
+    def __init__(self, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.lock = threading.Lock()
+
+    def wait_seconds(self, tokens: int) -> float:
+        """Seconds until a request with the expected number of tokens fits into the quota"""
+        with self.lock:
+            now = time.time()
+            return max(self.requests.wait_seconds(1, now), self.tokens.wait_seconds(tokens, now))
+
+    def acquire(self, tokens: int):
+        """Take the budget of a request with the expected number of tokens"""
+        with self.lock:
+            now = time.time()
+            self.requests.take(1, now)
+            self.tokens.take(tokens, now)
+
+    def settle(self, reserved_tokens: int, used_tokens: int):
+        """Correct the token budget by the difference between the expected and the actual tokens of a request"""
+        with self.lock:
+            self.tokens.take(used_tokens - reserved_tokens, time.time())
+
+    def update(self, rate_limits: Optional[dict]):
+        """Update the quota from the parsed x-ratelimit-* headers of a response"""
+        if not rate_limits: return
+        with self.lock:
+            now = time.time()
+            self.requests.update(rate_limits.get("limit_requests"), rate_limits.get("remaining_requests"),
+                                 rate_limits.get("reset_requests_seconds"), now)
+            self.tokens.update(rate_limits.get("limit_tokens"), rate_limits.get("remaining_tokens"),
+                               rate_limits.get("reset_tokens_seconds"), now)
+
+    def pause(self, seconds: float):
+        """Hold all requests for some seconds, i.e. after a 429 response"""
+        with self.lock:
+            now = time.time()
+            self.requests.pause(seconds, now)
+
+def estimate_request_tokens(task: 'Task', expected_tokens: Optional[float]) -> int:
+    """Tokens which are reserved in the rate limiter for a request; the prompt length is used until responses were measured"""
+    return int(expected_tokens) if expected_tokens else len(task.prompt) // 4
+
+@dataclass(eq=False) # servers are compared by identity
 class Server:
     """
     Dataclass for server.
     This dataclass is used to represent a server that can process tasks.
     Each server has an ID, an endpoint (URL), and a status that indicates whether the server is available or busy.
-    The status is used to track the current task being processed by the server.
+    The status is the set of tasks currently processed by the server; it can hold up to
+    endpoint.max_concurrency tasks at the same time.
+    The server also keeps moving averages of the measured request duration and throughput which
+    are used by the "throughput" scheduling policy of the LoadBalancer, and a rate limiter which
+    holds requests to hosted endpoints until their requests/tokens per minute quota allows them.
     """
     endpoint: Endpoint  # The endpoint of the server
-    current_task: Task = None  # Track the current task being processed
+    active_tasks: Set[Task] = field(default_factory=set)  # Track the tasks being processed
+    task_started: Dict[Task, float] = field(default_factory=dict)  # start time of each active task
+    duration_seconds: Optional[float] = None    # moving average of the request duration
+    token_per_second: Optional[float] = None    # moving average of the measured throughput
+    completed_tasks: int = 0
+    rate_limiter: Optional[RateLimiter] = None  # requests and tokens per minute, created from the endpoint
+    loaded_model: Optional[str] = None          # model that the server has loaded, when the cluster scheduler switches models
+
+    def __post_init__(self):
+        if self.rate_limiter is None:
+            self.rate_limiter = RateLimiter(self.endpoint.rpm, self.endpoint.tpm)
+
+    @property
+    def max_concurrency(self) -> int:
+        return max(1, self.endpoint.max_concurrency or 1)
+
+    def free_slots(self) -> int:
+        return self.max_concurrency - len(self.active_tasks)
+
+    def record_response(self, duration_seconds: float, token_per_second: float, alpha: float = 0.3):
+        """Update the moving averages with the measurements of a finished request"""
+        if duration_seconds > 0:
+            self.duration_seconds = duration_seconds if self.duration_seconds is None else \
+                alpha * duration_seconds + (1 - alpha) * self.duration_seconds
+        if token_per_second > 0:
+            self.token_per_second = token_per_second if self.token_per_second is None else \
+                alpha * token_per_second + (1 - alpha) * self.token_per_second
+        self.completed_tasks += 1
+
+    def expected_duration(self, expected_tokens: Optional[float]) -> Optional[float]:
+        """Expected duration of a new request; None if the server has not finished any request so far"""
+        if expected_tokens and self.token_per_second:
+            return expected_tokens / self.token_per_second
+        return self.duration_seconds
+
 
 class LoadBalancer:
     """
     LoadBalancer class for managing task distribution across multiple servers.
     This class is responsible for distributing tasks to available servers and managing their status.
     - It uses a queue to manage tasks and a list of servers to distribute the load.
-    - It will only assign tasks to servers that are AVAILABLE.
+    - It will only assign tasks to servers that are AVAILABLE, that is, servers with a free request slot.
+      Each server has endpoint.max_concurrency slots, so batching backends get several requests in flight.
     - It implements backpressure to prevent overloading the servers.
     - It will wait for a server to become available before assigning a new task.
-    - It will also retry failed tasks after a short delay.
+    - It retries a failed task with exponential backoff if the error is transient (timeout, connection error,
+      429, 5xx, broken response); other errors and tasks which failed max_retries times are given up.
+    - With hedge=True, a task which runs longer than the 95th percentile of the earlier response times is
+      duplicated to an idle slot of another server when no other task is waiting; the first answer is kept
+      and the other request is cancelled.
     - The status of each server is updated as tasks are assigned and completed.
+    - The server selection follows a policy: "fifo" takes the server slot that became free first,
+      "throughput" takes the server with the lowest expected completion time, measured from the
+      token_per_second and duration_seconds of earlier responses. At the end of a sweep, when there
+      are fewer tasks than free slots, a task waits for a fast busy server instead of starting on a
+      slow idle server if the fast server is expected to finish it earlier.
+    - A server is only selected when its rate limiter has budget for the request; otherwise the task is held
+      until the quota is refilled, so hosted endpoints are used as fast as their quota allows without 429s.
+    Waiting is event-driven: a single condition variable is notified whenever a server
+    is added or finishes a task, so the distributor and wait_completion never poll.
     """
-    def __init__(self, max_queue_size: int = 1000):
+    POLICIES = ("fifo", "throughput")
+    HEDGE_MIN_SAMPLES = 10 # responses needed before the latency percentile is trusted
+
+    def __init__(self, max_queue_size: int = 1000, policy: str = "throughput", max_retries: int = 4, hedge: bool = False):
+        if policy not in LoadBalancer.POLICIES:
+            raise ValueError(f"Unknown scheduling policy {policy}, must be one of {', '.join(LoadBalancer.POLICIES)}")
+        self.policy = policy
         self.servers = []
         self.task_queue = queue.Queue[Task](maxsize=max_queue_size)
-        self.available_servers = queue.Queue[Server]()
+        self.available_servers = deque()    # one entry per free request slot, in the order in which the slots became free
+        self.outstanding_tasks = 0          # tasks added but not yet finished (processed or failed)
+        self.expected_tokens = None         # moving average of the total tokens of a response
+        self.max_retries = max_retries
+        self.hedge = hedge
+        self.durations = deque(maxlen=200)  # duration of the latest responses, for the hedging threshold
+        self.running_copies: Dict[Task, int] = {}           # requests in flight per task; 2 if the task is hedged
+        self.cancel_events: Dict[Task, threading.Event] = {} # set when the answer of one of the requests was processed
+        self.answered_tasks: Set[Task] = set() # tasks with an answer which is processed or was processed
+        self.hedged_tasks: Set[Task] = set()
         self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
         
     def add_server(self, server: Server):
         """Add a server to the load balancer"""
-        self.servers.append(server)
-        self.available_servers.put(server)
-        print(f"Server {get_llm_url_stub(server.endpoint)} added to load balancer.")
+        with self.condition:
+            self.servers.append(server)
+            self.available_servers.extend([server] * server.max_concurrency)
+            self.condition.notify_all()
+        print(f"Server {get_llm_url_stub(server.endpoint)} added to load balancer with {server.max_concurrency} slot(s).")
 
     def add_task(self, task: Task):
         """Add a task to the processing queue with backpressure"""
+        with self.condition:
+            self.outstanding_tasks += 1
         try:
             self.task_queue.put(task, block=True, timeout=1)
             return True
         except queue.Full:
+            self.finish_task()
             print("Task queue full - applying backpressure")
             return False
+
+    def finish_task(self):
+        """Count a task as done; wakes up wait_completion when it was the last one"""
+        with self.condition:
+            self.outstanding_tasks -= 1
+            self.condition.notify_all()
     
-    def mark_server_available(self, server: Server):
-        """Mark a server as available for new tasks"""
-        with self.lock:
-            server.current_task = None
-            self.available_servers.put(server)
-    
-    def get_available_server(self, timeout: float = 10.0) -> Optional[Server]:
-        """Get the next available server with timeout"""
-        try:
-            # Remove and return the next available server from the queue.
-            # The only way the server gets available is when the task is finished
-            # and the task assignes its server back to the available_servers.
-            return self.available_servers.get(timeout=timeout)
-        except queue.Empty:
-            return None
+    def mark_server_available(self, server: Server, task: Task):
+        """Release the slot that the task occupied on the server"""
+        with self.condition:
+            self._release_slot(server, task)
+
+    def _release_slot(self, server: Server, task: Task):
+        """Release the slot of the task on the server; must be called with the lock held"""
+        server.active_tasks.discard(task)
+        server.task_started.pop(task, None)
+        self.available_servers.append(server)
+        self.condition.notify_all()
     
-    def assign_task_to_server(self, task: Task, server: Server):
-        """Assign task to server and mark it as busy"""
+    def get_available_server(self, timeout: Optional[float] = 10.0, tokens: int = 0) -> Optional[Server]:
+        """
+        Get the server slot which became free first and has rate limit budget for a request with the expected tokens;
+        blocks until one is freed or the timeout (None = forever) expires.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                # The only way the server gets available is when the task is finished
+                # and the task assignes its server back to the available_servers.
+                wait_seconds = None
+                for server in self.available_servers:
+                    budget_wait = server.rate_limiter.wait_seconds(tokens)
+                    if budget_wait <= 0:
+                        self.available_servers.remove(server)
+                        server.rate_limiter.acquire(tokens)
+                        return server
+                    wait_seconds = budget_wait if wait_seconds is None else min(wait_seconds, budget_wait)
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0: return None
+                    wait_seconds = remaining if wait_seconds is None else min(wait_seconds, remaining)
+                self.condition.wait(timeout=wait_seconds)
+
+    def select_server(self, timeout: Optional[float] = None, tokens: int = 0) -> Optional[Server]:
+        """Select a server for the next task according to the scheduling policy and take its rate limit budget"""
+        if self.policy == "fifo":
+            return self.get_available_server(timeout=timeout, tokens=tokens)
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while True:
+                server, wait_seconds = self._fastest_server(tokens)
+                if server is not None:
+                    self.available_servers.remove(server) # take one of its slots
+                    server.rate_limiter.acquire(tokens)
+                    return server
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0: return None
+                    wait_seconds = remaining if wait_seconds is None else min(wait_seconds, remaining)
+                # wake up when a slot is freed, when the expected finishing time of the fast server has passed
+                # or when the rate limit budget of a server is refilled
+                self.condition.wait(timeout=wait_seconds)
+
+    def _fastest_server(self, tokens: int = 0) -> Tuple[Optional[Server], Optional[float]]:
+        """
+        Find a server for the next task; must be called with the lock held.
+        The queued tasks are virtually distributed over all slots in the order of their expected completion time.
+        The fastest idle server that would get at least one of these tasks is selected. If all remaining tasks
+        would be finished earlier by the busy servers, None is returned together with the time to wait.
+        Idle servers without rate limit budget count as servers which get free when the budget is refilled.
+        """
+        budget_wait = {server: server.rate_limiter.wait_seconds(tokens) for server in self.servers if server.free_slots() > 0}
+        free_servers = [server for server, wait in budget_wait.items() if wait <= 0]
+        if not free_servers:
+            return None, min(budget_wait.values(), default=None) # wait until any slot gets free or gets budget
+        known = [d for d in (server.expected_duration(self.expected_tokens) for server in self.servers) if d is not None]
+        default_duration = min(known) if known else 0.0 # unmeasured servers are assumed to be fast, so they get probed
+
+        def duration(server: Server) -> float:
+            d = server.expected_duration(self.expected_tokens)
+            return default_duration if d is None else d
+
+        now = time.time()
+        pending = self.task_queue.qsize() + 1 # the queued tasks and the one which is waiting for a server
+        slots = [] # (seconds until the slot is free, expected duration) for each slot
+        for server in self.servers:
+            d = duration(server)
+            slots.extend([(max(0.0, budget_wait.get(server, 0.0)), d)] * server.free_slots())
+            for started in server.task_started.values():
+                elapsed = now - started
+                # an overdue task is assumed to need half of its elapsed time again
+                slots.append((d - elapsed if elapsed < d else elapsed * 0.5, d))
+
+        for server in sorted(free_servers, key=duration):
+            d = duration(server)
+            if d <= 0: return server, None
+            # count the tasks that the other slots complete before this server would have completed the task;
+            # ties do not count, so equally fast idle slots (like the other free slots of this server) add nothing
+            capacity = sum(math.ceil((d - free_in) / slot_duration) - 1 if slot_duration > 0 else pending
+                           for free_in, slot_duration in slots if free_in < d)
+            if capacity < pending:
+                return server, None
+
+        # the busy servers are faster; wake up when the next of them is expected to be done
+        next_free = min((free_in for free_in, _ in slots if free_in > 0), default=0.0)
+        return None, max(0.01, next_free)
+
+    def assign_task_to_server(self, task: Task, server: Server, reserved_tokens: int = 0):
+        """Assign task to a slot of the server; reserved_tokens is the budget taken from the rate limiter"""
         with self.lock:
-            server.current_task = task
+            server.active_tasks.add(task)
+            server.task_started[task] = time.time()
+            self.running_copies[task] = self.running_copies.get(task, 0) + 1
+            self.cancel_events.setdefault(task, threading.Event())
         
         threading.Thread(
             target=self.process_task_remote,
-            args=(server,),
+            args=(server, task, reserved_tokens),
             daemon=True
         ).start()
     
-    def process_task_remote(self, server: Server):
+    def process_task_remote(self, server: Server, task: Task, reserved_tokens: int = 0):
         """Process task on remote server"""
-        task = server.current_task
         endpoint = server.endpoint
+        used_tokens = 0
+        cancel_event = self.cancel_events.get(task)
+        outcome = None # "first" if this request answered the task, "duplicate" if the other request of a hedged task was faster
+        error = None
         try:
             #print(f"Processing task ID {task.id} on server {server.endpoint} with model {task.model}")
             answer, total_tokens, token_per_second, usage_summary, duration_seconds = openai_api_chat(
@@ -550,7 +1335,8 @@ class LoadBalancer:
                 task.prompt, 
                 base64_image=task.base64_image,
                 think = task.think,
-                no_think = task.no_think
+                no_think = task.no_think,
+                cancel_event = cancel_event
             )
             # Call the response processing function
             response = Response(
@@ -562,14 +1348,46 @@ class LoadBalancer:
                 prompt_tokens=usage_summary.get("prompt_tokens"),
                 completion_tokens=usage_summary.get("completion_tokens"),
                 reasoning_tokens=usage_summary.get("reasoning_tokens"),
+                connect_seconds=usage_summary.get("connect_seconds"),
+                ttfb_seconds=usage_summary.get("ttfb_seconds"),
+                ttft_seconds=usage_summary.get("ttft_seconds"),
+                itl_p50_seconds=usage_summary.get("itl_p50_seconds"),
+                itl_p95_seconds=usage_summary.get("itl_p95_seconds"),
+                itl_p99_seconds=usage_summary.get("itl_p99_seconds"),
+                cached=bool(usage_summary.get("cached")),
             )
-            task.response_processing(response)
-            print(f"Processed {task.description}, on {server.endpoint.url} with model {endpoint.model_name} in {duration_seconds:.2f} seconds with {total_tokens} tokens ({token_per_second:.2f} tokens/sec)")
-            
-            # mark server available
-            self.mark_server_available(server)
+            used_tokens = 0 if response.cached else total_tokens
+            server.rate_limiter.update(usage_summary.get("rate_limits"))
+            with self.lock:
+                if not response.cached: # a cached answer says nothing about the speed of the server
+                    server.record_response(duration_seconds, token_per_second)
+                    self.durations.append(duration_seconds)
+                if total_tokens:
+                    self.expected_tokens = total_tokens if self.expected_tokens is None else \
+                        0.3 * total_tokens + 0.7 * self.expected_tokens
+                outcome = "duplicate" if task in self.answered_tasks else "first"
+                self.answered_tasks.add(task)
+            if outcome == "duplicate":
+                print(f"Discarded the slower answer of hedged {task.description} from {server.endpoint.url}")
+                return
+            try:
+                task.response_processing(response)
+            except Exception:
+                # the answer was received, so the task is finished and not retried
+                import traceback
+                traceback.print_exc()
+                print(f"Failed to process the answer of {task.description} from {server.endpoint.url}")
+                return
+            finally:
+                cancel_event.set() # stops the other request of a hedged task
+            print(f"Processed {task.description}, on {server.endpoint.url} with model {endpoint.model_name} in {duration_seconds:.2f} seconds with {total_tokens} tokens ({token_per_second:.2f} tokens/sec){' from cache' if response.cached else ''}")
                 
         except Exception as e:
+            error = e
+            if cancel_event.is_set():
+                # the other request of a hedged task has answered
+                print(f"Stopped the slower request of hedged {task.description} on {server.endpoint.url}")
+                return
             # write a stack trace to std out
             import traceback
             traceback.print_exc()
@@ -582,42 +1400,115 @@ class LoadBalancer:
                 except:
                     error_msg += f" | Raw Response: {e.response.text}"
             print(error_msg)
-            # make server available again
-            self.mark_server_available(server)
-    
+        finally:
+            # make server available again before the task is counted as finished so that
+            # wait_completion never returns while a server is still marked as busy
+            server.rate_limiter.settle(reserved_tokens, used_tokens)
+            self._request_finished(server, task, outcome, error)
+
+    def _request_finished(self, server: Server, task: Task, outcome: Optional[str], error: Optional[Exception]):
+        """Release the slot of a request and finish, retry or give up the task"""
+        if isinstance(error, ApiError) and error.kind == "rate_limit":
+            # hold all tasks for this server until the quota is available again
+            server.rate_limiter.pause(error.retry_after if error.retry_after is not None else retry_base_delay)
+        with self.condition:
+            self._release_slot(server, task)
+            self.running_copies[task] -= 1
+            last_request = self.running_copies[task] == 0
+            answered = self.cancel_events[task].is_set()
+            if last_request:
+                del self.running_copies[task]
+                del self.cancel_events[task]
+                self.answered_tasks.discard(task)
+                self.hedged_tasks.discard(task)
+        if outcome == "first":
+            self.finish_task() # the task is done, even if the other request of a hedged task is still running
+            return
+        if answered or not last_request:
+            return # the task was answered or the other request of a hedged task is still running
+        delay = retry_delay(task, error, self.max_retries)
+        if delay is None:
+            print(f"Giving up {task.description} after {task.attempts + 1} attempt(s): {error}")
+            self.finish_task()
+            return
+        print(f"Retrying {task.description} in {delay:.1f} seconds (attempt {task.attempts + 1} of {self.max_retries + 1}, {error.kind} error)")
+        # the task stays outstanding while it waits for the retry
+        timer = threading.Timer(delay, self.task_queue.put, args=(task,))
+        timer.daemon = True
+        timer.start()
+
+    def _hedge_stragglers(self) -> Optional[float]:
+        """
+        Duplicate tasks which run longer than the 95th percentile of the response times to an idle slot of another server;
+        must be called with the lock held. Returns the seconds until the next task passes the threshold.
+        """
+        if len(self.durations) < LoadBalancer.HEDGE_MIN_SAMPLES:
+            return None # wait for more responses
+        threshold = _percentile(list(self.durations), 95)
+        now = time.time()
+        next_check = None
+        for server in list(self.servers):
+            for task, started in list(server.task_started.items()):
+                if task in self.hedged_tasks or task in self.answered_tasks: continue
+                remaining = started + threshold - now
+                if remaining > 0:
+                    next_check = remaining if next_check is None else min(next_check, remaining)
+                    continue
+                if self.task_queue.unfinished_tasks > 0:
+                    # waiting tasks go first; they are handed out when a slot is freed, which notifies us again
+                    continue
+                tokens = estimate_request_tokens(task, self.expected_tokens)
+                idle = [other for other in self.available_servers
+                        if task not in other.active_tasks and other.rate_limiter.wait_seconds(tokens) <= 0]
+                if not idle: continue
+                known = [other for other in idle if other.expected_duration(self.expected_tokens) is not None]
+                copy_server = min(known, key=lambda other: other.expected_duration(self.expected_tokens)) if known else idle[0]
+                self.available_servers.remove(copy_server)
+                copy_server.rate_limiter.acquire(tokens)
+                self.hedged_tasks.add(task)
+                copy_server.active_tasks.add(task)
+                copy_server.task_started[task] = now
+                self.running_copies[task] += 1
+                print(f"Hedging {task.description}: running for {now - started:.1f}s (p95 is {threshold:.1f}s), duplicate sent to {copy_server.endpoint.url}")
+                threading.Thread(target=self.process_task_remote, args=(copy_server, task, tokens), daemon=True).start()
+        return next_check
+
     def start_distribution(self):
         """Start the task distribution process"""
         def distributor():
             while True:
                 task = self.task_queue.get()
-                assigned = False
-                
-                while not assigned:
-                    server = self.get_available_server()
-                    if server:
-                        self.assign_task_to_server(task, server)
-                        assigned = True
-                    else:
-                        # All servers busy, wait and try again
-                        time.sleep(busy_waiting_time)
-                
+                # blocks until a server is freed; no busy waiting
+                tokens = estimate_request_tokens(task, self.expected_tokens)
+                server = self.select_server(timeout=None, tokens=tokens)
+                self.assign_task_to_server(task, server, tokens)
                 self.task_queue.task_done()
+                if self.hedge:
+                    with self.condition: self.condition.notify_all() # the hedger waits until no task is waiting
         
         # Start distributor thread
         threading.Thread(target=distributor, daemon=True).start()
+
+        if self.hedge:
+            def hedger():
+                with self.condition:
+                    while True:
+                        # woken up by finished requests or when the next running task passes the latency threshold
+                        self.condition.wait(timeout=self._hedge_stragglers())
+            threading.Thread(target=hedger, daemon=True).start()
     
-    def wait_completion(self):
-        """Wait for all tasks to be processed"""
-        self.task_queue.join()
-        # Wait for all servers to finish their current tasks
+    def wait_completion(self, status_interval: float = 60.0):
+        """Wait for all tasks to be processed; returns as soon as the last response is processed"""
         print("Waiting for all servers to finish processing...")
-        while any(s.current_task != None for s in self.servers):
-            time.sleep(busy_waiting_time)
-            print("Still waiting for servers to finish...")
-            # print out the current status of all servers
-            for server in self.servers:
-                if server.current_task:
-                    print(f"Server {server.endpoint.url} - Current task ID: {server.current_task.id}")
+        with self.condition:
+            while self.outstanding_tasks > 0:
+                if self.condition.wait(timeout=status_interval): continue
+                # print out the current status of all servers now and then, this is not a polling loop
+                print(f"Still waiting for servers to finish, {self.outstanding_tasks} tasks outstanding...")
+                for server in self.servers:
+                    if server.active_tasks:
+                        task_ids = ", ".join(sorted(task.id for task in server.active_tasks))
+                        print(f"Server {server.endpoint.url} - Current task IDs: {task_ids}")
 
         print("All servers finished processing.")
 
@@ -630,9 +1521,11 @@ def main():
     parser.add_argument('--image', required=False, default=None, help='path to an image that shall be processed')
     parser.add_argument('--think', action='store_true', help='forward a "think" flag to compatible backends')
     parser.add_argument('--no_think', action='store_true', help='forward a "no_think" flag to compatible backends')
+    parser.add_argument('--no_cache', action='store_true', help='bypass the response cache in cache/llm')
     
     # parse the arguments
     args = parser.parse_args()
+    set_response_cache(not args.no_cache)
     api_base = args.api_base.split(",") if "," in args.api_base else [args.api_base]
     endpoint_name = args.endpoint
     model_name = args.model
@@ -659,10 +1552,7 @@ def main():
                 )
             ]
     else:
-        endpoints = [
-            Endpoint(store_name=model_name, model_name=model_name, key="",
-                     url=f"{api_stub}/v1/chat/completions") for api_stub in api_base
-        ]
+        endpoints = [api_stub_endpoint(model_name, model_name, api_stub) for api_stub in api_base]
 
     # test if the endpoint is a multimodal model
     if test_vision(endpoints[0]):
@@ -0,0 +1,258 @@
+import time
+import asyncio
+import threading
+import aiohttp
+import llm_client
+from types import SimpleNamespace
+from typing import Optional, Tuple
+from llm_client import (
+    Endpoint, Task, Response, Server, ChatStream, ApiError,
+    build_chat_request, parse_chat_response, get_llm_url_stub, classify_status, parse_retry_after, retry_delay,
+    parse_rate_limit_headers, estimate_request_tokens, retry_base_delay, response_cache_lookup, response_cache_store,
+)
+
+# asyncio variant of the openai-api client and the LoadBalancer. All requests run as coroutines on one
+# event loop, so a single process can keep hundreds of requests in flight without a thread per request.
+
+def _connection_trace_config() -> aiohttp.TraceConfig:
+    """Trace config that measures the connection setup time of a request into its trace_request_ctx"""
+    async def on_connection_create_start(session, ctx, params):
+        ctx.trace_request_ctx.connect_t0 = time.time()
+
+    async def on_connection_create_end(session, ctx, params):
+        ctx.trace_request_ctx.connect_seconds += time.time() - ctx.trace_request_ctx.connect_t0
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    return trace_config
+
+def create_session(pool_size: int = 64) -> aiohttp.ClientSession:
+    """Create a client session with keep-alive connections; must be called inside the event loop"""
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=pool_size, ssl=False)
+    return aiohttp.ClientSession(connector=connector, trace_configs=[_connection_trace_config()])
+
+async def async_openai_api_chat(
+    session: aiohttp.ClientSession,
+    endpoint: Endpoint,
+    prompt: str = 'Hello World',
+    base64_image: str = None,
+    temperature: float = 0.0,
+    max_tokens: int = 32768,
+    stream: bool = True,
+    system_message: str = "You are a helpful assistant",
+    tools: list = None,
+    response_format: dict = None,
+    return_response_json: bool = False,
+    think = False,
+    no_think = False,
+    use_cache: bool = True
+) -> tuple:
+    """
+    Coroutine version of llm_client.openai_api_chat with the same arguments and the same return tuple.
+    The session must be created with create_session so the connection setup time can be measured.
+    """
+    headers, payload = build_chat_request(
+        endpoint, prompt, base64_image=base64_image, temperature=temperature, max_tokens=max_tokens, stream=stream,
+        system_message=system_message, tools=tools, response_format=response_format, think=think, no_think=no_think)
+    cache_key, cached_result = response_cache_lookup(payload, use_cache, return_response_json)
+    if cached_result is not None:
+        return cached_result
+
+    read_timeout = 600 # seconds
+    trace = SimpleNamespace(connect_t0=0.0, connect_seconds=0.0)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=60, sock_read=read_timeout)
+    try:
+        t0 = time.time()
+        chat_stream = ChatStream(endpoint, t0)
+        async with session.post(endpoint.url, headers=headers, json=payload, timeout=timeout, trace_request_ctx=trace) as response:
+            connect_seconds = trace.connect_seconds
+            ttfb_seconds = max(0.0, time.time() - t0 - connect_seconds)
+            rate_limits = parse_rate_limit_headers(response.headers)
+            if response.status >= 400:
+                body = (await response.text(errors="replace"))[:800].replace("\n", " ")
+                raise ApiError(f"API request failed to {endpoint.url}: {response.status} {response.reason} | Body: {body}",
+                               classify_status(response.status), response.status, parse_retry_after(response.headers.get("Retry-After")))
+            if stream:
+                timeouttime = t0 + read_timeout
+                async for chunk in response.content.iter_any(): # chunks as they arrive, not split into lines
+                    if time.time() > timeouttime: break # we simply silently terminate the stream after the timeout
+                    chat_stream.feed(chunk)
+                    if chat_stream.done: break
+                chat_stream.finish()
+                text = None
+            else:
+                text = await response.text(errors="replace")
+            t1 = time.time()
+    except asyncio.TimeoutError as e:
+        raise ApiError(f"Read timeout while calling {endpoint.url} (timeout=600s). "
+                       f"The model may be slow or the server overloaded.", "timeout") from e
+    except aiohttp.ClientError as e:
+        raise ApiError(f"API request failed to {endpoint.url}: {e} | Body: ", "connection") from e
+
+    if stream:
+        answer, total_tokens, token_per_second, usage_summary = chat_stream.result(endpoint, t1 - t0)
+        response_json = None
+    else:
+        answer, total_tokens, token_per_second, usage_summary, response_json = parse_chat_response(
+            endpoint, response.status, response.headers.get('Content-Type', ''), text or '', t1 - t0)
+    usage_summary["connect_seconds"] = connect_seconds
+    usage_summary["ttfb_seconds"] = ttfb_seconds
+    usage_summary["rate_limits"] = rate_limits
+    response_cache_store(cache_key, answer, total_tokens, token_per_second, usage_summary, t1 - t0, response_json,
+                         complete=not stream or chat_stream.complete())
+    if return_response_json:
+        return answer, total_tokens, token_per_second, usage_summary, t1 - t0, response_json
+    return answer, total_tokens, token_per_second, usage_summary, t1 - t0
+
+class AsyncLoadBalancer:
+    """
+    Drop-in replacement for llm_client.LoadBalancer which runs all requests on one asyncio event loop.
+    The event loop runs in a background thread, so the balancer has the same synchronous interface:
+    add_server, add_task, start_distribution and wait_completion.
+    - Each request slot of a server is a worker coroutine which takes the next task from a shared queue,
+      so a slot picks up the next task as soon as its request is finished.
+    - The response_processing callback of a task is called in a worker thread so file writes do not block the loop.
+    - Servers can be added at any time, also while tasks are processed.
+    - Failed tasks are retried with exponential backoff like in the LoadBalancer; hedging is not supported.
+    - A worker only takes the next task when the rate limiter of its server has budget for it.
+    """
+    def __init__(self, max_queue_size: int = 1000, pool_size: int = None, max_retries: int = 4):
+        self.servers = []
+        self.outstanding_tasks = 0          # tasks added but not yet finished (processed or failed)
+        self.condition = threading.Condition()
+        self.pool_size = pool_size or llm_client.session_pool_size
+        self.max_retries = max_retries
+        self.expected_tokens = None # moving average of the total tokens of a response
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.workers = []
+        asyncio.run_coroutine_threadsafe(self._init(max_queue_size), self.loop).result()
+
+    async def _init(self, max_queue_size: int):
+        self.task_queue = asyncio.Queue(maxsize=max_queue_size)
+        self.session = create_session(self.pool_size)
+
+    def add_server(self, server: Server):
+        """Add a server to the load balancer; starts one worker coroutine per request slot"""
+        def start_workers():
+            self.servers.append(server)
+            for _ in range(server.max_concurrency):
+                self.workers.append(self.loop.create_task(self._worker(server)))
+        self.loop.call_soon_threadsafe(start_workers)
+        print(f"Server {get_llm_url_stub(server.endpoint)} added to async load balancer with {server.max_concurrency} slot(s).")
+
+    def add_task(self, task: Task) -> bool:
+        """Add a task to the processing queue with backpressure"""
+        with self.condition:
+            self.outstanding_tasks += 1
+        future = asyncio.run_coroutine_threadsafe(asyncio.wait_for(self.task_queue.put(task), timeout=1), self.loop)
+        try:
+            future.result()
+            return True
+        except asyncio.TimeoutError:
+            self.finish_task()
+            print("Task queue full - applying backpressure")
+            return False
+
+    def finish_task(self):
+        """Count a task as done; wakes up wait_completion when it was the last one"""
+        with self.condition:
+            self.outstanding_tasks -= 1
+            self.condition.notify_all()
+
+    def start_distribution(self):
+        """Nothing to do, the worker coroutines of the servers take the tasks from the queue"""
+        pass
+
+    async def _worker(self, server: Server):
+        while True:
+            # wait for rate limit budget before taking a task, so other servers can take it meanwhile
+            while (budget_wait := server.rate_limiter.wait_seconds(int(self.expected_tokens or 0))) > 0:
+                await asyncio.sleep(budget_wait)
+            task = await self.task_queue.get()
+            tokens = estimate_request_tokens(task, self.expected_tokens)
+            server.rate_limiter.acquire(tokens)
+            server.active_tasks.add(task)
+            error = None
+            used_tokens = 0
+            try:
+                error, used_tokens = await self.process_task_remote(server, task)
+            finally:
+                server.rate_limiter.settle(tokens, used_tokens)
+                if isinstance(error, ApiError) and error.kind == "rate_limit":
+                    server.rate_limiter.pause(error.retry_after if error.retry_after is not None else retry_base_delay)
+                server.active_tasks.discard(task)
+                self.task_queue.task_done()
+                delay = None if error is None else retry_delay(task, error, self.max_retries)
+                if delay is None:
+                    if error is not None: print(f"Giving up {task.description} after {task.attempts + 1} attempt(s): {error}")
+                    self.finish_task()
+                else:
+                    # the task stays outstanding while it waits for the retry
+                    print(f"Retrying {task.description} in {delay:.1f} seconds (attempt {task.attempts + 1} of {self.max_retries + 1}, {error.kind} error)")
+                    self.loop.call_later(delay, lambda task=task: self.loop.create_task(self.task_queue.put(task)))
+
+    async def process_task_remote(self, server: Server, task: Task) -> Tuple[Optional[Exception], int]:
+        """Process task on remote server; returns the error if it failed and the number of used tokens"""
+        endpoint = server.endpoint
+        try:
+            answer, total_tokens, token_per_second, usage_summary, duration_seconds = await async_openai_api_chat(
+                self.session,
+                endpoint,
+                task.prompt,
+                base64_image=task.base64_image,
+                think = task.think,
+                no_think = task.no_think
+            )
+            response = Response(
+                task,
+                answer,
+                total_tokens,
+                token_per_second,
+                duration_seconds=duration_seconds,
+                prompt_tokens=usage_summary.get("prompt_tokens"),
+                completion_tokens=usage_summary.get("completion_tokens"),
+                reasoning_tokens=usage_summary.get("reasoning_tokens"),
+                connect_seconds=usage_summary.get("connect_seconds"),
+                ttfb_seconds=usage_summary.get("ttfb_seconds"),
+                ttft_seconds=usage_summary.get("ttft_seconds"),
+                itl_p50_seconds=usage_summary.get("itl_p50_seconds"),
+                itl_p95_seconds=usage_summary.get("itl_p95_seconds"),
+                itl_p99_seconds=usage_summary.get("itl_p99_seconds"),
+                cached=bool(usage_summary.get("cached")),
+            )
+            if not response.cached: server.record_response(duration_seconds, token_per_second)
+            server.rate_limiter.update(usage_summary.get("rate_limits"))
+            if total_tokens:
+                self.expected_tokens = total_tokens if self.expected_tokens is None else \
+                    0.3 * total_tokens + 0.7 * self.expected_tokens
+            await asyncio.to_thread(task.response_processing, response)
+            print(f"Processed {task.description}, on {server.endpoint.url} with model {endpoint.model_name} in {duration_seconds:.2f} seconds with {total_tokens} tokens ({token_per_second:.2f} tokens/sec){' from cache' if response.cached else ''}")
+            return None, 0 if response.cached else total_tokens
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            print(f"Failed to process task ID {task.id} on {server.endpoint}: {str(e)}")
+            return e, 0
+
+    def wait_completion(self, status_interval: float = 60.0):
+        """Wait for all tasks to be processed; returns as soon as the last response is processed"""
+        print("Waiting for all servers to finish processing...")
+        with self.condition:
+            while self.outstanding_tasks > 0:
+                if self.condition.wait(timeout=status_interval): continue
+                print(f"Still waiting for servers to finish, {self.outstanding_tasks} tasks outstanding...")
+                for server in list(self.servers):
+                    task_ids = ", ".join(sorted(task.id for task in list(server.active_tasks)))
+                    if task_ids: print(f"Server {server.endpoint.url} - Current task IDs: {task_ids}")
+        print("All servers finished processing.")
+
+    def close(self):
+        """Cancel the workers, close the connections and stop the event loop"""
+        async def shutdown():
+            for worker in self.workers: worker.cancel()
+            await asyncio.gather(*self.workers, return_exceptions=True)
+            await self.session.close()
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
@@ -0,0 +1,186 @@
+import threading
+from collections import deque
+from dataclasses import replace
+from typing import Dict, List, Optional, Set, Tuple
+from llm_client import (
+    Endpoint, Task, Response, Server,
+    openai_api_chat, warm_up_endpoint, ollama_loaded_models, get_llm_url_stub, retry_delay,
+)
+
+# Scheduler for sweeps over many models (--allmodels) on a cluster of servers which can load any model, like ollama.
+# Instead of switching all servers to the same model at the same time, every server works on its own model
+# and only switches when the work for its model is done, so each model is loaded as few times as possible.
+
+class ClusterScheduler:
+    """
+    Runs the tasks of many models on servers which can switch between models.
+    - Every task names its model in task.model; the tasks are kept in one queue per model in the order they were added.
+    - Each server remembers the model it has loaded (server.loaded_model, initially read from ollama /api/ps)
+      and takes tasks of that model into its free slots as long as there are any.
+    - A server switches the model only when no task of its model is waiting and all of its slots are idle.
+      It takes the model with the most waiting tasks per server already working on it, so different servers work
+      on different models at the same time. A model which is served by other servers is only joined if at least
+      a full batch (max_concurrency tasks) is waiting for it, otherwise the swap costs more than it helps.
+    - A switch pulls and loads the model with a warm-up request; tasks of a model which cannot be loaded on any
+      server are given up.
+    - Failed tasks are retried with exponential backoff like in the LoadBalancer. Rate limits and hedging are not
+      supported, the scheduler is meant for local servers.
+    """
+    def __init__(self, endpoints: List[Endpoint], max_retries: int = 4, warm_up_attempts: int = 3):
+        self.servers = [Server(endpoint=endpoint) for endpoint in endpoints]
+        self.queues: Dict[str, deque] = {}          # waiting tasks per model
+        self.outstanding: Dict[str, int] = {}       # tasks per model which are waiting, running or waiting for a retry
+        self.switching: Dict[Server, str] = {}      # servers which are loading a model
+        self.failed_loads: Set[Tuple[Server, str]] = set()
+        self.max_retries = max_retries
+        self.warm_up_attempts = warm_up_attempts
+        self.swaps = 0
+        self.condition = threading.Condition()
+
+    def add_task(self, task: Task):
+        """Queue a task; task.model must name the model of the task"""
+        with self.condition:
+            self.queues.setdefault(task.model, deque()).append(task)
+            self.outstanding[task.model] = self.outstanding.get(task.model, 0) + 1
+            self.condition.notify_all()
+
+    def start(self):
+        """Read the loaded models of the servers and start one dispatcher thread per server; add the tasks before"""
+        for server in self.servers:
+            loaded = ollama_loaded_models(server.endpoint)
+            with self.condition:
+                # prefer a loaded model with waiting tasks, so the sweep starts without a swap
+                server.loaded_model = next((model for model in loaded if self.queues.get(model)), loaded[0] if loaded else None)
+            print(f"Server {get_llm_url_stub(server.endpoint)} added to cluster scheduler with {server.max_concurrency} slot(s)"
+                  f"{f', model {server.loaded_model} is loaded' if server.loaded_model else ''}.")
+            threading.Thread(target=self._dispatcher, args=(server,), daemon=True).start()
+
+    def _remaining(self) -> int:
+        return sum(self.outstanding.values())
+
+    def _next_task(self, server: Server) -> Optional[Task]:
+        """Take a waiting task of the loaded model of the server if it has a free slot; must be called with the lock held"""
+        waiting = self.queues.get(server.loaded_model)
+        if server.free_slots() <= 0 or not waiting: return None
+        task = waiting.popleft()
+        server.active_tasks.add(task)
+        return task
+
+    def _choose_model(self, server: Server) -> Optional[str]:
+        """Select the model an idle server switches to; must be called with the lock held"""
+        best_model, best_score = None, 0.0
+        for model, waiting in self.queues.items():
+            if not waiting or (server, model) in self.failed_loads: continue
+            serving = sum(1 for other in self.servers
+                          if other is not server and (other.loaded_model == model or self.switching.get(other) == model))
+            if serving > 0 and len(waiting) < server.max_concurrency: continue
+            score = len(waiting) / (serving + 1)
+            if score > best_score: best_model, best_score = model, score
+        return best_model
+
+    def _dispatcher(self, server: Server):
+        while True:
+            task, model = None, None
+            with self.condition:
+                while task is None and model is None:
+                    if self._remaining() == 0: return
+                    task = self._next_task(server)
+                    if task is None and not server.active_tasks:
+                        model = self._choose_model(server)
+                    if task is None and model is None:
+                        self.condition.wait() # woken up by finished requests, retries and model switches
+                if model is not None:
+                    self.switching[server] = model
+            if task is not None:
+                threading.Thread(target=self.process_task_remote, args=(server, task), daemon=True).start()
+            else:
+                self._switch_model(server, model)
+
+    def _switch_model(self, server: Server, model: str):
+        """Pull and load the model on the server; gives up the tasks of the model if no server can load it"""
+        print(f"Switching server {get_llm_url_stub(server.endpoint)} from model {server.loaded_model} to {model}")
+        loaded = warm_up_endpoint(replace(server.endpoint, model_name=model), attempts=self.warm_up_attempts)
+        with self.condition:
+            del self.switching[server]
+            if loaded:
+                server.loaded_model = model
+                self.swaps += 1
+            else:
+                self.failed_loads.add((server, model))
+                if all((other, model) in self.failed_loads for other in self.servers):
+                    waiting = self.queues[model]
+                    print(f"Giving up {len(waiting)} task(s) of model {model}, it could not be loaded on any server")
+                    self.outstanding[model] -= len(waiting)
+                    waiting.clear()
+            self.condition.notify_all()
+
+    def process_task_remote(self, server: Server, task: Task):
+        """Process task on remote server with the model of the task"""
+        endpoint = replace(server.endpoint, model_name=task.model)
+        error = None
+        try:
+            answer, total_tokens, token_per_second, usage_summary, duration_seconds = openai_api_chat(
+                endpoint,
+                task.prompt,
+                base64_image=task.base64_image,
+                think = task.think,
+                no_think = task.no_think
+            )
+            response = Response(
+                task,
+                answer,
+                total_tokens,
+                token_per_second,
+                duration_seconds=duration_seconds,
+                prompt_tokens=usage_summary.get("prompt_tokens"),
+                completion_tokens=usage_summary.get("completion_tokens"),
+                reasoning_tokens=usage_summary.get("reasoning_tokens"),
+                connect_seconds=usage_summary.get("connect_seconds"),
+                ttfb_seconds=usage_summary.get("ttfb_seconds"),
+                ttft_seconds=usage_summary.get("ttft_seconds"),
+                itl_p50_seconds=usage_summary.get("itl_p50_seconds"),
+                itl_p95_seconds=usage_summary.get("itl_p95_seconds"),
+                itl_p99_seconds=usage_summary.get("itl_p99_seconds"),
+                cached=bool(usage_summary.get("cached")),
+            )
+            if not response.cached:
+                with self.condition: server.record_response(duration_seconds, token_per_second)
+            task.response_processing(response)
+            print(f"Processed {task.description}, on {server.endpoint.url} with model {task.model} in {duration_seconds:.2f} seconds with {total_tokens} tokens ({token_per_second:.2f} tokens/sec){' from cache' if response.cached else ''}")
+        except Exception as e:
+            error = e
+            import traceback
+            traceback.print_exc()
+            print(f"Failed to process task ID {task.id} on {server.endpoint.url} with model {task.model}: {str(e)}")
+        finally:
+            delay = None if error is None else retry_delay(task, error, self.max_retries)
+            with self.condition:
+                server.active_tasks.discard(task)
+                if delay is None:
+                    if error is not None: print(f"Giving up {task.description} after {task.attempts + 1} attempt(s): {error}")
+                    self.outstanding[task.model] -= 1
+                else:
+                    # the task stays outstanding while it waits for the retry
+                    print(f"Retrying {task.description} in {delay:.1f} seconds (attempt {task.attempts + 1} of {self.max_retries + 1}, {error.kind} error)")
+                    timer = threading.Timer(delay, self._requeue, args=(task,))
+                    timer.daemon = True
+                    timer.start()
+                self.condition.notify_all()
+
+    def _requeue(self, task: Task):
+        with self.condition:
+            self.queues[task.model].appendleft(task)
+            self.condition.notify_all()
+
+    def wait_completion(self, status_interval: float = 60.0):
+        """Wait for all tasks of all models to be processed"""
+        print("Waiting for all servers to finish processing...")
+        with self.condition:
+            while self._remaining() > 0:
+                if self.condition.wait(timeout=status_interval): continue
+                print(f"Still waiting for servers to finish, {self._remaining()} tasks outstanding...")
+                for server in self.servers:
+                    model = self.switching.get(server)
+                    status = f"loading model {model}" if model else f"model {server.loaded_model}, {len(server.active_tasks)} running task(s)"
+                    print(f"Server {server.endpoint.url} - {status}")
+        print(f"All servers finished processing with {self.swaps} model switch(es).")
@@ -0,0 +1,140 @@
+import json
+import time
+import random
+import threading
+from typing import List
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from llm_client import Endpoint, LoadBalancer, Server, Task, Response, set_response_cache
+
+# Microbenchmark for the LoadBalancer: starts a number of stub OpenAI-API servers on localhost
+# which answer after a fixed (or jittered) latency, pushes a batch of tasks through the balancer
+# and measures how long a freed server stays idle before it receives the next task.
+
+class StubServer:
+    """A stub /v1/chat/completions server that records request arrival and response end times"""
+    def __init__(self, latency: float, jitter: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.events = [] # (arrival_time, finish_time) tuples
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"   # keep-alive, like the real inference servers
+            disable_nagle_algorithm = True  # otherwise header and body writes wait for delayed ACKs
+
+            def do_POST(self):
+                arrival = time.perf_counter()
+                length = int(self.headers.get('Content-Length', 0))
+                request = json.loads(self.rfile.read(length) or b'{}')
+                time.sleep(max(0.0, stub.latency + random.uniform(-stub.jitter, stub.jitter)))
+                if request.get("stream"):
+                    body = (
+                        'data: {"choices":[{"delta":{"content":"42"}}]}\n\n'
+                        'data: {"choices":[],"usage":{"prompt_tokens":10,"completion_tokens":1,"total_tokens":11}}\n\n'
+                        'data: [DONE]\n\n'
+                    ).encode('utf-8')
+                    content_type = "text/event-stream"
+                else:
+                    body = json.dumps({
+                        "choices": [{"message": {"role": "assistant", "content": "42"}}],
+                        "usage": {"prompt_tokens": 10, "completion_tokens": 1, "total_tokens": 11},
+                    }).encode('utf-8')
+                    content_type = "application/json"
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                self.wfile.flush()
+                with stub.lock:
+                    stub.events.append((arrival, time.perf_counter()))
+
+            def log_message(self, format, *args):
+                pass # keep the benchmark output readable
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}/v1/chat/completions"
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def idle_gaps(self) -> List[float]:
+        """gaps between the end of one response and the arrival of the next request"""
+        with self.lock:
+            events = sorted(self.events)
+        return [max(0.0, events[i + 1][0] - events[i][1]) for i in range(len(events) - 1)]
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def percentile(values: List[float], p: float) -> float:
+    if not values: return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100.0 * (len(values) - 1)))))
+    return values[index]
+
+def run_benchmark(servers: int, tasks: int, latency: float, jitter: float, slots: int = 1,
+                  slow_servers: int = 0, slow_factor: float = 1.0, policy: str = "throughput", engine: str = "threads") -> dict:
+    set_response_cache(False) # the stub requests are deterministic, cached answers would not reach the servers
+    stubs = [StubServer(latency * (slow_factor if i < slow_servers else 1.0), jitter) for i in range(servers)]
+    if engine == "async":
+        from llm_client_async import AsyncLoadBalancer # needs aiohttp
+        lb = AsyncLoadBalancer()
+    else:
+        lb = LoadBalancer(policy=policy)
+    lb.start_distribution()
+    for stub in stubs:
+        lb.add_server(Server(endpoint=Endpoint(store_name="stub", model_name="stub", key="", url=stub.url, max_concurrency=slots)))
+
+    def ignore_response(response: Response):
+        pass
+
+    t0 = time.perf_counter()
+    for i in range(tasks):
+        task = Task(id=f"{i:04d}", description=f"stub task {i}", prompt="What is 6*7?",
+                    base64_image=None, response_processing=ignore_response)
+        while not lb.add_task(task): pass
+    lb.wait_completion()
+    wall = time.perf_counter() - t0
+    if engine == "async": lb.close()
+
+    gaps = [gap for stub in stubs for gap in stub.idle_gaps()]
+    first_arrival = min((event[0] for stub in stubs for event in stub.events), default=t0)
+    last_finish = max((event[1] for stub in stubs for event in stub.events), default=t0)
+    for stub in stubs: stub.shutdown()
+    ideal = tasks / sum(slots / stub.latency for stub in stubs)
+    return {
+        "wall_seconds": wall,
+        "ideal_seconds": ideal,
+        "overhead_seconds": wall - ideal,
+        "first_dispatch_seconds": first_arrival - t0,
+        "completion_detection_seconds": max(0.0, t0 + wall - last_finish),
+        "idle_gap_mean_ms": 1000.0 * sum(gaps) / len(gaps) if gaps else 0.0,
+        "idle_gap_p50_ms": 1000.0 * percentile(gaps, 50),
+        "idle_gap_p95_ms": 1000.0 * percentile(gaps, 95),
+        "idle_gap_max_ms": 1000.0 * max(gaps) if gaps else 0.0,
+        "idle_total_seconds": sum(gaps),
+    }
+
+def main():
+    parser = ArgumentParser(description="Measure dispatch latency and idle gaps of the LoadBalancer against stub servers.")
+    parser.add_argument('--servers', type=int, default=4, help='number of stub servers, default is 4')
+    parser.add_argument('--tasks', type=int, default=200, help='number of tasks to distribute, default is 200')
+    parser.add_argument('--latency', type=float, default=0.05, help='response latency of a stub server in seconds, default is 0.05')
+    parser.add_argument('--jitter', type=float, default=0.0, help='random jitter added to the latency in seconds, default is 0.0')
+    parser.add_argument('--slots', type=int, default=1, help='parallel request slots per stub server, default is 1')
+    parser.add_argument('--slow_servers', type=int, default=0, help='number of stub servers which are slower than the others, default is 0')
+    parser.add_argument('--slow_factor', type=float, default=4.0, help='latency factor of the slow stub servers, default is 4.0')
+    parser.add_argument('--policy', required=False, default='throughput', choices=LoadBalancer.POLICIES, help='scheduling policy of the load balancer, default is throughput')
+    parser.add_argument('--engine', required=False, default='threads', choices=('threads', 'async'), help='"threads" uses the LoadBalancer, "async" the AsyncLoadBalancer, default is threads')
+    args = parser.parse_args()
+
+    result = run_benchmark(args.servers, args.tasks, args.latency, args.jitter, slots=args.slots,
+                           slow_servers=args.slow_servers, slow_factor=args.slow_factor, policy=args.policy, engine=args.engine)
+    print(f"{args.tasks} tasks on {args.servers} stub servers with {args.slots} slot(s) and {args.latency * 1000:.0f}ms latency:")
+    for key, value in result.items():
+        print(f"  {key}: {value:.4f}")
+
+if __name__ == "__main__":
+    main()
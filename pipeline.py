@@ -0,0 +1,152 @@
+import os
+import json
+import threading
+import multiprocessing
+from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from llm_client import Response
+from codeextraction import extract_code_block, get_extension
+from execute import (
+    run_solution, evaluate_solutions, execution_cache, source_hash, read_solutions_meta, write_solutions_meta,
+    write_solutions_profile, is_recorded, meta_record,
+)
+from inference import build_endpoints, ensure_model_capabilities, process_problem_files, read_template, resolve_store_name
+
+# In-process pipeline for test.py --pipeline: every answer of the model goes through the code extraction into a
+# bounded pool of executors and is scored as soon as its output is known. The code execution runs on the CPU
+# while the servers are still generating the next answers, so a run ends soon after the last answer arrives.
+
+class SolutionPipeline:
+    """
+    Extract, execute and score the solutions of one model for several languages while the inference is running.
+    - submit() writes the code of an answer to solutions/<store_name>/<language>/NNNN.<ext> like codeextraction.py
+      and queues its execution; at most max_pending executions are queued, submit() blocks when the pool is full.
+    - Every finished execution is added to the solutions.json of its language, which is rewritten after each
+      result like in execute.py together with solutions_profile.json, and the running score of the language is printed.
+    - finish() waits for all executions and updates benchmark.json with evaluate_solutions.
+    """
+    def __init__(self, store_name: str, languages: List[str], max_problem_number: int, expected_solutions: dict,
+                 workers: int = None, max_pending: int = None):
+        self.store_name = store_name
+        self.languages = languages
+        self.max_problem_number = max_problem_number
+        self.expected_solutions = expected_solutions
+        workers = workers or multiprocessing.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.slots = threading.BoundedSemaphore(max_pending or 4 * workers) # bounds the queued executions
+        self.lock = threading.Lock()
+        self.solutions: Dict[str, dict] = {language: {} for language in languages}
+        self.profiles: Dict[str, dict] = {language: {} for language in languages}
+        self.meta: Dict[str, dict] = {language: read_solutions_meta(self._results_dir(language)) for language in languages}
+        self.futures = []
+        self.existing_thread = None
+
+    def submit(self, language: str, problem_number: str, markdown_content: str):
+        """Extract the code of an answer and queue its execution"""
+        if int(problem_number) > self.max_problem_number: return
+        extension = get_extension(language)
+        code_block = extract_code_block(markdown_content, language, extension)
+        program_file_path = os.path.join('solutions', self.store_name, language, f"{problem_number}.{extension}")
+        with open(program_file_path, 'w', encoding='utf-8') as language_file:
+            language_file.write(code_block)
+        self.slots.acquire()
+        self.futures.append(self.executor.submit(self._execute, language, problem_number, program_file_path))
+
+    def submit_response(self, language: str, response: Response):
+        """on_response hook for inference.process_problem_files"""
+        self.submit(language, response.task.id, response.result)
+
+    def submit_existing(self):
+        """
+        Queue the answers which are already stored in a background thread, so the inference can start meanwhile.
+        The answers are listed before the inference starts; a new answer is submitted by the on_response hook only.
+        """
+        existing = []
+        for language in self.languages:
+            language_dir = os.path.join('solutions', self.store_name, language)
+            if not os.path.isdir(language_dir): continue
+            for markdown_file in sorted(os.listdir(language_dir)):
+                if not markdown_file.endswith('.md') or not markdown_file[:-3].isdigit(): continue
+                existing.append((language, markdown_file[:-3], os.path.join(language_dir, markdown_file)))
+        def submit_files():
+            for language, problem_number, markdown_path in existing:
+                with open(markdown_path, 'r', encoding='utf-8') as file:
+                    self.submit(language, problem_number, file.read())
+        self.existing_thread = threading.Thread(target=submit_files, daemon=True)
+        self.existing_thread.start()
+
+    def _results_dir(self, language: str) -> str:
+        return os.path.join('solutions', self.store_name, language)
+
+    def _execute(self, language: str, problem_number: str, program_file_path: str):
+        try:
+            # a file which did not change since its last execution keeps its output
+            program_file = os.path.basename(program_file_path)
+            content_hash = source_hash(program_file_path)
+            with self.lock:
+                recorded = self.meta[language].get(program_file)
+            if is_recorded(recorded, content_hash, language):
+                output = recorded.get('output', '')
+                profile = recorded.get('profile', {})
+                cacheable = True
+                print(f"Unchanged {program_file_path}: {output}")
+            else:
+                profile = {}
+                output, cacheable = run_solution(program_file_path, self.expected_solutions.get(problem_number, None), profile=profile)
+            with self.lock:
+                solutions = self.solutions[language]
+                solutions[problem_number] = output
+                self.profiles[language][problem_number] = profile
+                solutions_json_path = os.path.join(self._results_dir(language), 'solutions.json')
+                with open(solutions_json_path, 'w', encoding='utf-8') as json_file:
+                    json.dump(dict(sorted(solutions.items())), json_file, indent=4)
+                record = meta_record(content_hash, language, output, profile, cacheable)
+                if record: self.meta[language][program_file] = record
+                else: self.meta[language].pop(program_file, None)
+                write_solutions_meta(self._results_dir(language), self.meta[language])
+                write_solutions_profile(self._results_dir(language), self.profiles[language])
+                self._print_score(language)
+        except Exception as e:
+            print(f"Failed to execute {program_file_path}: {e}")
+        finally:
+            self.slots.release()
+
+    def _print_score(self, language: str):
+        """print the running score of a language; must be called with the lock held"""
+        solutions = self.solutions[language]
+        correct = [p for p, output in solutions.items() if output == self.expected_solutions.get(p, {}).get('solution')]
+        points = sum(self.expected_solutions[p].get('points', 0) for p in correct)
+        print(f"Score {self.store_name} {language}: {len(correct)} of {len(solutions)} executed solutions correct, "
+              f"{points} points")
+
+    def finish(self):
+        """Wait for all executions and write the scores of the complete languages to benchmark.json"""
+        if self.existing_thread: self.existing_thread.join()
+        for future in self.futures: future.result()
+        self.executor.shutdown()
+        print(execution_cache.report())
+        for language in self.languages:
+            print(f"Evaluating {len(self.solutions[language])} {language} solutions of {self.store_name}")
+            evaluate_solutions(dict(sorted(self.solutions[language].items())), self.store_name, language,
+                               self.max_problem_number, self.expected_solutions, profiles=self.profiles[language])
+
+def run_pipeline(api_base: List[str], endpoint_name: str, model_name: str, languages: List[str], max_problem_number: int,
+                 overwrite_existing=False, overwrite_failed=False, think=False, no_think=False, workers: int = None):
+    """Run inference, code extraction, execution and scoring of one model in one process"""
+    store_name = resolve_store_name(model_name, think=think, no_think=no_think)
+    endpoints = build_endpoints(api_base, endpoint_name, store_name, model_name)
+    ensure_model_capabilities(endpoints[0], think = think, no_think = no_think)
+    store_name = endpoints[0].store_name
+    with open('solutions.json', 'r', encoding='utf-8') as json_file:
+        expected_solutions = json.load(json_file)
+    templates = {language: read_template(os.path.join('templates', 'template_' + language + '.md')) for language in languages}
+
+    pipeline = SolutionPipeline(store_name, languages, max_problem_number, expected_solutions, workers=workers)
+    if not overwrite_existing and not overwrite_failed:
+        # the inference skips the problems which have an answer, so their stored answers are executed right away
+        pipeline.submit_existing()
+    process_problem_files('problems', templates, endpoints, languages, max_problem_number = max_problem_number,
+                          overwrite_existing = overwrite_existing, overwrite_failed = overwrite_failed,
+                          expected_solutions = expected_solutions, think = think, no_think = no_think,
+                          on_response = pipeline.submit_response)
+    pipeline.finish()
@@ -0,0 +1,272 @@
+import json
+import os
+import sys
+import time
+import signal
+import subprocess
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import List, Optional
+
+try:
+    import resource # unix only; without it programs run without limits and without profile
+except ImportError:
+    resource = None
+
+# Resource isolation for the executed solutions: every program runs pinned to one cpu core with limits on
+# address space, cpu time and processes, and its peak memory and cpu time are measured with os.wait4 in a small
+# spawner process, so the measurement does not include the memory of the calling script.
+# Pinning one job per core avoids oversubscription, so the measured times are reproducible.
+
+MEMORY_LIMIT_MB = 2048      # address space of a program; the JVM gets -Xmx instead because it reserves much more
+CPU_LIMIT_SECONDS = 30      # cpu time of a program; the wall clock timeout of the executors is usually shorter
+PROCESS_ALLOWANCE = 256     # processes and threads a program may start in addition to those of the user
+JVM_HEAP_MB = 1024          # -Xmx of java and clojure programs
+
+class CorePool:
+    """The cpu cores this process may use; a job takes one core for its program and gives it back afterwards"""
+    def __init__(self):
+        self.cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        self.free = list(self.cores)
+        self.condition = threading.Condition()
+
+    @contextmanager
+    def core(self):
+        """Take a free core for the duration of the block; yields None where pinning is not supported"""
+        if not self.cores:
+            yield None
+            return
+        with self.condition:
+            self.condition.wait_for(lambda: self.free)
+            core = self.free.pop(0)
+        try:
+            yield core
+        finally:
+            with self.condition:
+                self.free.append(core)
+                self.condition.notify()
+
+core_pool = CorePool()
+
+def pin_process(pid: int, core: Optional[int]):
+    """
+    Pin all threads of a running process and of its child processes to a core, e.g. the java started by the clj
+    launcher; threads started later inherit the core of their creator
+    """
+    if core is None or not hasattr(os, "sched_setaffinity"): return
+    try:
+        threads = [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+    except OSError:
+        threads = [pid]
+    for tid in threads:
+        try:
+            os.sched_setaffinity(tid, {core})
+            with open(f"/proc/{pid}/task/{tid}/children") as file:
+                children = [int(child) for child in file.read().split()]
+        except OSError:
+            continue # the thread ended meanwhile
+        for child in children:
+            pin_process(child, core)
+
+def user_thread_count() -> int:
+    """Number of threads of the current user; RLIMIT_NPROC counts all of them, not only the children"""
+    uid = os.getuid()
+    count = 0
+    for pid in os.listdir("/proc") if os.path.isdir("/proc") else []:
+        if not pid.isdigit(): continue
+        try:
+            if os.stat(f"/proc/{pid}").st_uid == uid:
+                count += len(os.listdir(f"/proc/{pid}/task"))
+        except OSError:
+            pass # the process ended while counting
+    return count
+
+def address_space_mb() -> int:
+    """Current address space of this process in MB; 0 where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as file:
+            return int(file.read().split()[0]) * os.sysconf("SC_PAGE_SIZE") >> 20
+    except (OSError, ValueError):
+        return 0
+
+def apply_limits(core: Optional[int] = None, memory_mb: Optional[int] = MEMORY_LIMIT_MB,
+                 cpu_seconds: Optional[int] = CPU_LIMIT_SECONDS, max_processes: Optional[int] = None):
+    """Pin the calling process to a core and set its resource limits; called in the child before the program starts"""
+    if core is not None and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {core})
+    if resource is None: return
+    if memory_mb:
+        resource.setrlimit(resource.RLIMIT_AS, (memory_mb << 20, memory_mb << 20))
+    if cpu_seconds:
+        # the soft limit sends SIGXCPU, the hard limit one second later SIGKILL
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu_seconds, cpu_seconds + 1))
+    if max_processes:
+        resource.setrlimit(resource.RLIMIT_NPROC, (max_processes, max_processes))
+
+def spawn_program(request: dict) -> dict:
+    """
+    Run one program for the program spawner: fork, set the limits in the child and exec the program, kill its
+    process group on timeout and reap it with os.wait4. Returns the output, the profile and the errno if the
+    program could not be started.
+    """
+    stdout, stderr = tempfile.TemporaryFile(), tempfile.TemporaryFile() # files can not block the program like pipes
+    error_read, error_write = os.pipe() # closed by the exec; receives the errno if the exec failed
+    t0 = time.time()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.close(error_read)
+            os.setpgid(0, 0) # own process group, so a timeout kills the children too
+            os.dup2(os.open(os.devnull, os.O_RDONLY), 0)
+            os.dup2(stdout.fileno(), 1)
+            os.dup2(stderr.fileno(), 2)
+            os.chdir(request["cwd"])
+            try:
+                apply_limits(request["core"], request["memory_mb"], request["cpu_seconds"], request["max_processes"])
+            except ValueError:
+                pass # a limit above the hard limit of the user; the program runs with the hard limit
+            os.execvp(request["args"][0], request["args"])
+        except OSError as exc:
+            os.write(error_write, str(exc.errno or 0).encode())
+        finally:
+            os._exit(127)
+    os.close(error_write)
+    try:
+        os.setpgid(pid, pid) # also in the parent, so the timeout can not come before the child has its group
+    except OSError:
+        pass
+    timed_out = False
+    def kill(signum, frame):
+        nonlocal timed_out
+        timed_out = True
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except OSError:
+            pass
+    if request["timeout"]:
+        signal.signal(signal.SIGALRM, kill)
+        signal.setitimer(signal.ITIMER_REAL, request["timeout"])
+    try:
+        _, status, rusage = os.wait4(pid, 0)
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+    wall_seconds = time.time() - t0
+    with os.fdopen(error_read, "rb") as error_file:
+        error = error_file.read()
+    output = {}
+    for name, file in (("stdout", stdout), ("stderr", stderr)):
+        file.seek(0)
+        output[name] = file.read().decode("utf-8", errors="replace")
+        file.close()
+    return {
+        **output,
+        "errno": int(error) if error else None,
+        "timed_out": timed_out,
+        "profile": profile_from_rusage(rusage, wall_seconds, os.waitstatus_to_exitcode(status)),
+    }
+
+def program_spawner_main():
+    """
+    Main loop of a program spawner process: reads one json request per line from stdin and writes one json reply
+    per line to stdout. The spawner is a small interpreter which only imports this module, so the programs it forks
+    start with its small resident size instead of the size of the calling script; linux counts the peak rss of the
+    process which forked a program as peak rss of the program too.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN) # ctrl-c is handled by the calling process
+    for line in sys.stdin:
+        request = json.loads(line)
+        if request["max_processes"] == "threads":
+            request["max_processes"] = user_thread_count() + PROCESS_ALLOWANCE
+        sys.stdout.write(json.dumps(spawn_program(request)) + "\n")
+        sys.stdout.flush()
+
+class ProgramSpawnerPool:
+    """
+    Warm program spawner processes for run_limited, one per concurrent execution. A spawner only runs one program at
+    a time, so it is single threaded and may set the limits between fork and exec.
+    """
+    def __init__(self):
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def _checkout(self) -> subprocess.Popen:
+        with self.lock:
+            if self.idle: return self.idle.pop()
+        # -I -S: no site packages and no environment, the spawner only needs the standard library
+        return subprocess.Popen(
+            [sys.executable, "-I", "-S", os.path.realpath(__file__)], stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            text=True, encoding="utf-8", start_new_session=True)
+
+    def run(self, request: dict) -> dict:
+        """Run a program with a spawner; raises OSError if the spawner failed"""
+        spawner = self._checkout()
+        try:
+            spawner.stdin.write(json.dumps(request) + "\n")
+            spawner.stdin.flush()
+            line = spawner.stdout.readline()
+            if not line: raise OSError("The program spawner ended unexpectedly")
+            reply = json.loads(line)
+        except (OSError, ValueError):
+            spawner.kill()
+            spawner.wait()
+            raise
+        with self.lock:
+            self.idle.append(spawner)
+        return reply
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for spawner in idle:
+            spawner.stdin.close() # the spawner ends at the end of its input
+            spawner.wait()
+
+program_spawner_pool = ProgramSpawnerPool()
+
+def run_limited(args: List[str], timeout: Optional[float] = None, memory_mb: Optional[int] = MEMORY_LIMIT_MB,
+                cpu_seconds: Optional[int] = CPU_LIMIT_SECONDS, profile: dict = None) -> subprocess.CompletedProcess:
+    """
+    Run a program like subprocess.run(args, capture_output=True, text=True, timeout=timeout) on a core of its own with
+    resource limits. Raises subprocess.TimeoutExpired after the program (with all its children) was killed on timeout.
+    If a profile dict is given, it is filled with wall_seconds, cpu_seconds, peak_rss_mb, exit_status and timed_out.
+    The program is started by a program spawner, so peak_rss_mb does not depend on the memory of the calling script.
+    """
+    # RLIMIT_NPROC counts all threads of the user; the spawner counts them right before the start
+    max_processes = "threads" if resource is not None and os.getuid() != 0 else None
+    with core_pool.core() as core:
+        reply = program_spawner_pool.run({
+            "args": list(args), "cwd": os.getcwd(), "timeout": timeout, "core": core,
+            "memory_mb": memory_mb, "cpu_seconds": cpu_seconds, "max_processes": max_processes})
+    if reply["errno"] is not None:
+        raise OSError(reply["errno"], os.strerror(reply["errno"]), args[0])
+    if profile is not None:
+        profile.update(reply["profile"])
+        profile["timed_out"] = reply["timed_out"]
+    if reply["timed_out"]:
+        raise subprocess.TimeoutExpired(args, timeout, reply["stdout"], reply["stderr"])
+    return subprocess.CompletedProcess(args, reply["profile"]["exit_status"], reply["stdout"], reply["stderr"])
+
+def rss_mb(maxrss: int) -> float:
+    """MB of a ru_maxrss value, which is in kilobytes on linux and in bytes on macos"""
+    return round(maxrss / (1 << 20) if sys.platform == "darwin" else maxrss / 1024, 1)
+
+def peak_rss_self() -> int:
+    """ru_maxrss of the calling process; 0 where the resource module is not available"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource is not None else 0
+
+def profile_from_rusage(rusage, wall_seconds: float, exit_status: Optional[int]) -> dict:
+    """Profile values from a resource usage struct"""
+    return {
+        "wall_seconds": round(wall_seconds, 4),
+        "cpu_seconds": round(rusage.ru_utime + rusage.ru_stime, 4),
+        "peak_rss_mb": rss_mb(rusage.ru_maxrss),
+        "exit_status": exit_status,
+    }
+
+def jvm_options(heap_mb: int = JVM_HEAP_MB) -> List[str]:
+    """JVM options which limit the heap; the address space of a JVM cannot be limited with RLIMIT_AS"""
+    return [f"-Xmx{heap_mb}m"]
+
+if __name__ == "__main__":
+    program_spawner_main()
@@ -3,27 +3,37 @@ import json
 import shutil
 from argparse import ArgumentParser
 from benchmark import read_benchmark, write_benchmark
-from llm_client import openai_api_list, Endpoint
+from llm_client import openai_api_list, api_stub_endpoint, Endpoint
 
 def get_bench_name(language, max_problem_number, tool_mode=False):
     if tool_mode:
         return f"{language}-tool-{max_problem_number}"
     return f"{language}-{max_problem_number}"
 
-def test(api_base, endpoint_name, model_name, language, overwrite_existing, overwrite_failed, max_problem_number=100, think=False, no_think=False, tool_mode=False):
-    inference_script = "inference-with-tools.py" if tool_mode else "inference.py"
-
-    # call inference script
-    cmd = f"python3.12 {inference_script} --language {language} --api_base {api_base}"
-    cmd += f" --endpoint {endpoint_name}" if endpoint_name else f" --model {model_name}"
+def sweep_inference(api_base, languages, max_problem_number=100, think=False, no_think=False):
+    """run the inference of all models which are missing in benchmark.json in one run of the cluster scheduler"""
+    cmd = f"python3.12 inference.py --allmodels --language {','.join(languages)} --api_base {api_base}"
     if max_problem_number == 200: cmd += " --n200"
-    if overwrite_existing: cmd += " --overwrite_existing"
-    if overwrite_failed: cmd += " --overwrite_failed"
     if think: cmd += " --think"
     if no_think: cmd += " --no_think"
     print(f"Running command: {cmd}")
     os.system(cmd)
 
+def test(api_base, endpoint_name, model_name, language, overwrite_existing, overwrite_failed, max_problem_number=100, think=False, no_think=False, tool_mode=False, run_inference=True, java_worker=False, clojure_worker=False, exec_cache=True, exec_cache_mb=256, rust_opt_level='2', rust_compile_workers=0):
+    inference_script = "inference-with-tools.py" if tool_mode else "inference.py"
+
+    if run_inference:
+        # call inference script
+        cmd = f"python3.12 {inference_script} --language {language} --api_base {api_base}"
+        cmd += f" --endpoint {endpoint_name}" if endpoint_name else f" --model {model_name}"
+        if max_problem_number == 200: cmd += " --n200"
+        if overwrite_existing: cmd += " --overwrite_existing"
+        if overwrite_failed: cmd += " --overwrite_failed"
+        if think: cmd += " --think"
+        if no_think: cmd += " --no_think"
+        print(f"Running command: {cmd}")
+        os.system(cmd)
+
     if not tool_mode:
         # call codeextraction.py
         cmd = f"python3.12 codeextraction.py --language {language}"
@@ -39,14 +49,19 @@ def test(api_base, endpoint_name, model_name, language, overwrite_existing, over
         cmd += f" --endpoint {endpoint_name}" if endpoint_name else f" --model {model_name}"
         if think: cmd += " --think"
         if no_think: cmd += " --no_think"
+        if java_worker: cmd += " --java_worker"
+        if clojure_worker: cmd += " --clojure_worker"
+        if not exec_cache: cmd += " --no_exec_cache"
+        cmd += f" --exec_cache_mb {exec_cache_mb} --rust_opt_level {rust_opt_level}"
+        if rust_compile_workers: cmd += f" --rust_compile_workers {rust_compile_workers}"
         print(f"Running command: {cmd}")
         os.system(cmd)
 
 def main():
     parser = ArgumentParser(description="Run the complete pipeline to execute solutions and store results in a JSON file.")
-    parser.add_argument('--api', action='append', help="Specify (multiple) backend OpenAI API endpoints (i.e. ollama); can be used multiple times")
+    parser.add_argument('--api', action='append', help="Specify (multiple) backend OpenAI API endpoints (i.e. ollama); can be used multiple times. Append @<n> (i.e. http://host:8000@8) to send up to n requests in parallel to that server")
     parser.add_argument('--api_base', required=False, default='http://localhost:11434', help='API base URL for the LLM, default is http://localhost:11434')
-    parser.add_argument('--allmodels', action='store_true', help='loop over all models provided by ollama and run those which are missing in benchmark.json')
+    parser.add_argument('--allmodels', action='store_true', help='run all models provided by ollama which are missing in benchmark.json; the inference of all models runs at once on all servers')
     parser.add_argument('--model', required=False, default='llama3.2:latest', help='Name of the model to use, default is llama3.2:latest')
     parser.add_argument('--think', action='store_true', help='if set, the prompt will get an additional "/think" appended at the end')
     parser.add_argument('--no_think', action='store_true', help='if set, the prompt will get an additional "/no_think" appended at the end')
@@ -55,12 +70,22 @@ def main():
     parser.add_argument('--overwrite_failed', action='store_true', help='if set, re-calculate those problems with wrong answers')
     parser.add_argument('--endpoint', required=False, default='', help='Name of an <endpoint>.json file in the endpoints directory')
     parser.add_argument('--tool', action='store_true', help='use inference-with-tools.py and execute tool-prefixed source files')
+    parser.add_argument('--pipeline', action='store_true', help='run inference, code extraction, execution and scoring in one process; every answer is executed and scored as soon as it arrives')
+    parser.add_argument('--workers', type=int, default=0, help='number of parallel code executions in --pipeline mode, default is the number of cpu cores')
+    parser.add_argument('--java_worker', action='store_true', help='execute java solutions in long-lived worker JVMs instead of one javac and one java process per solution')
+    parser.add_argument('--clojure_worker', action='store_true', help='evaluate clojure solutions in warm worker runtimes instead of one clj process per solution')
+    parser.add_argument('--no_exec_cache', action='store_true', help='execute every program instead of taking the output of an identical program from cache/execution')
+    parser.add_argument('--exec_cache_mb', type=int, default=256, help='size limit of the execution cache in MB, default is 256')
+    parser.add_argument('--rust_opt_level', default='2', help='rustc opt-level of the rust solutions, default is 2')
+    parser.add_argument('--rust_compile_workers', type=int, default=0, help='number of parallel rustc processes, default is half the number of cpu cores')
     parser.add_argument('--n100', action='store_true', help='only 100 problems') # this is the default
     parser.add_argument('--n200', action='store_true', help='only 200 problems')
     parser.add_argument('--n400', action='store_true', help='only 400 problems')
     parser.add_argument('--nall', action='store_true', help='all problems')
 
     args = parser.parse_args()
+    if args.pipeline and args.tool:
+        parser.error("--pipeline cannot be used in combination with --tool")
     api_base = args.api if args.api else args.api_base.split(",") if "," in args.api_base else [args.api_base]
     store_name = args.model
     max_problem_number = 200
@@ -74,7 +99,7 @@ def main():
 
     # find models to test
     models = []
-    local_endpoint = Endpoint(store_name=store_name, model_name=store_name, key="", url=f"{api_base[0]}/v1/chat/completions")
+    local_endpoint = api_stub_endpoint(store_name, store_name, api_base[0])
     model_dict = openai_api_list(local_endpoint)
     if args.allmodels:
         if endpoint_name:
@@ -96,6 +121,13 @@ def main():
 
     # get languages
     languages = args.language.split(',')
+
+    # with --allmodels the inference of all missing models runs at once, so the servers can work on different models
+    # at the same time; the solutions are then extracted and executed model by model
+    sweep = args.allmodels and not args.tool and not args.pipeline and not overwrite_existing and not overwrite_failed
+    pipeline = args.pipeline
+    if sweep:
+        sweep_inference(",".join(api_base), languages, max_problem_number, think = args.think, no_think = args.no_think)
     
     # loop over all models
     for model in models:
@@ -113,6 +145,27 @@ def main():
             else:
                 print(f"No existing solutions in {solutions_model_dir} to remove")
 
+        if pipeline:
+            # inference, code extraction, execution and scoring of all missing languages in one process
+            from pipeline import run_pipeline
+            from execute_java import set_java_worker
+            from execute_clojure import set_clojure_worker
+            from execute_rust import set_rust_build
+            from execute import set_execution_cache
+            set_java_worker(args.java_worker)
+            set_clojure_worker(args.clojure_worker)
+            set_rust_build(args.rust_opt_level, args.rust_compile_workers)
+            set_execution_cache(not args.no_exec_cache, args.exec_cache_mb)
+            benchmark = read_benchmark()
+            entry = benchmark.get(model_solution_name, {})
+            pipeline_languages = [language for language in languages
+                                  if get_bench_name(language, max_problem_number) not in entry or overwrite_existing or overwrite_failed]
+            if pipeline_languages:
+                print(f"Testing model {model} with languages {', '.join(pipeline_languages)} in pipeline mode")
+                run_pipeline(api_base, endpoint_name, model, pipeline_languages, max_problem_number,
+                             overwrite_existing = overwrite_existing, overwrite_failed = overwrite_failed,
+                             think = args.think, no_think = args.no_think, workers = args.workers)
+
         # loop over all languages
         for language in languages:
 
@@ -127,9 +180,11 @@ def main():
             entry = benchmark.get(model_benchmark_name, {})
 
             # add metadata to benchmark.json
-            if not model_benchmark_name in benchmark or not bench_name in benchmark[model_benchmark_name] or overwrite_existing or overwrite_failed:
+            if not pipeline and (not model_benchmark_name in benchmark or not bench_name in benchmark[model_benchmark_name] or overwrite_existing or overwrite_failed):
                 # run the model; this writes a news entry to benchmark.json
-                test(",".join(api_base), endpoint_name, model, language, overwrite_existing, overwrite_failed, max_problem_number, think = args.think, no_think = args.no_think, tool_mode = args.tool)
+                test(",".join(api_base), endpoint_name, model, language, overwrite_existing, overwrite_failed, max_problem_number, think = args.think, no_think = args.no_think, tool_mode = args.tool, run_inference = not sweep, java_worker = args.java_worker, clojure_worker = args.clojure_worker,
+                     exec_cache = not args.no_exec_cache, exec_cache_mb = args.exec_cache_mb,
+                     rust_opt_level = args.rust_opt_level, rust_compile_workers = args.rust_compile_workers)
                 # load benchmark.json again because the test has updated it
                 benchmark = read_benchmark()
                 # because testing can be interrupted, there is no guarantee that the entry is present